@@ -0,0 +1,287 @@
+"""
+Optional pre-analysis of code.
+
+Evaluating a raw pair means evaluating its car, looking at whatever combiner
+that yields and then walking the operands.  Here we turn combinations into
+node objects that remember their structure ahead of time: a generic
+combination node with its operands already analyzed (so evaluating arguments
+doesn't have to look at the original pairs again), and fast nodes for the
+combinations whose operator is a symbol naming one of a few ground operatives
+($if, $sequence, $define!, $vau and $lambda).
+
+Since environments are first class and operatives can be rebound, fast nodes
+check on each evaluation that their operator still evaluates to the ground
+combiner they were built for.  If it doesn't, they fall back to combining
+whatever the operator evaluates to with the original operands.
+
+Nodes only ever take the place of code.  Operatives always get the original
+operand trees, so no node leaks into user data.
+
+By itself this is groundwork rather than a speedup: nodes still look their
+operator up and go through the same continuations as the tree walker, so
+untranslated, `--analyze` runs bench.k only about 10% faster and
+bench-numeric.k no faster, and translated with the JIT the gain on bench.k
+drops to about 5%.  So analysis stays off unless asked for.  The bytecode compiler in vm.py builds on the
+special form recognition here (`special_form_name`, `operand_list`), and
+that's where the time goes down.
+"""
+
+import interpreter
+import kernel_type as kt
+
+
+class AnalysisState(object):
+    def __init__(self):
+        self.enabled = False
+
+def enable():
+    interpreter.current().analysis.enabled = True
+
+def disable():
+    interpreter.current().analysis.enabled = False
+
+def is_enabled():
+    return interpreter.current().analysis.enabled
+
+# Ground combiners for which we build fast nodes, filled in by primitive.py.
+special_forms = {}
+
+def register_special_form(name, combiner):
+    assert name in _analyzers, "no analyzer for %s" % name
+    special_forms[name] = combiner
+
+def analyze(expr):
+    """Return the node to evaluate in place of `expr`."""
+    if isinstance(expr, kt.Pair) and not isinstance(expr, Node):
+        return analyze_combination(expr)
+    else:
+        # Symbols and self-evaluating values are their own nodes.
+        return expr
+
+def analyze_body(exprs):
+    """Analyze a list of expressions to be evaluated in sequence.  Improper
+    lists are returned as they are, so the error shows up at run time as
+    usual."""
+    nodes = analyze_list(exprs)
+    if nodes is None:
+        return exprs
+    return nodes
+
+def analyze_list(exprs):
+    nodes = []
+    rest = exprs
+    while isinstance(rest, kt.Pair):
+        nodes.append(analyze(rest.car))
+        rest = rest.cdr
+    if not kt.is_nil(rest):
+        return None
+    return kt.kernelify_list(nodes)
+
+def analyze_combination(pair):
+    operator = pair.car
+    name = special_form_name(operator)
+    if name is not None:
+        node = _analyzers[name](pair, operator, special_forms[name])
+        if node is not None:
+            return node
+    return Combination(pair, analyze(operator), analyze_list(pair.cdr))
+
+def special_form_name(operator):
+    if isinstance(operator, kt.Symbol):
+        if operator.symval in special_forms:
+            return operator.symval
+        return None
+    # Code built by a program (e.g., `load` wraps files in a combination of
+    # the actual $sequence operative) may have the combiner itself as operator.
+    for name, combiner in special_forms.iteritems():
+        if operator is combiner:
+            return name
+    return None
+
+def operand_list(pair, min_length, max_length=-1):
+    """Python list with the operands of `pair`, or None if they're not a proper
+    list of the given length."""
+    ret = []
+    rest = pair.cdr
+    while isinstance(rest, kt.Pair):
+        ret.append(rest.car)
+        rest = rest.cdr
+    if not kt.is_nil(rest):
+        return None
+    if len(ret) < min_length or (max_length != -1 and len(ret) > max_length):
+        return None
+    return ret
+
+def stamp_source_pos(source_pos, cont):
+    # See Pair.interpret.
+    if cont.source_pos == kt.NO_SOURCE_POS:
+        cont.source_pos = source_pos
+
+class Node(kt.Pair):
+    """Base class for analyzed combinations.
+
+    Nodes are pairs (with the same car and cdr as the original combination) so
+    they print, compare and answer `pair?` like the code they come from, if
+    they're ever seen by the debugger or error reports."""
+    def __init__(self, pair):
+        kt.Pair.__init__(self, pair.car, pair.cdr, pair.source_pos)
+    def interpret(self, env, cont):
+        raise NotImplementedError
+
+class Combination(Node):
+    _immutable_fields_ = ['operator', 'args']
+    def __init__(self, pair, operator, args):
+        Node.__init__(self, pair)
+        self.operator = operator
+        # List of argument nodes, or None if the operands are not a proper
+        # list.
+        self.args = args
+    def interpret(self, env, cont):
+        stamp_source_pos(self.source_pos, cont)
+        return self.operator, env, CombineNodeCont(self,
+                                                   env,
+                                                   cont,
+                                                   self.operator.source_pos)
+    def combine(self, combiner, env, cont):
+        if self.args is not None and isinstance(combiner, kt.Applicative):
+            return kt.evaluate_arguments(
+                    self.args,
+                    env,
+                    kt.ApplyCont(combiner.wrapped_combiner, env, cont))
+        else:
+            return combiner.combine(self.cdr, env, cont)
+
+class CombineNodeCont(kt.Continuation):
+    def __init__(self, node, env, prev, source_pos=kt.NO_SOURCE_POS):
+        kt.Continuation.__init__(self, prev)
+        self.node = node
+        self.env = env
+        self.source_pos = source_pos
+    def _plug_reduce(self, val):
+        return self.node.combine(val, self.env, self.prev)
+
+class SpecialForm(Node):
+    """A combination whose operator we expect to evaluate to `expected`."""
+    _immutable_fields_ = ['operator', 'expected']
+    def __init__(self, pair, operator, expected):
+        Node.__init__(self, pair)
+        self.operator = operator
+        self.expected = expected
+    def interpret(self, env, cont):
+        stamp_source_pos(self.source_pos, cont)
+        if isinstance(self.operator, kt.Symbol):
+            combiner = env.lookup(self.operator)
+        else:
+            combiner = self.operator
+        if combiner is self.expected:
+            return self.fast_path(env, cont)
+        else:
+            # The guard failed; do what evaluating the original pair would.
+            return combiner.combine(self.cdr, env, cont)
+    def fast_path(self, env, cont):
+        raise NotImplementedError
+
+class IfNode(SpecialForm):
+    _immutable_fields_ = ['test', 'consequent', 'alternative']
+    def __init__(self, pair, operator, expected, test, consequent,
+                 alternative):
+        SpecialForm.__init__(self, pair, operator, expected)
+        self.test = test
+        self.consequent = consequent
+        self.alternative = alternative
+    def fast_path(self, env, cont):
+        return self.test, env, kt.IfCont(self.consequent,
+                                         self.alternative,
+                                         env,
+                                         cont)
+
+def analyze_if(pair, operator, expected):
+    operands = operand_list(pair, 3, 3)
+    if operands is None:
+        return None
+    test, consequent, alternative = operands
+    return IfNode(pair, operator, expected,
+                  analyze(test), analyze(consequent), analyze(alternative))
+
+class SequenceNode(SpecialForm):
+    _immutable_fields_ = ['body']
+    def __init__(self, pair, operator, expected, body):
+        SpecialForm.__init__(self, pair, operator, expected)
+        self.body = body
+    def fast_path(self, env, cont):
+        return kt.sequence(self.body, env, cont)
+
+def analyze_sequence(pair, operator, expected):
+    body = analyze_list(pair.cdr)
+    if body is None:
+        return None
+    return SequenceNode(pair, operator, expected, body)
+
+class DefineNode(SpecialForm):
+    _immutable_fields_ = ['definiend', 'expression']
+    def __init__(self, pair, operator, expected, definiend, expression):
+        SpecialForm.__init__(self, pair, operator, expected)
+        self.definiend = definiend
+        self.expression = expression
+    def fast_path(self, env, cont):
+        return self.expression, env, kt.DefineCont(
+                self.definiend,
+                env,
+                cont,
+                self.expression.source_pos)
+
+def analyze_define(pair, operator, expected):
+    operands = operand_list(pair, 2, 2)
+    if operands is None:
+        return None
+    definiend, expression = operands
+    return DefineNode(pair, operator, expected, definiend, analyze(expression))
+
+class VauNode(SpecialForm):
+    _immutable_fields_ = ['formals', 'eformal', 'exprs', 'body', 'layout']
+    def __init__(self, pair, operator, expected, formals, eformal, exprs):
+        SpecialForm.__init__(self, pair, operator, expected)
+        self.formals = formals
+        self.eformal = eformal
+        self.exprs = exprs
+        # Shared by all the operatives this node creates.
+        self.body = analyze_body(exprs)
+        self.layout = kt.frame_layout(formals, eformal)
+    def fast_path(self, env, cont):
+        return cont.plug_reduce(self.make_operative(env))
+    def make_operative(self, env):
+        return kt.make_compound_operative(self.formals,
+                                          self.eformal,
+                                          self.exprs,
+                                          env,
+                                          body=self.body,
+                                          layout=self.layout)
+
+def analyze_vau(pair, operator, expected):
+    operands = operand_list(pair, 2)
+    if operands is None:
+        return None
+    rest = pair.cdr
+    assert isinstance(rest, kt.Pair)
+    rest = rest.cdr
+    assert isinstance(rest, kt.Pair)
+    return VauNode(pair, operator, expected, operands[0], operands[1], rest.cdr)
+
+class LambdaNode(VauNode):
+    def fast_path(self, env, cont):
+        return cont.plug_reduce(kt.Applicative(self.make_operative(env)))
+
+def analyze_lambda(pair, operator, expected):
+    operands = operand_list(pair, 1)
+    if operands is None:
+        return None
+    rest = pair.cdr
+    assert isinstance(rest, kt.Pair)
+    return LambdaNode(pair, operator, expected, operands[0], kt.ignore,
+                      rest.cdr)
+
+_analyzers = {'$if': analyze_if,
+              '$sequence': analyze_sequence,
+              '$define!': analyze_define,
+              '$vau': analyze_vau,
+              '$lambda': analyze_lambda}
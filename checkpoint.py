@@ -0,0 +1,611 @@
+"""
+Checkpoints: running computations saved to a file, to be resumed later.
+
+All of a computation's control state is its continuation, a chain of
+`Continuation` objects, so `(checkpoint path)` saves the continuation of the
+call along with everything it refers to (environments, combiners, data),
+and `(resume path)` reads it back and passes #t to it, so the `checkpoint`
+call returns again, this time with #t (it returns #f when it saves).  The
+file may be resumed any number of times, by another process or on another
+machine running the same kernel.k and extension.k (`interpret.py --resume
+FILE` does it from the command line): standard bindings (and the ground and
+extended environments themselves) are written by name and looked up again
+when resuming.
+
+A checkpoint goes all the way down to the root continuation, so resuming it
+abandons the current computation in favour of the saved one, unless it was
+taken within `(call-with-checkpoint-root combiner)`.  Then only the
+computation up to the return from that call is saved, and resuming passes
+its value to the `resume` call instead.  Continuations captured outside of
+it are cut the same way.
+
+The encoding extends the one in serialize.py.  Environments, combiners and
+continuation frames may refer to each other in cycles, so unlike pairs they
+get their numbers before their contents are written, and the decoder
+creates them empty and fills them in.  Continuations are written frame by
+frame from the innermost out, in a loop, so deep ones don't eat native
+stack.
+
+Ports, threads, promises and other things tied to this process can't be
+saved, nor can continuations of green threads other than the main one or
+of nested evaluations (like those of `parallel-map` workers).  Analyzed code
+is saved as the original expressions; VM frames are saved with the
+expressions of their code, which is compiled again (into the same
+instructions) when resuming.
+"""
+
+import os
+
+from rpython.rlib.objectmodel import instantiate, specialize
+
+import kernel_type as kt
+import serialize
+import threads
+import vm
+
+
+NAMED = 'N'
+NONE = '0'
+SOME = '1'
+ROOT = '^'
+ENVIRONMENT = 'e'
+FRAME = 'l'
+OPERATIVE = 'o'
+LAMBDA = 'm'
+APPLICATIVE = 'a'
+CONT_WRAPPER = 'w'
+CODE = 'c'
+KEYED_BINDER = 'k'
+KEYED_ACCESSOR = 'q'
+ENCAPSULATION_TYPE = 'h'
+ENCAPSULATED = 'j'
+ENCAPSULATION_CONSTRUCTOR = 'u'
+ENCAPSULATION_PREDICATE = 'v'
+ENCAPSULATION_ACCESSOR = 'z'
+
+# Continuation frames.
+SEQUENCE_CONT = 'S'
+COMBINE_CONT = 'C'
+EVAL_ARGS_CONT = 'E'
+NO_MORE_ARGS_CONT = 'M'
+GATHER_ARGS_CONT = 'G'
+APPLY_CONT = 'A'
+IF_CONT = 'I'
+COND_CONT = 'O'
+DEFINE_CONT = 'D'
+AND_CONT = 'H'
+OR_CONT = 'R'
+MAP_CONT = 'P'
+CONSTANT_CONT = 'K'
+EXTEND_CONT = 'X'
+INNER_GUARD_CONT = 'J'
+OUTER_GUARD_CONT = 'U'
+KEYED_DYNAMIC_CONT = 'B'
+VM_CONT = 'V'
+FUEL_CONT = 'F'
+BINDS_CONT = 'Y'
+CONT_TAGS = 'SCEMGAIODHRPKXJUBVFY'
+
+class CheckpointRootCont(kt.Continuation):
+    """Marks the return from `call-with-checkpoint-root`."""
+
+class Encoder(serialize.Encoder):
+    def __init__(self, port, names):
+        serialize.Encoder.__init__(self, port)
+        # Names of the standard values.
+        self.names = names
+    def write_ref(self, val):
+        name = self.names.get(val, None)
+        if name is not None:
+            self.port.write(NAMED)
+            self.write_str(name)
+            return True
+        return serialize.Encoder.write_ref(self, val)
+    def encode(self, val):
+        while isinstance(val, kt.Continuation):
+            if isinstance(val, CheckpointRootCont):
+                self.port.write(ROOT)
+                return
+            if self.write_ref(val):
+                return
+            self.encode_frame(val)
+            val = val.prev
+        serialize.Encoder.encode(self, val)
+    def encode_optional(self, val):
+        if val is None:
+            self.port.write(NONE)
+        else:
+            self.port.write(SOME)
+            self.encode(val)
+    def encode_list(self, vals):
+        self.write_uint(len(vals))
+        for val in vals:
+            self.encode(val)
+    def encode_atom(self, val):
+        if isinstance(val, kt.KeyedEnvironment):
+            kt.signal_value_error("Can't serialize value",
+                                  kt.Pair(val, kt.nil))
+        elif isinstance(val, kt.Frame):
+            self.port.write(FRAME)
+            self.remember(val)
+            self.encode(val.parents[0])
+            self.write_uint(len(val.layout.symvals))
+            for i in range(len(val.layout.symvals)):
+                self.write_str(val.layout.symvals[i])
+                self.encode_optional(val.values[i])
+            if val.bindings is None:
+                self.write_uint(0)
+            else:
+                self.encode_bindings(val.bindings)
+        elif isinstance(val, kt.Environment):
+            self.port.write(ENVIRONMENT)
+            self.remember(val)
+            self.encode_list(val.parents)
+            self.encode_bindings(val.bindings)
+        elif isinstance(val, kt.CompoundOperative):
+            if isinstance(val, kt.Lambda):
+                self.port.write(LAMBDA)
+                self.remember(val)
+            else:
+                self.port.write(OPERATIVE)
+                self.remember(val)
+                self.encode(val.eformal)
+            self.encode(val.formals)
+            self.encode(val.exprs)
+            self.encode(val.static_env)
+            if val.name is None:
+                self.port.write(NONE)
+            else:
+                self.port.write(SOME)
+                self.write_str(val.name)
+        elif isinstance(val, kt.Applicative):
+            self.port.write(APPLICATIVE)
+            self.remember(val)
+            self.encode(val.wrapped_combiner)
+        elif isinstance(val, kt.ContWrapper):
+            self.port.write(CONT_WRAPPER)
+            self.remember(val)
+            self.encode(val.cont)
+        elif isinstance(val, vm.Code):
+            self.port.write(CODE)
+            self.encode(val.exprs)
+            self.remember(val)
+        elif isinstance(val, kt.KeyedDynamicBinder):
+            self.port.write(KEYED_BINDER)
+            self.remember(val)
+        elif isinstance(val, kt.KeyedDynamicAccessor):
+            self.port.write(KEYED_ACCESSOR)
+            self.remember(val)
+            self.encode(val.binder)
+        elif isinstance(val, kt.EncapsulationType):
+            self.port.write(ENCAPSULATION_TYPE)
+            self.remember(val)
+        elif isinstance(val, kt.EncapsulatedObject):
+            self.port.write(ENCAPSULATED)
+            self.remember(val)
+            self.encode(val.val)
+            self.encode(val.encapsulation_type)
+        elif isinstance(val, kt.EncapsulationMethod):
+            if isinstance(val, kt.EncapsulationConstructor):
+                self.port.write(ENCAPSULATION_CONSTRUCTOR)
+            elif isinstance(val, kt.EncapsulationPredicate):
+                self.port.write(ENCAPSULATION_PREDICATE)
+            else:
+                self.port.write(ENCAPSULATION_ACCESSOR)
+            self.remember(val)
+            self.encode(val.encapsulation_type)
+        else:
+            serialize.Encoder.encode_atom(self, val)
+    def encode_bindings(self, bindings):
+        self.write_uint(len(bindings))
+        for symval, val in bindings.items():
+            self.write_str(symval)
+            self.encode(val)
+    def encode_frame(self, cont):
+        """Write `cont`, but not its parent."""
+        import analyze
+        if isinstance(cont, kt.SequenceCont):
+            self.start_frame(SEQUENCE_CONT, cont)
+            self.encode(cont.exprs)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.CombineCont):
+            self.start_frame(COMBINE_CONT, cont)
+            self.encode(cont.operands)
+            self.encode(cont.env)
+        elif isinstance(cont, analyze.CombineNodeCont):
+            # Combining with the operands of the node does the same.
+            self.start_frame(COMBINE_CONT, cont)
+            self.encode(cont.node.cdr)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.EvalArgsCont):
+            self.start_frame(EVAL_ARGS_CONT, cont)
+            self.encode(cont.exprs)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.NoMoreArgsCont):
+            self.start_frame(NO_MORE_ARGS_CONT, cont)
+        elif isinstance(cont, kt.GatherArgsCont):
+            self.start_frame(GATHER_ARGS_CONT, cont)
+            self.encode(cont.val)
+        elif isinstance(cont, kt.ApplyCont):
+            self.start_frame(APPLY_CONT, cont)
+            self.encode(cont.combiner)
+            self.encode_optional(cont.env)
+        elif isinstance(cont, kt.IfCont):
+            self.start_frame(IF_CONT, cont)
+            self.encode(cont.consequent)
+            self.encode(cont.alternative)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.CondCont):
+            self.start_frame(COND_CONT, cont)
+            self.encode(cont.clauses)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.DefineCont):
+            self.start_frame(DEFINE_CONT, cont)
+            self.encode(cont.definiend)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.AndCont):
+            self.start_frame(AND_CONT, cont)
+            self.encode(cont.exprs)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.OrCont):
+            self.start_frame(OR_CONT, cont)
+            self.encode(cont.exprs)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.MapCont):
+            self.start_frame(MAP_CONT, cont)
+            self.encode(cont.combiner)
+            self.encode_list(cont.lists)
+            self.write_uint(cont.index)
+            self.encode_optional(cont.env)
+        elif isinstance(cont, kt.ConstantCont):
+            self.start_frame(CONSTANT_CONT, cont)
+            self.encode(cont.val)
+        elif isinstance(cont, kt.ExtendCont):
+            self.start_frame(EXTEND_CONT, cont)
+            self.encode(cont.receiver)
+            self.encode_optional(cont.env)
+        elif isinstance(cont, kt.GuardCont):
+            if isinstance(cont, kt.InnerGuardCont):
+                self.start_frame(INNER_GUARD_CONT, cont)
+            else:
+                self.start_frame(OUTER_GUARD_CONT, cont)
+            self.encode(cont.guards)
+            self.encode(cont.env)
+        elif isinstance(cont, kt.KeyedDynamicCont):
+            self.start_frame(KEYED_DYNAMIC_CONT, cont)
+            self.encode(cont.binder)
+            self.encode(cont.value)
+        elif isinstance(cont, vm.VMCont):
+            self.start_frame(VM_CONT, cont)
+            self.encode(cont.code)
+            self.write_uint(cont.pc)
+            self.encode_list(cont.stack)
+            self.encode(cont.env)
+        elif isinstance(cont, threads.FuelCont):
+            self.start_frame(FUEL_CONT, cont)
+            self.write_int(cont.budget.fuel)
+        elif isinstance(cont, kt.BindsCont):
+            self.start_frame(BINDS_CONT, cont)
+            self.encode_list(cont.pyvals)
+        else:
+            kt.signal_value_error("Can't serialize continuation",
+                                  kt.Pair(cont, kt.nil))
+    def start_frame(self, tag, cont):
+        self.port.write(tag)
+        self.remember(cont)
+
+class Decoder(serialize.StringDecoder):
+    def __init__(self, data, names, root):
+        serialize.StringDecoder.__init__(self, data)
+        # Standard values by name.
+        self.names = names
+        # What the checkpoint root stands for.
+        self.root = root
+    @specialize.arg(1)
+    def start(self, cls):
+        """Empty instance of `cls`, with the next number."""
+        val = instantiate(cls)
+        val.source_pos = kt.NO_SOURCE_POS
+        self.objects.append(val)
+        return val
+    @specialize.arg(1)
+    def decode_instance(self, cls):
+        val = self.decode()
+        if not isinstance(val, cls):
+            serialize.signal_malformed()
+        assert isinstance(val, cls)
+        return val
+    @specialize.arg(1)
+    def decode_optional(self, cls):
+        tag = self.read_tag()
+        if tag == NONE:
+            return None
+        if tag != SOME:
+            serialize.signal_malformed()
+        return self.decode_instance(cls)
+    def decode_list(self):
+        vals = []
+        for i in range(self.read_length()):
+            vals.append(self.decode())
+        return vals
+    def decode_bindings(self, bindings):
+        for i in range(self.read_length()):
+            symval = self.read_str()
+            bindings[symval] = self.decode()
+    def decode_atom(self, tag):
+        if tag == NAMED:
+            val = self.names.get(self.read_str(), None)
+            if val is None:
+                kt.signal_value_error("Checkpoint refers to unknown binding",
+                                      kt.nil)
+            return val
+        elif tag == ROOT:
+            return self.root
+        elif tag in CONT_TAGS:
+            return self.decode_conts(tag)
+        elif tag == ENVIRONMENT:
+            env = self.start(kt.Environment)
+            env.parents = []
+            env.bindings = {}
+            for parent in self.decode_list():
+                if not isinstance(parent, kt.Environment):
+                    serialize.signal_malformed()
+                assert isinstance(parent, kt.Environment)
+                env.parents.append(parent)
+            self.decode_bindings(env.bindings)
+            return env
+        elif tag == FRAME:
+            frame = self.start(kt.Frame)
+            frame.bindings = None
+            frame.parents = [self.decode_instance(kt.Environment)]
+            symvals = []
+            values = []
+            for i in range(self.read_length()):
+                symvals.append(self.read_str())
+                values.append(self.decode_optional(kt.KernelValue))
+            frame.layout = kt.FrameLayout(symvals)
+            frame.values = values
+            # Only used to tell JIT traces apart; the frames of calls made
+            # after resuming have it again.
+            frame.body = None
+            bindings = {}
+            self.decode_bindings(bindings)
+            if bindings:
+                frame.bindings = bindings
+            return frame
+        elif tag == OPERATIVE or tag == LAMBDA:
+            if tag == LAMBDA:
+                op = self.start(kt.Lambda)
+                eformal = kt.ignore
+            else:
+                op = self.start(kt.CompoundOperative)
+                eformal = self.decode()
+            formals = self.decode()
+            exprs = self.decode()
+            static_env = self.decode_instance(kt.Environment)
+            name = None
+            if self.read_tag() == SOME:
+                name = self.read_str()
+            if isinstance(op, kt.Lambda):
+                kt.Lambda.__init__(op, formals, exprs, static_env, name=name)
+            else:
+                kt.CompoundOperative.__init__(op, formals, eformal, exprs,
+                                              static_env, name=name)
+            return op
+        elif tag == APPLICATIVE:
+            app = self.start(kt.Applicative)
+            app.wrapped_combiner = self.decode_instance(kt.Combiner)
+            return app
+        elif tag == CONT_WRAPPER:
+            wrapper = self.start(kt.ContWrapper)
+            wrapper.name = None
+            wrapper.cont = self.decode_instance(kt.Continuation)
+            return wrapper
+        elif tag == CODE:
+            body = vm.compile_body(self.decode())
+            if not isinstance(body, kt.Pair) or not isinstance(body.car, vm.Code):
+                serialize.signal_malformed()
+            assert isinstance(body, kt.Pair)
+            self.objects.append(body.car)
+            return body.car
+        elif tag == KEYED_BINDER:
+            return self.start(kt.KeyedDynamicBinder)
+        elif tag == KEYED_ACCESSOR:
+            accessor = self.start(kt.KeyedDynamicAccessor)
+            accessor.binder = self.decode_instance(kt.KeyedDynamicBinder)
+            return accessor
+        elif tag == ENCAPSULATION_TYPE:
+            return self.start(kt.EncapsulationType)
+        elif tag == ENCAPSULATED:
+            obj = self.start(kt.EncapsulatedObject)
+            obj.val = self.decode()
+            obj.encapsulation_type = self.decode_instance(kt.EncapsulationType)
+            return obj
+        elif tag == ENCAPSULATION_CONSTRUCTOR:
+            return self.decode_method(
+                    self.start(kt.EncapsulationConstructor))
+        elif tag == ENCAPSULATION_PREDICATE:
+            return self.decode_method(self.start(kt.EncapsulationPredicate))
+        elif tag == ENCAPSULATION_ACCESSOR:
+            return self.decode_method(self.start(kt.EncapsulationAccessor))
+        else:
+            return serialize.StringDecoder.decode_atom(self, tag)
+    def decode_method(self, method):
+        method.name = None
+        method.encapsulation_type = self.decode_instance(kt.EncapsulationType)
+        return method
+    def decode_conts(self, tag):
+        """Read a chain of frames, starting with the one for `tag`, and
+        return the innermost."""
+        first = None
+        last = None
+        while True:
+            cont = self.decode_frame(tag)
+            if last is None:
+                first = cont
+            else:
+                last.prev = cont
+            last = cont
+            tag = self.read_tag()
+            if tag not in CONT_TAGS:
+                break
+        base = self.decode_atom(tag)
+        if not isinstance(base, kt.Continuation):
+            serialize.signal_malformed()
+        assert isinstance(base, kt.Continuation)
+        last.prev = base
+        assert first is not None
+        return first
+    def decode_frame(self, tag):
+        """Frame for `tag`, without its parent yet."""
+        cont = None
+        if tag == SEQUENCE_CONT:
+            cont = self.start(kt.SequenceCont)
+            cont.exprs = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == COMBINE_CONT:
+            cont = self.start(kt.CombineCont)
+            cont.operands = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == EVAL_ARGS_CONT:
+            cont = self.start(kt.EvalArgsCont)
+            cont.exprs = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == NO_MORE_ARGS_CONT:
+            cont = self.start(kt.NoMoreArgsCont)
+        elif tag == GATHER_ARGS_CONT:
+            cont = self.start(kt.GatherArgsCont)
+            cont.val = self.decode()
+        elif tag == APPLY_CONT:
+            cont = self.start(kt.ApplyCont)
+            cont.combiner = self.decode_instance(kt.Combiner)
+            cont.env = self.decode_optional(kt.Environment)
+        elif tag == IF_CONT:
+            cont = self.start(kt.IfCont)
+            cont.consequent = self.decode()
+            cont.alternative = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == COND_CONT:
+            cont = self.start(kt.CondCont)
+            cont.clauses = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == DEFINE_CONT:
+            cont = self.start(kt.DefineCont)
+            cont.definiend = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == AND_CONT:
+            cont = self.start(kt.AndCont)
+            cont.exprs = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == OR_CONT:
+            cont = self.start(kt.OrCont)
+            cont.exprs = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == MAP_CONT:
+            cont = self.start(kt.MapCont)
+            cont.combiner = self.decode_instance(kt.Combiner)
+            cont.lists = self.decode_list()
+            cont.index = self.read_length()
+            cont.env = self.decode_optional(kt.Environment)
+        elif tag == CONSTANT_CONT:
+            cont = self.start(kt.ConstantCont)
+            cont.val = self.decode()
+        elif tag == EXTEND_CONT:
+            cont = self.start(kt.ExtendCont)
+            cont.receiver = self.decode_instance(kt.Combiner)
+            cont.env = self.decode_optional(kt.Environment)
+        elif tag == INNER_GUARD_CONT or tag == OUTER_GUARD_CONT:
+            if tag == INNER_GUARD_CONT:
+                cont = self.start(kt.InnerGuardCont)
+            else:
+                cont = self.start(kt.OuterGuardCont)
+            cont.guards = self.decode()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == KEYED_DYNAMIC_CONT:
+            cont = self.start(kt.KeyedDynamicCont)
+            cont.binder = self.decode_instance(kt.KeyedDynamicBinder)
+            cont.value = self.decode()
+        elif tag == VM_CONT:
+            cont = self.start(vm.VMCont)
+            cont.code = self.decode_instance(vm.Code)
+            cont.pc = self.read_length()
+            cont.stack = self.decode_list()
+            cont.env = self.decode_instance(kt.Environment)
+        elif tag == FUEL_CONT:
+            cont = self.start(threads.FuelCont)
+            cont.budget = threads.Budget(self.read_int(),
+                                         threads.get_scheduler().slices)
+        elif tag == BINDS_CONT:
+            cont = self.start(kt.BindsCont)
+            cont.pyvals = self.decode_list()
+        else:
+            serialize.signal_malformed()
+        return cont
+
+def standard_names():
+    """Names for the values bound in the ground and extended environments,
+    and for those environments."""
+    import interpreter
+    interp = interpreter.current()
+    names = {}
+    for name, val in interp.extended_env.bindings.items():
+        name_standard(names, name, val)
+    # Ground bindings are the ones you get by name, if they are shadowed.
+    for name, val in interp.ground_env.bindings.items():
+        name_standard(names, name, val)
+    names[interp.extended_env] = '%extended'
+    names[interp.ground_env] = '%ground'
+    return names
+
+def name_standard(names, name, val):
+    """Name `val` and the combiners it wraps; continuations hold
+    unwrapped ones while they apply them."""
+    names[val] = name
+    while isinstance(val, kt.Applicative):
+        val = val.wrapped_combiner
+        name = '%unwrap ' + name
+        names[val] = name
+
+def standard_values():
+    values = {}
+    for val, name in standard_names().items():
+        values[name] = val
+    return values
+
+def write_file(path, cont):
+    """Save `cont` (up to the innermost checkpoint root) in `path`.  We
+    write a new file and rename it, so a crash while we write doesn't leave
+    a half-written checkpoint in place of the previous one."""
+    port = kt.StringOutputPort()
+    port.write(serialize.MAGIC)
+    port.write(serialize.VERSION)
+    Encoder(port, standard_names()).encode(cont)
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+    try:
+        serialize.write_all(fd, port.getvalue())
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.rename(tmp_path, path)
+
+def read_file(path, root):
+    """Continuation saved in `path`, with `root` standing for the
+    checkpoint root, if it was taken within one."""
+    fd = os.open(path, os.O_RDONLY, 0)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+    decoder = Decoder("".join(chunks), standard_values(), root)
+    if not decoder.decode_header():
+        serialize.signal_malformed()
+    cont = decoder.decode_instance(kt.Continuation)
+    if not decoder.at_end():
+        serialize.signal_malformed()
+    return cont
@@ -1,5 +1,7 @@
 import os
 
+import interpreter
+
 
 class DebugHook(object):
     def on_eval(self, val, env, cont):
@@ -14,21 +16,37 @@ class DebugHook(object):
                          entering):
         pass
 
+def flush_output():
+    # Make sure buffered kernel output shows up before ours.
+    interpreter.current().stdout_port.flush()
+
 def is_user_source(source_pos):
-    return (source_pos is not None
-            and source_pos.source_file.path != 'kernel.k'
-            and source_pos.source_file.path != 'extension.k')
+    import kernel_type as kt
+    import parse
+    if source_pos == kt.NO_SOURCE_POS:
+        return False
+    source_file = parse.source_file_of(source_pos)
+    if source_file is None:
+        return False
+    path = source_file.path
+    return path != 'kernel.k' and path != 'extension.k'
+
+def print_source_pos(source_pos, prefix=''):
+    import parse
+    parse.print_source_pos(source_pos, prefix)
 
 class StepHook(DebugHook):
     def on_eval(self, val, env, cont):
         if is_user_source(val.source_pos):
-            val.source_pos.print_()
+            flush_output()
+            print_source_pos(val.source_pos)
             return debug_interaction(env, cont)
         else:
             return val, env, cont
     def on_plug_reduce(self, val, cont):
         if is_user_source(cont.source_pos):
-            cont.source_pos.print_("        ")
+            flush_output()
+            print_source_pos(cont.source_pos, "        ")
             print "        return", val.tostring()
             print
     def on_abnormal_pass(self,
@@ -37,6 +55,7 @@ class StepHook(DebugHook):
                          dst_cont,
                          exiting,
                          entering):
+        flush_output()
         print "*** ABNORMAL PASS of %s from %s to %s" % (
                 val_tree.tostring(),
                 src_cont.tostring(),
@@ -47,7 +66,8 @@ class ResumeContHook(DebugHook):
         self.cont = cont
     def on_plug_reduce(self, val, cont):
         if is_user_source(cont.source_pos):
-            cont.source_pos.print_("        ")
+            flush_output()
+            print_source_pos(cont.source_pos, "        ")
             print "        return", val.tostring()
             print
         if cont is self.cont:
@@ -76,6 +96,8 @@ class ResumeContHook(DebugHook):
                 break
 
 class DebugState(object):
+    # Rarely changes, and argument evaluation checks it all the time.
+    _immutable_fields_ = ['step_hook?']
     def __init__(self):
         self.latest_command = None
         self.step_hook = None
@@ -101,9 +123,11 @@ class DebugState(object):
                                             exiting,
                                             entering)
     def on_error(self, e):
+        import kernel_type as kt
+        flush_output()
         print "Trying to evaluate %s" % e.val.tostring()
-        if e.val.source_pos:
-            e.val.source_pos.print_()
+        if e.val.source_pos != kt.NO_SOURCE_POS:
+            print_source_pos(e.val.source_pos)
         while True:
             val, env, cont = debug_interaction(e.env, e.src_cont)
             if val is None:
@@ -118,7 +142,7 @@ def guarded_ad_hoc_cont(cont):
     import kernel_type as kt
     s = primitive.standard_value
     env = primitive.standard_environment()
-    env.set(kt.get_interned('cont'), primitive.AdHocCont(cont))
+    env.set(kt.Symbol('cont'), primitive.AdHocCont(cont))
     return primitive.kernel_eval(
         kt.Pair(primitive.standard_value("$sequence"),
                 parse("""(guard-continuation
@@ -134,16 +158,17 @@ def debug_interaction(env, cont):
     import kernel_type as kt
     import parse
     import primitive
+    state = get_state()
     try:
         while True:
             os.write(1, "> ")
             cmd = readline()
             if cmd == "":
-                if _state.latest_command is not None:
-                    cmd = _state.latest_command
+                if state.latest_command is not None:
+                    cmd = state.latest_command
                 else:
                     continue
-            _state.latest_command = cmd
+            state.latest_command = cmd
             if cmd.startswith(",c"):
                 expr_src = cmd[2:].strip()
                 if expr_src:
@@ -159,16 +184,17 @@ def debug_interaction(env, cont):
                 start_stepping()
                 break
             elif cmd == ",n":
-                _state.step_hook = ResumeContHook(cont)
+                state.step_hook = ResumeContHook(cont)
                 break
             elif cmd == ",r":
                 prev = cont.prev
-                while prev is not None and prev.source_pos is None:
+                while (prev is not None
+                       and prev.source_pos == kt.NO_SOURCE_POS):
                     prev = prev.prev
                 if prev is None:
                     stop_stepping()
                 else:
-                    _state.step_hook = ResumeContHook(prev)
+                    state.step_hook = ResumeContHook(prev)
                 break
             elif cmd == ",e":
                 print_bindings(env, recursive=False)
@@ -181,15 +207,15 @@ def debug_interaction(env, cont):
                 assert isinstance(dbgexprs, kt.Pair)
                 assert kt.is_nil(kt.cdr(dbgexprs))
                 expr = kt.car(dbgexprs)
-                old = _state.step_hook
-                _state.step_hook = None
+                old = state.step_hook
+                state.step_hook = None
                 try:
                     dbgval = primitive.kernel_eval(expr,
                                                    env,
                                                    guarded_ad_hoc_cont(cont))
                     print dbgval.tostring()
                 finally:
-                    _state.step_hook = old
+                    state.step_hook = old
     except EOFError:
         stop_stepping()
     return None, None, None
@@ -212,23 +238,39 @@ def readline():
     return "".join(result)
 
 def print_bindings(env, recursive=False, indent=0):
-    for k, v in env.bindings.iteritems():
+    for k, v in env.local_bindings():
         print "    " * indent, k, ":", v.tostring()
     if recursive:
         for parent in env.parents:
             print " ---"
             print_bindings(parent, True, indent+1)
 
+def get_state():
+    return interpreter.current().debug
+
 def start_stepping():
-    _state.step_hook = step_hook
+    get_state().step_hook = step_hook
 
 def stop_stepping():
-    _state.step_hook = None
+    get_state().step_hook = None
+
+def is_stepping():
+    return get_state().step_hook is not None
+
+def on_eval(val, env, cont):
+    return get_state().on_eval(val, env, cont)
+
+def on_plug_reduce(val, cont):
+    get_state().on_plug_reduce(val, cont)
+
+def on_abnormal_pass(val_tree, src_cont, dst_cont, exiting, entering):
+    get_state().on_abnormal_pass(val_tree,
+                                 src_cont,
+                                 dst_cont,
+                                 exiting,
+                                 entering)
 
-_state = DebugState()
-on_eval = _state.on_eval
-on_plug_reduce = _state.on_plug_reduce
-on_abnormal_pass = _state.on_abnormal_pass
-on_error = _state.on_error
+def on_error(e):
+    return get_state().on_error(e)
 
 step_hook = StepHook()
@@ -6,8 +6,7 @@ import kernel_type as kt
 
 def entry_point(argv):
     jit.set_param(None, "trace_limit", 20000)
-    interpret.run(argv)
-    return 0
+    return interpret.run(argv)
 
 def target(driver, args):
     return entry_point, None
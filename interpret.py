@@ -1,23 +1,135 @@
 #!/usr/bin/env python
 
+import os
 import sys
 
+from rpython.rlib import rpath
+
 import kernel_type as kt
-import primitive
+from interpreter import Interpreter
+import parallel
+import server
+import testrunner
+
+
+USAGE = """usage: interpret.py [--analyze | --vm] FILE
+       interpret.py [--analyze | --vm] --resume CHECKPOINT
+       interpret.py [--analyze | --vm] --run-tests [--jobs N] [--junit]
+                    [--output REPORT] FILE
+       interpret.py [--analyze | --vm] --serve ADDRESS [--workers N] [--fuel N]
+       interpret.py --client ADDRESS (FILE | --eval TEXT | --stats)
 
+By default code runs in the tree walker.  --analyze compiles it into nodes
+first; that is experimental and off by default because it isn't measurably
+faster yet (about 5% on bench.k, nothing on bench-numeric.k).  --vm compiles
+it to bytecode instead.
+
+ADDRESS is HOST:PORT or the path of a Unix domain socket.
+"""
 
 def run(args):
-    env = primitive.extended_environment()
-    _, filename = args
+    args = args[1:]
+    if args and args[0] == '--client':
+        return run_client(args[1:])
+    interp = Interpreter()
+    if args and args[0] == '--analyze':
+        interp.analysis.enabled = True
+        args = args[1:]
+    elif args and args[0] == '--vm':
+        interp.vm.enabled = True
+        args = args[1:]
+    if args and args[0] == '--serve':
+        return run_server(interp, args[1:])
+    if args and args[0] == '--run-tests':
+        return run_tests(interp, args[1:])
+    resuming = len(args) == 2 and args[0] == '--resume'
+    if resuming:
+        args = args[1:]
+    elif len(args) != 1:
+        return usage()
+    filename = args[0]
     try:
-        program = primitive.parse_file(filename)
-        primitive.kernel_eval(program, env, kt.root_cont)
+        if resuming:
+            interp.resume_file(filename)
+        else:
+            interp.run_file(filename)
     except kt.KernelExit:
         pass
+    finally:
+        interp.stdout_port.flush()
     return 0
 
+def run_server(interp, args):
+    if not args:
+        return usage()
+    num_workers = parallel.worker_count()
+    fuel = 0
+    i = 1
+    while i < len(args):
+        if i + 1 == len(args):
+            return usage()
+        try:
+            n = int(args[i + 1])
+        except ValueError:
+            return usage()
+        if n < 1:
+            return usage()
+        if args[i] == '--workers':
+            num_workers = n
+        elif args[i] == '--fuel':
+            fuel = n
+        else:
+            return usage()
+        i += 2
+    return server.serve(interp, args[0], num_workers, fuel)
 
-if __name__ == '__main__':
-    run(sys.argv)
+def run_tests(interp, args):
+    jobs = parallel.worker_count()
+    junit = False
+    output_path = None
+    i = 0
+    while i < len(args) - 1:
+        if args[i] == '--junit':
+            junit = True
+            i += 1
+            continue
+        if i + 2 == len(args):
+            return usage()
+        if args[i] == '--jobs':
+            try:
+                jobs = int(args[i + 1])
+            except ValueError:
+                return usage()
+            if jobs < 1:
+                return usage()
+        elif args[i] == '--output':
+            output_path = args[i + 1]
+        else:
+            return usage()
+        i += 2
+    if i != len(args) - 1:
+        return usage()
+    try:
+        return testrunner.run(interp, args[i], jobs, junit, output_path)
+    finally:
+        interp.stdout_port.flush()
+
+def run_client(args):
+    if len(args) == 2 and args[1] == '--stats':
+        return server.request(args[0], server.STATS, '', True)
+    elif len(args) == 3 and args[1] == '--eval':
+        return server.request(args[0], server.EVAL_TEXT, args[2], True)
+    elif len(args) == 2:
+        # The server may be running somewhere else.
+        return server.request(args[0], server.EVAL_FILE,
+                              rpath.rabspath(args[1]), False)
+    else:
+        return usage()
 
+def usage():
+    os.write(2, USAGE)
+    return 2
 
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv))
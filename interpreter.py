@@ -0,0 +1,148 @@
+"""
+Interpreter instances.
+
+An `Interpreter` owns everything that used to be process-wide: its own ground
+and extended environments (kernel.k and extension.k are evaluated afresh for
+each one), the debugger, the evaluation mode (tree walking, analysis or VM),
+the search path for `load`, the numbering of the files it loads code from (for
+source positions), the green thread scheduler and the standard input and
+output ports (each with its own buffer).  The rest of the system is either
+immutable or made up of values that only become shared if the embedder
+passes them between interpreters.
+
+While an interpreter evaluates something it is the current one for its
+thread, which is how debug.py, analyze.py, vm.py and primitives like `load`
+find their state.  Evaluation may nest (an interpreter may run another one,
+or itself, from a primitive); the previous current interpreter is restored
+when the inner evaluation is done.
+"""
+
+import os
+
+from rpython.rlib import rthread
+
+
+class Interpreter(object):
+    def __init__(self, search_paths=None, stdin_port=None, stdout_port=None):
+        import analyze
+        import debug
+        import kernel_type as kt
+        import parse
+        import primitive
+        import threads
+        import vm
+        self.debug = debug.DebugState()
+        self.analysis = analyze.AnalysisState()
+        self.vm = vm.VMState()
+        self.scheduler = threads.Scheduler()
+        if search_paths is None:
+            search_paths = default_search_paths()
+        self.search_paths = search_paths
+        if stdin_port is None:
+            stdin_port = kt.FileInputPort(0, '<stdin>')
+        self.stdin_port = stdin_port
+        if stdout_port is None:
+            stdout_port = kt.FileOutputPort(1, line_buffered=os.isatty(1))
+        self.stdout_port = stdout_port
+        # The files we load code from, numbered for source positions.
+        self.source_files = parse.SourceFiles(primitive.builtin_source_files)
+        self.ground_env = primitive.make_ground_environment()
+        self.eval(primitive.kernel_program(), self.ground_env)
+        self.extended_env = kt.Environment([self.ground_env], {})
+        self.eval(primitive.extension_program(), self.extended_env)
+        # Like (list (list root-continuation intercept-exit)).
+        self.exit_guards = kt.Pair(
+                kt.Pair(kt.root_cont,
+                        kt.Pair(kt.Applicative(
+                                    kt.SimplePrimitive(intercept_exit,
+                                                       'intercept-exit')),
+                                kt.nil)),
+                kt.nil)
+
+    def eval(self, val, env, cont=None):
+        """Evaluate `val` in `env` and return the value passed to `cont`
+        (an ad hoc continuation that returns to the caller by default)."""
+        import primitive
+        prev = _current.get()
+        _current.set(self)
+        try:
+            return primitive.trampoline(val, env, cont)
+        finally:
+            _current.set(prev)
+
+    def eval_contained(self, val, env, base=None, fuel=0):
+        """Evaluate `val` in `env` and return its value, raising Escape
+        instead of letting anything leave the computation abnormally (an
+        error nobody handles, which would otherwise enter the debugger, or a
+        call to a continuation captured outside of it).
+
+        The computation's continuation extends `base` (the root continuation
+        by default), so it sees its keyed dynamic bindings.  If `fuel` is
+        positive the computation runs as if by `call-with-fuel`, so it
+        escapes with a fuel exhausted error if it takes longer."""
+        import kernel_type as kt
+        import primitive
+        if base is None:
+            base = kt.root_cont
+        if fuel > 0:
+            base = self.scheduler.with_fuel(fuel, base)
+        # Like (guard-continuation () base exit-guards).
+        outer = kt.OuterGuardCont(kt.nil, env, primitive.AdHocCont(base))
+        cont = kt.InnerGuardCont(self.exit_guards, env, outer)
+        return self.eval(val, env, cont)
+
+    def standard_value(self, name):
+        return self.ground_env.bindings[name]
+
+    def standard_environment(self):
+        import kernel_type as kt
+        return kt.Environment([self.ground_env], {})
+
+    def extended_environment(self):
+        import kernel_type as kt
+        return kt.Environment([self.extended_env], {})
+
+    def run_file(self, path):
+        """Run a program in a fresh extended environment, like the command
+        line does."""
+        import analyze
+        import kernel_type as kt
+        import primitive
+        program = primitive.parse_file(path, self.source_files)
+        if self.analysis.enabled:
+            program = analyze.analyze(program)
+        self.eval(program, self.extended_environment(), kt.root_cont)
+
+    def resume_file(self, path):
+        """Resume a checkpoint (see checkpoint.py), like the command line
+        does."""
+        import kernel_type as kt
+        self.eval(kt.Pair(self.standard_value('resume'),
+                          kt.Pair(kt.String(path), kt.nil)),
+                  self.extended_environment(),
+                  kt.root_cont)
+
+class Escape(Exception):
+    """Raised by `Interpreter.eval_contained` with the value (usually an
+    error object) that tried to leave the computation."""
+    def __init__(self, val):
+        self.val = val
+
+def intercept_exit(vals):
+    import kernel_type as kt
+    obj, divert = kt.pythonify_list(vals, 2)
+    raise Escape(obj)
+
+def default_search_paths():
+    paths = os.environ.get('KERNELPATH')
+    if paths is None:
+        return ['.']
+    return ['.'] + paths.split(':')
+
+_current = rthread.ThreadLocalReference(Interpreter)
+
+def current():
+    """The interpreter evaluating code in this thread."""
+    interp = _current.get()
+    assert interp is not None, "no interpreter running in this thread"
+    return interp
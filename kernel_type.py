@@ -1,14 +1,22 @@
 from itertools import product
+import math
+import os
+import sys
 
-from rpython.rlib import jit, rarithmetic, rstring
+from rpython.rlib import jit, rarithmetic, rfloat, rmmap, rpoll, rstring
+from rpython.rlib.objectmodel import specialize
 from rpython.rlib.rbigint import rbigint
 
 import debug
 
 
+# Source positions are integers packed by parse.py; values that weren't
+# parsed from a source file have this one.
+NO_SOURCE_POS = -1
+
 class KernelValue(object):
     simple = True
-    def __init__(self, source_pos=None):
+    def __init__(self, source_pos=NO_SOURCE_POS):
         self.source_pos = source_pos
     def equal(self, other):
         return other is self
@@ -28,7 +36,7 @@ class KernelValue(object):
 class String(KernelValue):
     type_name = 'string'
     _immutable_fields_ = ['strval']
-    def __init__(self, value, source_pos=None):
+    def __init__(self, value, source_pos=NO_SOURCE_POS):
         assert isinstance(value, str), "wrong value for String: %s" % value
         self.strval = value
         self.source_pos = source_pos
@@ -41,16 +49,32 @@ class String(KernelValue):
 
 class Number(KernelValue):
     type_name = 'number'
+    def num_eq(self, other):
+        """Numeric equality, as in `=?`.  Unlike `equal`, this is true for
+        numbers of different exactness with the same value."""
+        if isinstance(other, Flonum):
+            return other.num_eq(self)
+        return self.equal(other)
     def lteq(self, other):
-        return self.lt(other) or self.equal(other)
+        return self.lt(other) or self.num_eq(other)
     def gt(self, other):
         return other.lt(self)
     def gteq(self, other):
-        return self.gt(other) or self.equal(other)
+        return self.gt(other) or self.num_eq(other)
     def sub(self, other):
         return self.add(other.neg())
+    def abs(self):
+        raise NotImplementedError
+    def is_zero(self):
+        return False
+    def to_float(self):
+        raise NotImplementedError
+    def tostring_radix(self, radix):
+        return self.tostring()
 
 class Infinity(Number):
+    def abs(self):
+        return e_pos_inf
     def divide(self, other):
         # divide primitive already discards error cases.
         return zero
@@ -62,6 +86,8 @@ class Infinity(Number):
 class ExactPositiveInfinity(Infinity):
     def tostring(self):
         return "#e+infinity"
+    def to_float(self):
+        return rfloat.INFINITY
     def equal(self, other):
         return isinstance(other, ExactPositiveInfinity)
     def lt(self, other):
@@ -69,10 +95,14 @@ class ExactPositiveInfinity(Infinity):
     def add(self, other):
         if isinstance(other, ExactNegativeInfinity):
             signal_add_positive_to_negative_infinity(self, other)
+        elif isinstance(other, Flonum):
+            return other.add(self)
         else:
             return self
     def mul(self, other):
-        if zero.lt(other):
+        if isinstance(other, Flonum):
+            return other.mul(self)
+        elif zero.lt(other):
             return self
         elif other.lt(zero):
             return e_neg_inf
@@ -86,17 +116,26 @@ e_pos_inf = ExactPositiveInfinity()
 class ExactNegativeInfinity(Infinity):
     def tostring(self):
         return "#e-infinity"
+    def to_float(self):
+        return -rfloat.INFINITY
     def equal(self, other):
         return isinstance(other, ExactNegativeInfinity)
     def lt(self, other):
+        if isinstance(other, Flonum):
+            # False for #i-infinity and NaN.
+            return self.to_float() < other.floval
         return not isinstance(other, ExactNegativeInfinity)
     def add(self, other):
         if isinstance(other, ExactPositiveInfinity):
             signal_add_positive_to_negative_infinity(other, self)
+        elif isinstance(other, Flonum):
+            return other.add(self)
         else:
             return self
     def mul(self, other):
-        if zero.lt(other):
+        if isinstance(other, Flonum):
+            return other.mul(self)
+        elif zero.lt(other):
             return self
         elif other.lt(zero):
             return e_pos_inf
@@ -107,19 +146,47 @@ class ExactNegativeInfinity(Infinity):
 
 e_neg_inf = ExactNegativeInfinity()
 
-class Fixnum(Number):
+class Integer(Number):
+    """Exact, finite integer."""
+    type_name = 'integer'
+    def tobigint(self):
+        raise NotImplementedError
+    def abs(self):
+        raise NotImplementedError
+    def is_zero(self):
+        raise NotImplementedError
+    def tostring_radix(self, radix):
+        return self.tobigint().format(DIGITS[:radix])
+
+DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+class Fixnum(Integer):
     _immutable_fields_ = ['fixval']
-    def __init__(self, fixval, source_pos=None):
+    def __init__(self, fixval, source_pos=NO_SOURCE_POS):
         assert isinstance(fixval, int)
         self.fixval = fixval
         self.source_pos = source_pos
     def tostring(self):
         return str(self.fixval)
+    def tostring_radix(self, radix):
+        if radix == 10:
+            return str(self.fixval)
+        return Integer.tostring_radix(self, radix)
+    def tobigint(self):
+        return rbigint.fromint(self.fixval)
+    def to_float(self):
+        return float(self.fixval)
+    def is_zero(self):
+        return self.fixval == 0
     def equal(self, other):
         return isinstance(other, Fixnum) and other.fixval == self.fixval
     def lt(self, other):
         if isinstance(other, Fixnum):
             return self.fixval < other.fixval
+        elif isinstance(other, Bignum):
+            return other.bigval.int_gt(self.fixval)
+        elif isinstance(other, Flonum):
+            return self.to_float() < other.floval
         elif isinstance(other, ExactNegativeInfinity):
             return False
         else:
@@ -128,30 +195,48 @@ class Fixnum(Number):
         if isinstance(other, Fixnum):
             try:
                 res = rarithmetic.ovfcheck(other.fixval + self.fixval)
-                return Fixnum(res)
+                return make_fixnum(res)
             except OverflowError:
-                return Bignum(rbigint.fromint(self.fixval).add(rbigint.fromint(other.fixval)))
+                return Bignum(rbigint.fromint(self.fixval).int_add(other.fixval))
         else:
             assert isinstance(other, Number)
             return other.add(self)
+    def sub(self, other):
+        if isinstance(other, Fixnum):
+            try:
+                res = rarithmetic.ovfcheck(self.fixval - other.fixval)
+                return make_fixnum(res)
+            except OverflowError:
+                return Bignum(rbigint.fromint(self.fixval).int_sub(other.fixval))
+        else:
+            return Number.sub(self, other)
     def mul(self, other):
         if isinstance(other, Fixnum):
             try:
                 res = rarithmetic.ovfcheck(other.fixval * self.fixval)
-                return Fixnum(res)
+                return make_fixnum(res)
             except OverflowError:
-                return Bignum(rbigint.fromint(self.fixval).mul(rbigint.fromint(other.fixval)))
+                return Bignum(rbigint.fromint(self.fixval).int_mul(other.fixval))
         else:
             assert isinstance(other, Number)
             return other.mul(self)
     def divide_by(self, other):
         if isinstance(other, Fixnum):
-            return Fixnum(self.fixval // other.fixval)
+            try:
+                return make_fixnum(
+                        rarithmetic.ovfcheck(self.fixval // other.fixval))
+            except OverflowError:
+                return try_and_make_fixnum(
+                        self.tobigint().floordiv(other.tobigint()))
         else:
             return other.divide(self)
     def mod_by(self, other):
         if isinstance(other, Fixnum):
-            return Fixnum(self.fixval % other.fixval)
+            try:
+                return make_fixnum(
+                        rarithmetic.ovfcheck(self.fixval % other.fixval))
+            except OverflowError:
+                return zero
         else:
             return other.mod(self)
     def divmod_by(self, other):
@@ -159,125 +244,276 @@ class Fixnum(Number):
             # builtin divmod doesn't seem to work in RPython.
             s = self.fixval
             o = other.fixval
-            return Pair(Fixnum(s // o), Pair(Fixnum(s % o), nil))
+            try:
+                d = rarithmetic.ovfcheck(s // o)
+            except OverflowError:
+                return Pair(Bignum(self.tobigint().neg()), Pair(zero, nil))
+            return Pair(make_fixnum(d), Pair(make_fixnum(s % o), nil))
         else:
             return other.divmod(self)
     def neg(self):
         try:
-            return Fixnum(-self.fixval)
+            return make_fixnum(rarithmetic.ovfcheck(-self.fixval))
         except OverflowError:
             return Bignum(rbigint.fromint(self.fixval).neg())
+    def abs(self):
+        if self.fixval < 0:
+            return self.neg()
+        return self
 
-zero = Fixnum(0)
-one = Fixnum(1)
+# Boxes for small integers are preallocated and shared, so arithmetic on them
+# (counters, indices, lengths...) doesn't allocate.
+SMALL_INT_MIN = -128
+SMALL_INT_MAX = 1023
+small_fixnums = [Fixnum(i) for i in range(SMALL_INT_MIN, SMALL_INT_MAX + 1)]
 
-class Bignum(Number):
+def make_fixnum(i):
+    if SMALL_INT_MIN <= i <= SMALL_INT_MAX:
+        return small_fixnums[i - SMALL_INT_MIN]
+    return Fixnum(i)
+
+zero = make_fixnum(0)
+one = make_fixnum(1)
+
+class Bignum(Integer):
     _immutable_fields_ = ['bigval']
-    def __init__(self, bigval, source_pos=None):
+    def __init__(self, bigval, source_pos=NO_SOURCE_POS):
         assert isinstance(bigval, rbigint)
         self.bigval = bigval
         self.source_pos = source_pos
     def tostring(self):
-        return str(self.bigval)
+        return self.bigval.str()
+    def tobigint(self):
+        return self.bigval
+    def to_float(self):
+        try:
+            return self.bigval.tofloat()
+        except OverflowError:
+            if self.bigval.int_lt(0):
+                return -rfloat.INFINITY
+            return rfloat.INFINITY
+    def is_zero(self):
+        # We demote results that fit in a fixnum.
+        return False
     def equal(self, other):
         return isinstance(other, Bignum) and other.bigval.eq(self.bigval)
-    #XXX: refactor out duplication once we have them all implemented.
+    def lt(self, other):
+        if isinstance(other, Bignum):
+            return self.bigval.lt(other.bigval)
+        elif isinstance(other, Fixnum):
+            return self.bigval.int_lt(other.fixval)
+        elif isinstance(other, Flonum):
+            return self.to_float() < other.floval
+        elif isinstance(other, ExactNegativeInfinity):
+            return False
+        else:
+            return True
+    # Fixnum operands are used as they are where rbigint lets us, rather than
+    # converted to rbigints first.
     def add(self, other):
         if isinstance(other, Bignum):
-            otherval = other.bigval
+            return try_and_make_fixnum(self.bigval.add(other.bigval))
         elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+            return try_and_make_fixnum(self.bigval.int_add(other.fixval))
         else:
             assert isinstance(other, Number)
             return other.add(self)
-        return try_and_make_fixnum(self.bigval.add(otherval))
+    def sub(self, other):
+        if isinstance(other, Bignum):
+            return try_and_make_fixnum(self.bigval.sub(other.bigval))
+        elif isinstance(other, Fixnum):
+            return try_and_make_fixnum(self.bigval.int_sub(other.fixval))
+        else:
+            return Number.sub(self, other)
     def mul(self, other):
         if isinstance(other, Bignum):
-            otherval = other.bigval
+            return try_and_make_fixnum(self.bigval.mul(other.bigval))
         elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+            return try_and_make_fixnum(self.bigval.int_mul(other.fixval))
         else:
             assert isinstance(other, Number)
-            return other.add(self)
-        return try_and_make_fixnum(self.bigval.mul(otherval))
+            return other.mul(self)
     def divide(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Integer):
+            return try_and_make_fixnum(
+                    other.tobigint().floordiv(self.bigval))
         else:
             assert isinstance(other, Number)
             return other.divide_by(self)
-        return try_and_make_fixnum(otherval.floordiv(self.bigval))
     def divide_by(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Integer):
+            return try_and_make_fixnum(
+                    self.bigval.floordiv(other.tobigint()))
         else:
             assert isinstance(other, Number)
             return other.divide(self)
-        return try_and_make_fixnum(self.bigval.floordiv(otherval))
     def mod(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Integer):
+            return try_and_make_fixnum(other.tobigint().mod(self.bigval))
         else:
             assert isinstance(other, Number)
             return other.mod_by(self)
-        return try_and_make_fixnum(otherval.mod(self.bigval))
     def mod_by(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Fixnum):
+            return try_and_make_fixnum(self.bigval.int_mod(other.fixval))
+        elif isinstance(other, Bignum):
+            return try_and_make_fixnum(self.bigval.mod(other.bigval))
         else:
             assert isinstance(other, Number)
             return other.mod(self)
-        return try_and_make_fixnum(self.bigval.mod(otherval))
     def divmod(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Integer):
+            d, m = other.tobigint().divmod(self.bigval)
+            return Pair(try_and_make_fixnum(d),
+                        Pair(try_and_make_fixnum(m),
+                             nil))
         else:
             assert isinstance(other, Number)
             return other.divmod_by(self)
-        d, m = otherval.divmod(self.bigval)
-        return Pair(try_and_make_fixnum(d),
-                    Pair(try_and_make_fixnum(m),
-                         nil))
-
     def divmod_by(self, other):
-        if isinstance(other, Bignum):
-            otherval = other.bigval
-        elif isinstance(other, Fixnum):
-            otherval = rbigint.fromint(other.fixval)
+        if isinstance(other, Integer):
+            d, m = self.bigval.divmod(other.tobigint())
+            return Pair(try_and_make_fixnum(d),
+                        Pair(try_and_make_fixnum(m),
+                             nil))
         else:
             assert isinstance(other, Number)
             return other.divmod(self)
-        d, m = self.bigval.divmod(otherval)
-        return Pair(try_and_make_fixnum(d),
-                    Pair(try_and_make_fixnum(m),
-                         nil))
     def neg(self):
         return try_and_make_fixnum(self.bigval.neg())
+    def abs(self):
+        if self.bigval.int_lt(0):
+            return self.neg()
+        return self
+
+# rbigints with more digits than this can't possibly fit in a machine integer.
+MAX_FIXNUM_DIGITS = rbigint.fromint(-sys.maxint - 1).numdigits()
 
 def try_and_make_fixnum(bi):
+    if bi.numdigits() > MAX_FIXNUM_DIGITS:
+        return Bignum(bi)
     try:
         num = bi.toint()
-        return Fixnum(num)
+        return make_fixnum(num)
     except OverflowError:
         return Bignum(bi)
 
+class Flonum(Number):
+    """Inexact real number.
+
+    The value is an immutable machine double, so the JIT can keep it unboxed
+    in traces.  Operations with any other kind of number give a Flonum."""
+    _immutable_fields_ = ['floval']
+    def __init__(self, floval, source_pos=NO_SOURCE_POS):
+        assert isinstance(floval, float)
+        self.floval = floval
+        self.source_pos = source_pos
+    def tostring(self):
+        x = self.floval
+        if rfloat.isinf(x):
+            if x > 0:
+                return "#i+infinity"
+            else:
+                return "#i-infinity"
+        elif rfloat.isnan(x):
+            return "#undefined"
+        return rfloat.formatd(x, 'r', 0, rfloat.DTSF_ADD_DOT_0)
+    def tostring_radix(self, radix):
+        if radix != 10:
+            signal_value_error("Inexact numbers can only be written in radix 10",
+                               Pair(self, nil))
+        return self.tostring()
+    def to_float(self):
+        return self.floval
+    def is_zero(self):
+        return self.floval == 0.0
+    def equal(self, other):
+        return isinstance(other, Flonum) and other.floval == self.floval
+    def num_eq(self, other):
+        return self.floval == other.to_float()
+    def lt(self, other):
+        return self.floval < other.to_float()
+    def add(self, other):
+        return Flonum(self.floval + other.to_float())
+    def sub(self, other):
+        return Flonum(self.floval - other.to_float())
+    def mul(self, other):
+        return Flonum(self.floval * other.to_float())
+    def neg(self):
+        return Flonum(-self.floval)
+    def abs(self):
+        return Flonum(abs(self.floval))
+    # As for exact numbers, `x.divide_by(y)` is x div y, and `x.divide(y)` is y
+    # div x.  The division primitives rule out zero divisors.
+    def divide_by(self, other):
+        return Flonum(math.floor(self.floval / other.to_float()))
+    def divide(self, other):
+        return Flonum(math.floor(other.to_float() / self.floval))
+    def mod_by(self, other):
+        return Flonum(float_mod(self.floval, other.to_float()))
+    def mod(self, other):
+        return Flonum(float_mod(other.to_float(), self.floval))
+    def divmod_by(self, other):
+        return float_divmod(self.floval, other.to_float())
+    def divmod(self, other):
+        return float_divmod(other.to_float(), self.floval)
+
+def float_mod(x, y):
+    return x - y * math.floor(x / y)
+
+def float_divmod(x, y):
+    return Pair(Flonum(math.floor(x / y)),
+                Pair(Flonum(float_mod(x, y)), nil))
+
+def integer_gcd(a, b):
+    if isinstance(a, Fixnum) and isinstance(b, Fixnum):
+        x = a.fixval
+        y = b.fixval
+        # -sys.maxint - 1 has no fixnum absolute value.
+        if x != -sys.maxint - 1 and y != -sys.maxint - 1:
+            x = abs(x)
+            y = abs(y)
+            while y != 0:
+                x, y = y, x % y
+            return make_fixnum(x)
+    bx = a.tobigint().abs()
+    by = b.tobigint().abs()
+    while by.tobool():
+        bx, by = by, bx.mod(by)
+    return try_and_make_fixnum(bx)
+
+def integer_lcm(a, b):
+    if a.is_zero() or b.is_zero():
+        return zero
+    gcd = integer_gcd(a, b)
+    return a.divide_by(gcd).mul(b).abs()
+
+def integer_expt(base, power):
+    """`base` to the nonnegative `power`."""
+    if isinstance(base, Fixnum) and isinstance(power, Fixnum):
+        # Square and multiply in machine integers while we can.
+        result = 1
+        b = base.fixval
+        p = power.fixval
+        try:
+            while p > 0:
+                if p & 1:
+                    result = rarithmetic.ovfcheck(result * b)
+                p >>= 1
+                if p > 0:
+                    b = rarithmetic.ovfcheck(b * b)
+            return make_fixnum(result)
+        except OverflowError:
+            pass
+    return try_and_make_fixnum(base.tobigint().pow(power.tobigint()))
+
 #XXX: Unicode
 class Symbol(KernelValue):
 
     type_name = 'symbol'
     _immutable_fields_ = ['symval']
 
-    def __init__(self, value, source_pos=None):
+    def __init__(self, value, source_pos=NO_SOURCE_POS):
         assert isinstance(value, str), "wrong value for Symbol: %s" % value
         self.symval = value
         self.source_pos = source_pos
@@ -291,15 +527,6 @@ class Symbol(KernelValue):
     def equal(self, other):
         return isinstance(other, Symbol) and other.symval == self.symval
 
-_symbol_table = {}
-
-def get_interned(name):
-    try:
-        return _symbol_table[name]
-    except KeyError:
-        ret = _symbol_table[name] = Symbol(name)
-        return ret
-
 class List(KernelValue):
     pass
 
@@ -315,6 +542,16 @@ nil = Null()
 def is_nil(kv):
     return isinstance(kv, Null)
 
+def is_eq(a, b):
+    """Whether `a` and `b` are the same object.  Atoms like (), booleans,
+    symbols and numbers aren't unique in memory, so they are compared by
+    value."""
+    if a is b:
+        return True
+    if isinstance(a, Pair) or isinstance(a, String):
+        return False
+    return a.equal(b)
+
 class Ignore(KernelValue):
     type_name = 'ignore'
     def tostring(self):
@@ -342,7 +579,7 @@ def is_inert(kv):
 class Boolean(KernelValue):
     type_name = 'boolean'
     _immutable_fields_ = ['value']
-    def __init__(self, value, source_pos=None):
+    def __init__(self, value, source_pos=NO_SOURCE_POS):
         assert isinstance(value, bool), "wrong value for Boolean: %s" % value
         self.bval = value
         self.source_pos = source_pos
@@ -364,46 +601,114 @@ def kernel_boolean(python_boolean):
     return true if python_boolean else false
 
 class Pair(List):
+    """A pair.
+
+    `cdr` is read through `get_cdr`, so subclasses can hold the rest of a
+    short list in fields of their own (see Pair2 and Pair3) and only make a
+    pair for it if somebody asks.  Such a pair is made once and kept in
+    `_cdr`, so it stays the same object; that's the only time `_cdr` changes
+    after construction."""
     type_name = 'pair'
-    _immutable_fields_ = ['car', 'cdr']
+    _immutable_fields_ = ['car', '_cdr?']
     simple = False
-    def __init__(self, car, cdr, source_pos=None):
+    def __init__(self, car, cdr, source_pos=NO_SOURCE_POS):
         assert isinstance(car, KernelValue), "non-KernelValue car: %s" % car
         assert isinstance(cdr, KernelValue), "non-KernelValue cdr: %s" % cdr
         self.car = car
-        self.cdr = cdr
+        self._cdr = cdr
         self.source_pos = source_pos
+    def _get_cdr(self):
+        return self.get_cdr()
+    cdr = property(_get_cdr)
+    def get_cdr(self):
+        return self._cdr
+    def append_items(self, items):
+        """Append the elements we hold to the Python list `items`, and return
+        the rest of the list."""
+        items.append(self.car)
+        return self._cdr
     def tostring(self):
-        s = rstring.StringBuilder()
-        s.append("(")
-        pair = self
-        while True:
-            assert isinstance(pair, Pair), "not a pair: %s" % pair
-            s.append(pair.car.tostring())
-            if isinstance(pair.cdr, Pair):
-                pair = pair.cdr
-                s.append(" ")
-            else:
-                if not is_nil(pair.cdr):
-                    s.append(" . ")
-                    s.append(pair.cdr.tostring())
-                break
-        s.append(")")
-        return s.build()
+        port = StringOutputPort()
+        write_value(self, port)
+        return port.getvalue()
     def interpret(self, env, cont):
-        if cont.source_pos is None:
+        if cont.source_pos == NO_SOURCE_POS:
             cont.source_pos = self.source_pos
         return self.car, env, CombineCont(self.cdr,
                                           env,
                                           cont,
                                           source_pos=self.car.source_pos)
     def equal(self, other):
-        return (isinstance(other, Pair)
-                and self.car.equal(other.car)
-                and self.cdr.equal(other.cdr))
+        # Walk the cdr spine in a loop and keep nested cars in an explicit
+        # stack, so we don't use native stack proportional to the data.
+        pending = [(self, other)]
+        while pending:
+            a, b = pending.pop()
+            while isinstance(a, Pair):
+                if not isinstance(b, Pair):
+                    return False
+                if isinstance(a.car, Pair):
+                    pending.append((a.car, b.car))
+                elif not a.car.equal(b.car):
+                    return False
+                a = a.cdr
+                b = b.cdr
+            if not a.equal(b):
+                return False
+        return True
+
+class Pair2(Pair):
+    """Two-element proper list in a single object.  These have no source
+    positions; they're for lists we build, like argument lists."""
+    _immutable_fields_ = ['second']
+    def __init__(self, first, second):
+        self.car = first
+        self._cdr = None
+        self.second = second
+        self.source_pos = NO_SOURCE_POS
+    def get_cdr(self):
+        if self._cdr is None:
+            self._cdr = Pair(self.second, nil)
+        return self._cdr
+    def append_items(self, items):
+        items.append(self.car)
+        items.append(self.second)
+        return nil
+
+class Pair3(Pair):
+    """Three-element proper list in a single object, like Pair2."""
+    _immutable_fields_ = ['second', 'third']
+    def __init__(self, first, second, third):
+        self.car = first
+        self._cdr = None
+        self.second = second
+        self.third = third
+        self.source_pos = NO_SOURCE_POS
+    def get_cdr(self):
+        if self._cdr is None:
+            self._cdr = Pair2(self.second, self.third)
+        return self._cdr
+    def append_items(self, items):
+        items.append(self.car)
+        items.append(self.second)
+        items.append(self.third)
+        return nil
+
+def cons_list(first, rest):
+    """(cons first rest), for a `rest` nobody else sees, so short lists can
+    be made compact: we may copy the elements of `rest` instead of sharing
+    it."""
+    if isinstance(rest, Pair2):
+        return Pair3(first, rest.car, rest.second)
+    if (isinstance(rest, Pair) and not isinstance(rest, Pair3)
+            and is_nil(rest.cdr)):
+        return Pair2(first, rest.car)
+    return Pair(first, rest)
 
 class Combiner(KernelValue):
     type_name = 'combiner'
+    # Whether `combine` looks at its `env` argument at all.
+    uses_dynamic_env = True
     def combine(self, operands, env, cont):
         raise NotImplementedError
 
@@ -412,28 +717,64 @@ class Operative(Combiner):
     name = None
 
 class CompoundOperative(Operative):
-    def __init__(self, formals, eformal, exprs, static_env, source_pos=None, name=None):
+    def __init__(self, formals, eformal, exprs, static_env, source_pos=NO_SOURCE_POS,
+                 name=None, body=None, layout=None):
         self.formals = formals
         self.eformal = eformal
         self.exprs = exprs
         self.static_env = static_env
         self.source_pos = source_pos
         self.name = name
+        # Analyzed or compiled version of exprs (see analyze.py and vm.py), if
+        # we have it.
+        self.body = body
+        self.entry = BodyEntry(self)
+        self.layout = layout
     def combine(self, operands, env, cont):
-        eval_env = Environment([self.static_env])
+        eval_env = Frame(self.static_env, self.get_layout(), self.get_body())
         match_parameter_tree(self.formals, operands, eval_env)
         match_parameter_tree(self.eformal, env, eval_env)
-        return sequence(self.exprs, eval_env, cont)
+        return self.entry, eval_env, cont
+    def get_layout(self):
+        if self.layout is None:
+            self.layout = frame_layout(self.formals, self.eformal)
+        return self.layout
+    def get_body(self):
+        if self.body is None:
+            import analyze
+            import vm
+            if vm.is_enabled():
+                self.body = vm.compile_body(self.exprs,
+                                            Pair(self.formals, self.eformal))
+            elif analyze.is_enabled():
+                self.body = analyze.analyze_body(self.exprs)
+            else:
+                return self.exprs
+        return self.body
     def tostring(self):
         if self.name is None:
             return str(self)
         else:
             return "<operative '%s'>" % self.name
 
+class BodyEntry(KernelValue):
+    """Evaluating this starts evaluating the body of `operative`.
+
+    Operatives return these rather than going straight into their bodies so
+    `kernel_eval` can tell where loops may start (see the JIT driver there)."""
+    _immutable_fields_ = ['operative']
+    def __init__(self, operative):
+        self.operative = operative
+        self.source_pos = NO_SOURCE_POS
+    def interpret(self, env, cont):
+        return sequence(self.operative.get_body(), env, cont)
+    def tostring(self):
+        return "<body of %s>" % self.operative.tostring()
+
 class Primitive(Operative):
     def __init__(self, code, name):
         self.code = code
-        self.source_pos = None
+        self.source_pos = NO_SOURCE_POS
         self.name = name
     def combine(self, operands, env, cont):
         return self.code(operands, env, cont)
@@ -443,15 +784,17 @@ class Primitive(Operative):
 class SimplePrimitive(Operative):
     def __init__(self, code, name):
         self.code = code
-        self.source_pos = None
+        self.source_pos = NO_SOURCE_POS
         self.name = name
+    uses_dynamic_env = False
     def combine(self, operands, env, cont):
         return cont.plug_reduce(self.code(operands))
     def tostring(self):
         return "<primitive '%s'>" % self.name
 
 class ContWrapper(Operative):
-    def __init__(self, cont, source_pos=None):
+    uses_dynamic_env = False
+    def __init__(self, cont, source_pos=NO_SOURCE_POS):
         self.cont = cont
         self.source_pos = source_pos
         self.name = None
@@ -459,12 +802,14 @@ class ContWrapper(Operative):
         return abnormally_pass(operands, cont, self.cont)
 
 def abnormally_pass(operands, src_cont, dst_cont):
-    dst_cont.mark(True)
-    exiting = select_interceptors(src_cont, InnerGuardCont)
-    dst_cont.mark(False)
-    src_cont.mark(True)
-    entering = select_interceptors(dst_cont, OuterGuardCont)
-    src_cont.mark(False)
+    # Continuations are shared between interpreters and threads, so rather
+    # than marking the chains in place we collect them into sets.
+    exiting = select_interceptors(src_cont,
+                                  InnerGuardCont,
+                                  cont_chain(dst_cont))
+    entering = select_interceptors(dst_cont,
+                                   OuterGuardCont,
+                                   cont_chain(src_cont))
     cont = dst_cont
     for outer, interceptor in entering:
         cont = InterceptCont(interceptor, cont, outer)
@@ -483,22 +828,94 @@ def pass_to_next(operands, cont):
     else:
         return cont.plug_reduce(operands)
 
-def select_interceptors(cont, cls):
+def cont_chain(cont):
+    """Set of `cont` and all its ancestors."""
+    chain = {}
+    while cont is not None:
+        chain[cont] = None
+        cont = cont.prev
+    return chain
+
+def select_interceptors(cont, cls, other_chain):
+    """Interceptors of the guards of class `cls` between `cont` and the
+    first ancestor it shares with the other continuation, whose chain is
+    `other_chain`.  Only guards whose selector is in that chain apply."""
     ls = []
-    while cont is not None and not cont.marked:
+    while cont is not None and cont not in other_chain:
         if isinstance(cont, cls):
             for guard in iter_list(cont.guards):
                 selector, interceptor = pythonify_list(guard)
-                if selector.marked:
+                if selector in other_chain:
                     outer_cont = cont if isinstance(cont, OuterGuardCont) else cont.prev
                     ls.append((outer_cont, interceptor))
                     break
         cont = cont.prev
     return ls
 
+class Lambda(CompoundOperative):
+    """Compound operative that ignores its dynamic environment, like the ones
+    made by `$lambda` or by `$vau` with #ignore as environment parameter.
+
+    We don't keep the caller's environment around to call these (see
+    ApplyCont).  If the parameter tree is a flat list of distinct symbols,
+    callers that have the arguments at hand can bind them straight into a
+    frame with `bind_arguments`, without consing an argument list."""
+    uses_dynamic_env = False
+    def __init__(self, formals, exprs, static_env, source_pos=NO_SOURCE_POS,
+                 name=None, body=None, layout=None):
+        CompoundOperative.__init__(self, formals, ignore, exprs, static_env,
+                                   source_pos, name, body, layout)
+        self.arity = flat_arity(formals)
+    def combine(self, operands, env, cont):
+        if ((isinstance(operands, Pair2) or isinstance(operands, Pair3))
+                and self.arity != -1):
+            # Don't make pairs for the rest of a compact argument list just
+            # to walk it.
+            args = pythonify_list(operands)
+            if len(args) == self.arity:
+                return self.entry, self.bind_arguments(args), cont
+        eval_env = Frame(self.static_env, self.get_layout(), self.get_body())
+        match_parameter_tree(self.formals, operands, eval_env)
+        return self.entry, eval_env, cont
+    def bind_arguments(self, args):
+        """Frame for a call with the given Python list of arguments, which
+        must have `self.arity` elements."""
+        assert len(args) == self.arity
+        frame = Frame(self.static_env, self.get_layout(), self.get_body())
+        param = self.formals
+        # The symbols in a flat parameter list take the slots in order.
+        for i in range(len(args)):
+            assert isinstance(param, Pair)
+            name_operative(param.car, args[i])
+            frame.values[i] = args[i]
+            param = param.cdr
+        return frame
+
+def flat_arity(formals):
+    """Number of parameters if `formals` is a proper list of distinct symbols,
+    otherwise -1."""
+    seen = {}
+    while isinstance(formals, Pair):
+        param = formals.car
+        if not isinstance(param, Symbol) or param.symval in seen:
+            return -1
+        seen[param.symval] = None
+        formals = formals.cdr
+    if not is_nil(formals):
+        return -1
+    return len(seen)
+
+def make_compound_operative(formals, eformal, exprs, static_env, body=None,
+                            layout=None):
+    if is_ignore(eformal):
+        return Lambda(formals, exprs, static_env, body=body, layout=layout)
+    else:
+        return CompoundOperative(formals, eformal, exprs, static_env,
+                                 body=body, layout=layout)
+
 class Applicative(Combiner):
     type_name = 'applicative'
-    def __init__(self, combiner, source_pos=None):
+    def __init__(self, combiner, source_pos=NO_SOURCE_POS):
         assert isinstance(combiner, Combiner), "wrong type to wrap: %s" % combiner
         self.wrapped_combiner = combiner
         self.source_pos = source_pos
@@ -515,7 +932,7 @@ class Applicative(Combiner):
 
 class Environment(KernelValue):
     type_name = 'environment'
-    def __init__(self, parents, bindings=None, source_pos=None):
+    def __init__(self, parents, bindings=None, source_pos=NO_SOURCE_POS):
         for each in parents:
             check_type(each, Environment)
             assert isinstance(each, Environment)
@@ -525,6 +942,11 @@ class Environment(KernelValue):
     def set(self, symbol, value):
         assert isinstance(symbol, Symbol), "setting non-symbol: %s" % symbol
         self.bindings[symbol.symval] = value
+    def get_local(self, symval):
+        """Value bound to `symval` in this very environment, or None."""
+        return self.bindings.get(symval, None)
+    def local_bindings(self):
+        return self.bindings.items()
     def lookup(self, symbol):
         ret = self.lookup_unchecked(symbol)
         if ret is None:
@@ -533,17 +955,114 @@ class Environment(KernelValue):
             return ret
     def lookup_unchecked(self, symbol):
         assert isinstance(symbol, Symbol), "looking up non-symbol: %s" % symbol
-        ret = self.bindings.get(symbol.symval, None)
-        if ret is not None:
-            return ret
-        for parent in self.parents:
-            ret = parent.lookup_unchecked(symbol)
+        # Depth-first search of the parent graph, in order.  Single parents
+        # (the common case) are followed in a loop; siblings of multiple
+        # parents wait in an explicit stack.
+        env = self
+        pending = None
+        while True:
+            ret = env.get_local(symbol.symval)
             if ret is not None:
                 return ret
+            if len(env.parents) == 1:
+                env = env.parents[0]
+            else:
+                if pending is None:
+                    pending = []
+                env = next_env(env, pending)
+                if env is None:
+                    return None
+
+class FrameLayout(object):
+    """Slot assignment for the symbols in the parameter trees of an operative.
+    Shared by all the frames created for calls to it."""
+    _immutable_fields_ = ['indices', 'symvals[*]']
+    def __init__(self, symvals):
+        self.symvals = symvals
+        self.indices = {}
+        for i, symval in enumerate(symvals):
+            self.indices[symval] = i
+    @jit.elidable
+    def index(self, symval):
+        return self.indices.get(symval, -1)
+
+def frame_layout(formals, eformal):
+    symvals = []
+    seen = {}
+    pending = [eformal, formals]
+    while pending:
+        tree = pending.pop()
+        if isinstance(tree, Symbol):
+            if tree.symval not in seen:
+                seen[tree.symval] = None
+                symvals.append(tree.symval)
+        elif isinstance(tree, Pair):
+            pending.append(tree.cdr)
+            pending.append(tree.car)
+    return FrameLayout(symvals[:])
+
+class Frame(Environment):
+    """Local environment for a call to a compound operative.
+
+    The parameters live in an array of slots laid out by the operative's
+    FrameLayout.  A dictionary is only created if something else gets defined
+    here (e.g., by `$define!` in the body or `eval` in a reified
+    environment), so most calls don't allocate one.
+
+    `body` is the body of the operative (as returned by `get_body`) that the
+    frame is for.  Whatever is evaluated in the frame is part of that body,
+    so the JIT driver in primitive.py tells traces apart by it."""
+    _immutable_fields_ = ['body']
+    def __init__(self, parent, layout, body=None):
+        self.parents = [parent]
+        self.bindings = None
+        self.source_pos = NO_SOURCE_POS
+        self.layout = layout
+        self.values = [None] * len(layout.symvals)
+        self.body = body
+    def set(self, symbol, value):
+        assert isinstance(symbol, Symbol), "setting non-symbol: %s" % symbol
+        index = jit.promote(self.layout).index(symbol.symval)
+        if index != -1:
+            self.values[index] = value
+        else:
+            if self.bindings is None:
+                self.bindings = {}
+            self.bindings[symbol.symval] = value
+    def get_local(self, symval):
+        index = jit.promote(self.layout).index(symval)
+        if index != -1:
+            return self.values[index]
+        if self.bindings is None:
+            return None
+        return self.bindings.get(symval, None)
+    def local_bindings(self):
+        ret = []
+        for i, symval in enumerate(self.layout.symvals):
+            if self.values[i] is not None:
+                ret.append((symval, self.values[i]))
+        if self.bindings is not None:
+            ret.extend(self.bindings.items())
+        return ret
+
+def next_env(env, pending):
+    """Next environment to visit in a depth-first search of the ancestors of
+    `env`, or None when the search is over.  `pending` holds the ancestors that
+    have yet to be visited; it's updated in place."""
+    parents = env.parents
+    i = len(parents) - 1
+    while i > 0:
+        pending.append(parents[i])
+        i -= 1
+    if parents:
+        return parents[0]
+    elif pending:
+        return pending.pop()
+    else:
         return None
 
 class EncapsulationType(KernelValue):
-    def create_methods(self, source_pos=None):
+    def create_methods(self, source_pos=NO_SOURCE_POS):
         constructor = Applicative(EncapsulationConstructor(self, source_pos))
         predicate = Applicative(EncapsulationPredicate(self, source_pos))
         accessor = Applicative(EncapsulationAccessor(self, source_pos))
@@ -552,13 +1071,13 @@ class EncapsulationType(KernelValue):
 class EncapsulatedObject(KernelValue):
     # Abusing terminology; this is actually a union of types.
     type_name = 'encapsulated-object'
-    def __init__(self, val, encapsulation_type, source_pos=None):
+    def __init__(self, val, encapsulation_type, source_pos=NO_SOURCE_POS):
         self.val = val
         self.encapsulation_type = encapsulation_type
         self.source_pos = source_pos
 
 class EncapsulationMethod(Operative):
-    def __init__(self, encapsulation_type, source_pos=None):
+    def __init__(self, encapsulation_type, source_pos=NO_SOURCE_POS):
         self.encapsulation_type = encapsulation_type
         self.source_pos = source_pos
         self.name = None
@@ -602,7 +1121,7 @@ class PromiseData(object):
 
 class Promise(KernelValue):
     type_name = 'promise'
-    def __init__(self, val, env, source_pos=None):
+    def __init__(self, val, env, source_pos=NO_SOURCE_POS):
         self.data = PromiseData(val, env)
         self.source_pos = source_pos
     def force(self, cont):
@@ -621,18 +1140,24 @@ class KeyedDynamicBinder(Operative):
                              KeyedDynamicCont(self, value, cont))
 
 class KeyedDynamicAccessor(Operative):
-    def __init__(self, binder, source_pos=None):
+    def __init__(self, binder, source_pos=NO_SOURCE_POS):
         self.binder = binder
         self.source_pos = source_pos
     def combine(self, operands, env, cont):
         pythonify_list(operands, 0)
-        prev = cont
-        while prev is not None:
-            if (isinstance(prev, KeyedDynamicCont)
-                and prev.binder is self.binder):
-                return cont.plug_reduce(prev.value)
-            prev = prev.prev
-        signal_unbound_dynamic_key(self)
+        ret = find_dynamic_binding(self.binder, cont)
+        if ret is None:
+            signal_unbound_dynamic_key(self)
+        else:
+            return cont.plug_reduce(ret)
+
+def find_dynamic_binding(binder, cont):
+    while cont is not None:
+        if (isinstance(cont, KeyedDynamicCont)
+            and cont.binder is binder):
+            return cont.value
+        cont = cont.prev
+    return None
 
 class KeyedStaticBinder(Operative):
     def combine(self, operands, env, cont):
@@ -642,13 +1167,13 @@ class KeyedStaticBinder(Operative):
         return cont.plug_reduce(KeyedEnvironment(self, value, env))
 
 class KeyedEnvironment(Environment):
-    def __init__(self, binder, value, parent, source_pos=None):
+    def __init__(self, binder, value, parent, source_pos=NO_SOURCE_POS):
         Environment.__init__(self, [parent], {}, source_pos)
         self.binder = binder
         self.value = value
 
 class KeyedStaticAccessor(Operative):
-    def __init__(self, binder, source_pos=None):
+    def __init__(self, binder, source_pos=NO_SOURCE_POS):
         self.binder = binder
         self.source_pos = source_pos
     def combine(self, operands, env, cont):
@@ -659,47 +1184,498 @@ class KeyedStaticAccessor(Operative):
         else:
             return cont.plug_reduce(ret)
     def find_binding(self, env):
-        if (isinstance(env, KeyedEnvironment)
-            and env.binder is self.binder):
-            return env.value
-        for parent in env.parents:
-            ret = self.find_binding(parent)
-            if ret is not None:
-                return ret
+        pending = None
+        while env is not None:
+            if (isinstance(env, KeyedEnvironment)
+                and env.binder is self.binder):
+                return env.value
+            if len(env.parents) == 1:
+                env = env.parents[0]
+            else:
+                if pending is None:
+                    pending = []
+                env = next_env(env, pending)
         return None
 
+class Port(KernelValue):
+    type_name = 'port'
+    def close(self):
+        self.closed = True
+    def check_open(self):
+        if self.closed:
+            signal_io_error("Port is closed", Pair(self, nil))
+
+class OutputPort(Port):
+    type_name = 'output-port'
+    def write(self, s):
+        raise NotImplementedError
+    def flush(self):
+        pass
+    def flush_ready(self):
+        """Like `flush`, but raise WouldBlock instead of blocking."""
+        self.flush()
+
+class FileOutputPort(OutputPort):
+    """Output port writing to a file descriptor.
+
+    Output is accumulated in a buffer and written out in a single system call
+    when the buffer fills up, on explicit flushes, and (if `line_buffered`) at
+    the end of each line."""
+    def __init__(self, fd, line_buffered=False, buffer_size=65536,
+                 source_pos=NO_SOURCE_POS):
+        self.fd = fd
+        self.line_buffered = line_buffered
+        self.buffer_size = buffer_size
+        self.buf = rstring.StringBuilder(buffer_size)
+        self.closed = False
+        self.source_pos = source_pos
+    def write(self, s):
+        self.check_open()
+        self.buf.append(s)
+        if (self.buf.getlength() >= self.buffer_size
+            or (self.line_buffered and s.find("\n") != -1)):
+            self.flush()
+    def flush(self):
+        if self.buf.getlength() == 0:
+            return
+        data = self.buf.build()
+        self.buf = rstring.StringBuilder(self.buffer_size)
+        while data:
+            written = os.write(self.fd, data)
+            data = data[written:]
+    def flush_ready(self):
+        """Write what we can without blocking, and raise WouldBlock if there
+        is more, which is kept in the buffer."""
+        self.check_open()
+        data = self.buf.build()
+        self.buf = rstring.StringBuilder(self.buffer_size)
+        while data:
+            if not fd_ready(self.fd, rpoll.POLLOUT):
+                self.buf.append(data)
+                raise WouldBlock(self.fd, rpoll.POLLOUT)
+            # Being writable only promises room for PIPE_BUF bytes.
+            written = os.write(self.fd, data[:4096])
+            data = data[written:]
+    def close(self):
+        if not self.closed:
+            self.flush()
+            os.close(self.fd)
+            self.closed = True
+
+class StringOutputPort(OutputPort):
+    def __init__(self, source_pos=NO_SOURCE_POS):
+        self.buf = rstring.StringBuilder()
+        self.closed = False
+        self.source_pos = source_pos
+    def write(self, s):
+        self.buf.append(s)
+    def getvalue(self):
+        return self.buf.build()
+
+class InputPort(Port):
+    """Input ports deliver characters through `peek_char` and `read_char`,
+    which return the empty string at end of file.
+
+    They also know how to delimit the source text of the next datum, so the
+    reader can parse data one at a time."""
+    type_name = 'input-port'
+    path = '<input port>'
+    # Offset where the latest datum read starts, for ports that keep track.
+    datum_start = 0
+    def peek_char(self):
+        raise NotImplementedError
+    def read_char(self):
+        raise NotImplementedError
+    def begin_read(self):
+        """Start an operation that may raise WouldBlock, in which case the
+        caller must `rewind` to where the operation started and retry it
+        later.  Either way it must call `end_read` when it's done."""
+        pass
+    def rewind(self):
+        pass
+    def end_read(self):
+        pass
+    def read_line(self):
+        """Return the next line, without the line terminator, or None at end
+        of file."""
+        c = self.read_char()
+        if c == '':
+            return None
+        s = rstring.StringBuilder()
+        while c != '' and c != '\n':
+            s.append(c)
+            c = self.read_char()
+        return s.build()
+    def read_datum_source(self):
+        """Return the source text of the next datum, or None if only
+        whitespace and comments are left.
+
+        We only find where the datum ends; checking that it's well formed is
+        left to the parser."""
+        c = self.skip_to_datum()
+        if c == '':
+            return None
+        s = rstring.StringBuilder()
+        self.scan_datum(c, s)
+        return s.build()
+    def skip_to_datum(self):
+        """Skip whitespace, comments and datum comments.  Consume and return
+        the first character of the next datum, or return '' at end of
+        file."""
+        while True:
+            self.skip_atmosphere()
+            c = self.read_char()
+            if c == '#' and self.peek_char() == ';':
+                self.read_char()
+                c = self.skip_to_datum()
+                if c == '':
+                    return ''
+                self.scan_datum(c, None)
+            else:
+                return c
+    def scan_datum(self, c, s):
+        """Scan the rest of the datum that starts with `c`, appending its
+        source to `s` unless that's None."""
+        depth = 0
+        prev = ''
+        while True:
+            if s is not None:
+                s.append(c)
+            if c == '"':
+                self.scan_string(s)
+            elif c == ';' and prev != '#':
+                # The ';' of a '#;' datum comment doesn't start a comment;
+                # the datum it comments out is scanned like any other.
+                self.scan_comment(s)
+            elif c == '(':
+                depth += 1
+            elif c == ')':
+                depth -= 1
+            elif depth == 0:
+                self.scan_atom(s)
+            if depth <= 0:
+                return
+            prev = c
+            c = self.read_char()
+            if c == '':
+                # Premature EOF; let the parser complain about it.
+                return
+    def skip_atmosphere(self):
+        while True:
+            c = self.peek_char()
+            if is_whitespace(c):
+                self.read_char()
+            elif c == ';':
+                self.scan_comment(None)
+            else:
+                return
+    def scan_string(self, s):
+        while True:
+            c = self.read_char()
+            if c == '':
+                return
+            if s is not None:
+                s.append(c)
+            if c == '"':
+                return
+            elif c == '\\':
+                c = self.read_char()
+                if c == '':
+                    return
+                if s is not None:
+                    s.append(c)
+    def scan_comment(self, s):
+        while True:
+            c = self.read_char()
+            if c == '' or c == '\n':
+                break
+            if s is not None:
+                s.append(c)
+        if s is not None:
+            # The grammar wants comments to end in a newline.
+            s.append('\n')
+    def scan_atom(self, s):
+        while True:
+            c = self.peek_char()
+            if (c == '' or is_whitespace(c) or c == '(' or c == ')'
+                or c == '"' or c == ';'):
+                return
+            self.read_char()
+            if s is not None:
+                s.append(c)
+
+def is_whitespace(c):
+    return c == ' ' or c == '\n' or c == '\t' or c == '\r'
+
+class FileInputPort(InputPort):
+    """Input port reading from a file descriptor, a buffer at a time.
+
+    Inside `begin_read` and `end_read` we don't block: if we run out of
+    buffered data and the file descriptor has nothing to read we raise
+    WouldBlock, and we keep the data read since `begin_read` so the operation
+    can be rewound."""
+    def __init__(self, fd, path, buffer_size=65536, source_pos=NO_SOURCE_POS):
+        self.fd = fd
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buf = ''
+        self.pos = 0
+        # Where the current operation started in `buf`, or -1 if we aren't in
+        # one.
+        self.start = -1
+        self.closed = False
+        self.source_pos = source_pos
+    def begin_read(self):
+        self.start = self.pos
+    def rewind(self):
+        if self.start >= 0:
+            self.pos = self.start
+    def end_read(self):
+        self.start = -1
+    def fill(self):
+        self.check_open()
+        start = self.start
+        if start < 0:
+            self.buf = os.read(self.fd, self.buffer_size)
+            self.pos = 0
+            return len(self.buf) > 0
+        if not fd_ready(self.fd, rpoll.POLLIN):
+            raise WouldBlock(self.fd, rpoll.POLLIN)
+        data = os.read(self.fd, self.buffer_size)
+        self.buf = self.buf[start:] + data
+        self.pos -= start
+        self.start = 0
+        return len(data) > 0
+    def peek_char(self):
+        if self.pos >= len(self.buf) and not self.fill():
+            return ''
+        return self.buf[self.pos]
+    def read_char(self):
+        c = self.peek_char()
+        if c != '':
+            self.pos += 1
+        return c
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+            self.buf = ''
+            self.pos = 0
+            self.closed = True
+
+class MappedInputPort(InputPort):
+    """Read-only input port on a memory-mapped file.
+
+    Characters are read straight from the mapping, and the source of each datum
+    is copied out in one slice, so we never hold a second copy of the whole
+    file in memory."""
+    def __init__(self, fd, path, source_pos=NO_SOURCE_POS):
+        self.path = path
+        self.size = os.fstat(fd).st_size
+        if self.size > 0:
+            self.map = rmmap.mmap(fd, self.size, access=rmmap.ACCESS_READ)
+        else:
+            self.map = None
+        # The mapping stays valid after the file is closed.
+        os.close(fd)
+        self.pos = 0
+        # Offset where the latest datum read starts.
+        self.datum_start = 0
+        self.closed = False
+        self.source_pos = source_pos
+    def peek_char(self):
+        self.check_open()
+        if self.pos >= self.size:
+            return ''
+        return self.map.getitem(self.pos)
+    def read_char(self):
+        c = self.peek_char()
+        if c != '':
+            self.pos += 1
+        return c
+    def read_line(self):
+        self.check_open()
+        if self.pos >= self.size:
+            return None
+        start = self.pos
+        end = start
+        while end < self.size and self.map.getitem(end) != '\n':
+            end += 1
+        self.pos = min(end + 1, self.size)
+        return self.map.getslice(start, end - start)
+    def read_datum_source(self):
+        c = self.skip_to_datum()
+        if c == '':
+            return None
+        self.datum_start = self.pos - 1
+        self.scan_datum(c, None)
+        return self.map.getslice(self.datum_start,
+                                 self.pos - self.datum_start)
+    def close(self):
+        if not self.closed:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            self.closed = True
+
+class StringInputPort(InputPort):
+    """Input port reading from a string."""
+    def __init__(self, s, path='<string>', source_pos=NO_SOURCE_POS):
+        self.s = s
+        self.path = path
+        self.pos = 0
+        # Offset where the latest datum read starts.
+        self.datum_start = 0
+        self.closed = False
+        self.source_pos = source_pos
+    def peek_char(self):
+        self.check_open()
+        if self.pos >= len(self.s):
+            return ''
+        return self.s[self.pos]
+    def read_char(self):
+        c = self.peek_char()
+        if c != '':
+            self.pos += 1
+        return c
+    def read_datum_source(self):
+        c = self.skip_to_datum()
+        if c == '':
+            return None
+        self.datum_start = self.pos - 1
+        self.scan_datum(c, None)
+        start = self.datum_start
+        stop = self.pos
+        assert start >= 0 and stop >= 0
+        return self.s[start:stop]
+
+class EofObject(KernelValue):
+    type_name = 'eof-object'
+    def tostring(self):
+        return '#[eof]'
+
+eof = EofObject()
+
+# Specialized by port type, so writing into a string (as for naming JIT
+# traces) doesn't look like it may do I/O.
+@specialize.argtype(1)
+def write_value(val, port, display=False, limit=-1):
+    """Stream the external representation of `val` into `port`.
+
+    The only state kept is a stack with the rest of each list we're in the
+    middle of, so memory use is proportional to the nesting depth of `val`,
+    not to its size.
+
+    If `display` is true and `val` is not a pair, write its display
+    representation instead (e.g., strings without quotes).
+
+    If `limit` isn't negative we stop once we've written that many
+    characters (the last write may take us past it), so a prefix of a big
+    value costs no more than the prefix."""
+    if display and not isinstance(val, Pair):
+        port.write(val.todisplay())
+        return
+    written = 0
+    pending = []
+    while True:
+        while isinstance(val, Pair):
+            port.write("(")
+            written += 1
+            if 0 <= limit <= written:
+                return
+            pending.append(val.cdr)
+            val = val.car
+        s = val.tostring()
+        port.write(s)
+        written += len(s)
+        while True:
+            if not pending or 0 <= limit <= written:
+                return
+            rest = pending.pop()
+            if isinstance(rest, Pair):
+                port.write(" ")
+                written += 1
+                pending.append(rest.cdr)
+                val = rest.car
+                break
+            elif not is_nil(rest):
+                s = rest.tostring()
+                port.write(" . ")
+                port.write(s)
+                written += 3 + len(s)
+            port.write(")")
+            written += 1
+
 class Continuation(KernelValue):
     type_name = 'continuation'
     _immutable_args_ = ['prev']
-    def __init__(self, prev, source_pos=None):
+    # The innermost continuation with a fuel budget (see threads.py) that
+    # this one extends, once `get_fuel_cont` has looked it up.
+    fuel_cont = None
+    fuel_cont_known = False
+    def __init__(self, prev, source_pos=NO_SOURCE_POS):
         self.prev = prev
-        self.marked = False
         self.source_pos = source_pos
+    def get_fuel_cont(self):
+        """The innermost continuation with a fuel budget that this one
+        extends, or None.  We only need it when a slice ends, so rather than
+        working it out for every continuation we make, we look it up then and
+        remember it along the way, so the next lookup stops where this one
+        started."""
+        if self.fuel_cont_known:
+            return self.fuel_cont
+        chain = []
+        cont = self
+        while cont is not None and not cont.fuel_cont_known:
+            chain.append(cont)
+            cont = cont.prev
+        if cont is None:
+            fuel_cont = None
+        else:
+            fuel_cont = cont.fuel_cont
+        for i in range(len(chain) - 1, -1, -1):
+            fuel_cont = chain[i].extend_fuel_cont(fuel_cont)
+            chain[i].fuel_cont = fuel_cont
+            chain[i].fuel_cont_known = True
+        return fuel_cont
+    def extend_fuel_cont(self, fuel_cont):
+        """Our fuel continuation, given that of our parent."""
+        return fuel_cont
     def plug_reduce(self, val):
         debug.on_plug_reduce(val, self)
         return self._plug_reduce(val)
     def _plug_reduce(self, val):
         return self.prev.plug_reduce(val)
-    def mark(self, boolean):
-        self.marked = boolean
-        if self.prev is not None:
-            self.prev.mark(boolean)
-
 class RootCont(Continuation):
     def __init__(self):
         Continuation.__init__(self, None)
-        self.source_pos = None
+        self.source_pos = NO_SOURCE_POS
     def _plug_reduce(self, val):
         raise KernelExit
 
 class BaseErrorCont(Continuation):
     def _plug_reduce(self, val):
+        import interpreter
+        stdout_port = interpreter.current().stdout_port
         if not isinstance(val, ErrorObject):
-            print "*** ERROR ***:",
-        print val.todisplay()
+            stdout_port.write("*** ERROR ***: ")
+        stdout_port.write(val.todisplay())
+        stdout_port.write("\n")
+        stdout_port.flush()
         return Continuation._plug_reduce(self, val)
 
 def evaluate_arguments(vals, env, cont):
+    # Simple operands (symbols and self-evaluating values) don't need a trip
+    # through the trampoline, nor continuations to wait for them.  Unless the
+    # debugger is stepping, which shows every evaluation.
+    count = count_simple_prefix(vals)
+    if count != 0 and not debug.is_stepping():
+        if count == -1:
+            # All of them are simple; build the argument list right away.
+            return cont.plug_reduce(evaluate_simple_list(vals, env))
+        for i in range(count):
+            assert isinstance(vals, Pair)
+            cont = GatherArgsCont(vals.car.interpret_simple(env), cont)
+            vals = vals.cdr
     if is_nil(vals):
         return cont.plug_reduce(nil)
     elif isinstance(vals, Pair):
@@ -712,6 +1688,47 @@ def evaluate_arguments(vals, env, cont):
         # cdr.
         signal_combine_with_non_list_operands(Pair(vals, nil))
 
+def count_simple_prefix(vals):
+    """Number of simple values at the start of `vals`, or -1 if it's a proper
+    list of simple values."""
+    count = 0
+    while isinstance(vals, Pair):
+        if not vals.car.simple:
+            return count
+        count += 1
+        vals = vals.cdr
+    if is_nil(vals):
+        return -1
+    return count
+
+def evaluate_simple_list(vals, env):
+    """The values of the simple operands in the proper list `vals`.
+
+    Most combinations have three operands or fewer; we build their argument
+    lists directly, in order, as a single compact list object."""
+    if is_nil(vals):
+        return nil
+    assert isinstance(vals, Pair)
+    first = vals.car.interpret_simple(env)
+    vals = vals.cdr
+    if is_nil(vals):
+        return Pair(first, nil)
+    assert isinstance(vals, Pair)
+    second = vals.car.interpret_simple(env)
+    vals = vals.cdr
+    if is_nil(vals):
+        return Pair2(first, second)
+    assert isinstance(vals, Pair)
+    third = vals.car.interpret_simple(env)
+    vals = vals.cdr
+    if is_nil(vals):
+        return Pair3(first, second, third)
+    evaluated = [first, second, third]
+    while isinstance(vals, Pair):
+        evaluated.append(vals.car.interpret_simple(env))
+        vals = vals.cdr
+    return kernelify_list(evaluated)
+
 # XXX: DRY
 def s_andp(vals, env, cont):
     if is_nil(vals):
@@ -724,7 +1741,7 @@ def s_andp(vals, env, cont):
         signal_value_error("$and? with non-list arguments", Pair(vals, nil))
 
 class AndCont(Continuation):
-    def __init__(self, exprs, env, prev, source_pos=None):
+    def __init__(self, exprs, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.exprs = exprs
         self.env = env
@@ -747,7 +1764,7 @@ def s_orp(vals, env, cont):
         signal_value_error("$or? with non-list arguments", Pair(vals, nil))
 
 class OrCont(Continuation):
-    def __init__(self, exprs, env, prev, source_pos=None):
+    def __init__(self, exprs, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.exprs = exprs
         self.env = env
@@ -778,12 +1795,12 @@ def map_(combiner, transposed_lists, index, env, cont):
                                         cont))
 
 class MapCont(Continuation):
-    def __init__(self, combiner, lists, index, env, prev, source_pos=None):
+    def __init__(self, combiner, lists, index, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.combiner = combiner
         self.lists = lists
         self.index = index
-        self.env = env
+        self.env = env_for(combiner, env)
     def _plug_reduce(self, val):
         return map_(self.combiner,
                     self.lists,
@@ -792,7 +1809,7 @@ class MapCont(Continuation):
                     GatherArgsCont(val, self.prev))
 
 class EvalArgsCont(Continuation):
-    def __init__(self, exprs, env, prev, source_pos=None):
+    def __init__(self, exprs, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.exprs = exprs
         self.env = env
@@ -806,24 +1823,35 @@ class NoMoreArgsCont(Continuation):
         return self.prev.plug_reduce(Pair(val, nil))
 
 class GatherArgsCont(Continuation):
-    def __init__(self, val, prev, source_pos=None):
+    def __init__(self, val, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.val = val
         self.source_pos = source_pos
     def _plug_reduce(self, val):
-        return self.prev.plug_reduce(Pair(self.val, val))
+        return self.prev.plug_reduce(cons_list(self.val, val))
+
+def env_for(combiner, env):
+    """The dynamic environment to keep for a later call to `combiner`.
+
+    Continuations should only hold what they'll need when they're plugged, so
+    we don't keep environments (and everything bound in them) alive for
+    combiners that never look at them."""
+    if combiner.uses_dynamic_env:
+        return env
+    else:
+        return None
 
 class ApplyCont(Continuation):
-    def __init__(self, combiner, env, prev, source_pos=None):
+    def __init__(self, combiner, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.combiner = combiner
-        self.env = env
+        self.env = env_for(combiner, env)
         self.source_pos = source_pos
     def _plug_reduce(self, args):
         return self.combiner.combine(args, self.env, self.prev)
 
 class CombineCont(Continuation):
-    def __init__(self, operands, env, prev, source_pos=None):
+    def __init__(self, operands, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.operands = operands
         self.env = env
@@ -832,14 +1860,14 @@ class CombineCont(Continuation):
         return val.combine(self.operands, self.env, self.prev)
 
 class GuardCont(Continuation):
-    def __init__(self, guards, env, prev, source_pos=None):
+    def __init__(self, guards, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.guards = guards
         self.env = env
         self.source_pos = source_pos
 
 class SequenceCont(Continuation):
-    def __init__(self, exprs, env, prev, source_pos=None):
+    def __init__(self, exprs, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.exprs = exprs
         self.env = env
@@ -879,11 +1907,10 @@ class IfCont(Continuation):
             signal_type_error(Boolean, val)
 
 class CondCont(Continuation):
-    def __init__(self, clauses, env, prev, source_pos=None):
+    def __init__(self, clauses, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.clauses = clauses
         self.env = env
-        self.prev = prev
         self.source_pos = source_pos
     def _plug_reduce(self, val):
         if is_true(val):
@@ -897,7 +1924,7 @@ def cond(vals, env, cont):
     return caar(vals), env, CondCont(vals, env, cont)
 
 class DefineCont(Continuation):
-    def __init__(self, definiend, env, prev, source_pos=None):
+    def __init__(self, definiend, env, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev)
         self.definiend = definiend
         self.env = env
@@ -907,25 +1934,50 @@ class DefineCont(Continuation):
         return self.prev.plug_reduce(inert)
 
 def match_parameter_tree(param_tree, operand_tree, env):
-    if isinstance(param_tree, Symbol):
-        op = operand_tree
-        while isinstance(op, Applicative):
-            op = op.wrapped_combiner
-        if isinstance(op, Operative) and op.name is None:
-            op.name = param_tree.symval
-        env.set(param_tree, operand_tree)
-    elif is_ignore(param_tree):
+    # We walk the cdr spine of the parameter tree in a loop.  Sub-trees in car
+    # position wait in `pending` (only allocated if needed) until we're done
+    # with the spine.
+    pending = None
+    while True:
+        if isinstance(param_tree, Pair):
+            if not isinstance(operand_tree, Pair):
+                # XXX: this only shows the tail of the mismatch
+                signal_operand_mismatch(param_tree, operand_tree)
+            assert isinstance(operand_tree, Pair)
+            if isinstance(param_tree.car, Pair):
+                if pending is None:
+                    pending = []
+                pending.append((param_tree.car, operand_tree.car))
+            else:
+                match_parameter_leaf(param_tree.car, operand_tree.car, env)
+            param_tree = param_tree.cdr
+            operand_tree = operand_tree.cdr
+        else:
+            match_parameter_leaf(param_tree, operand_tree, env)
+            if pending is None or len(pending) == 0:
+                return
+            param_tree, operand_tree = pending.pop()
+
+def match_parameter_leaf(param, operand, env):
+    if isinstance(param, Symbol):
+        name_operative(param, operand)
+        env.set(param, operand)
+    elif is_ignore(param):
         pass
-    elif is_nil(param_tree):
-        if not is_nil(operand_tree):
+    elif is_nil(param):
+        if not is_nil(operand):
             # XXX: this only shows the tail of the mismatch
-            signal_operand_mismatch(param_tree, operand_tree)
-    elif isinstance(param_tree, Pair):
-        if not isinstance(operand_tree, Pair):
-            # XXX: this only shows the tail of the mismatch
-            signal_operand_mismatch(param_tree, operand_tree)
-        match_parameter_tree(param_tree.car, operand_tree.car, env)
-        match_parameter_tree(param_tree.cdr, operand_tree.cdr, env)
+            signal_operand_mismatch(param, operand)
+
+def name_operative(param, operand):
+    # Give anonymous combiners the name of the first symbol they're bound to,
+    # for error messages and the debugger.
+    assert isinstance(param, Symbol)
+    op = operand
+    while isinstance(op, Applicative):
+        op = op.wrapped_combiner
+    if isinstance(op, Operative) and op.name is None:
+        op.name = param.symval
 
 class InnerGuardCont(GuardCont):
     pass
@@ -934,7 +1986,7 @@ class OuterGuardCont(GuardCont):
     pass
 
 class InterceptCont(Continuation):
-    def __init__(self, interceptor, next_cont, outer_cont, source_pos=None):
+    def __init__(self, interceptor, next_cont, outer_cont, source_pos=NO_SOURCE_POS):
         # The outer continuation is the parent of this one for the purposes of
         # abnormal passes, but normal return from this continuation goes to the
         # next interceptor (or to the destination, if this is the last one)
@@ -947,17 +1999,17 @@ class InterceptCont(Continuation):
         return pass_to_next(val, self.next_cont)
 
 class ExtendCont(Continuation):
-    def __init__(self, receiver, env, cont_to_extend, source_pos=None):
+    def __init__(self, receiver, env, cont_to_extend, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, cont_to_extend)
         assert isinstance(receiver, Applicative), "non-applicative receiver: %s" % receiver
         self.receiver = receiver.wrapped_combiner
-        self.env = env
+        self.env = env_for(self.receiver, env)
         self.source_pos = source_pos
     def _plug_reduce(self, val):
         return self.receiver.combine(val, self.env, self.prev)
 
 class HandlePromiseResultCont(Continuation):
-    def __init__(self, promise, prev, source_pos=None):
+    def __init__(self, promise, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.promise = promise
     def plug_reduce(self, val):
@@ -972,7 +2024,7 @@ class HandlePromiseResultCont(Continuation):
             return self.prev.plug_reduce(val)
 
 class KeyedDynamicCont(Continuation):
-    def __init__(self, binder, value, prev, source_pos=None):
+    def __init__(self, binder, value, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.binder = binder
         self.value = value
@@ -990,8 +2042,17 @@ class ConstantCont(Continuation):
     def _plug_reduce(self, val):
         return self.prev.plug_reduce(self.val)
 
+class ClosePortCont(Continuation):
+    """Close the given port, then pass on the value I receive."""
+    def __init__(self, port, prev):
+        Continuation.__init__(self, prev)
+        self.port = port
+    def _plug_reduce(self, val):
+        self.port.close()
+        return self.prev.plug_reduce(val)
+
 class BindsCont(Continuation):
-    def __init__(self, pyvals, prev, source_pos=None):
+    def __init__(self, pyvals, prev, source_pos=NO_SOURCE_POS):
         Continuation.__init__(self, prev, source_pos)
         self.pyvals = pyvals
     def _plug_reduce(self, env):
@@ -1025,6 +2086,7 @@ error_cont = BaseErrorCont(debug_error_cont)
 system_error_cont = Continuation(error_cont)
 user_error_cont = Continuation(error_cont)
 file_not_found_cont = Continuation(user_error_cont)
+io_error_cont = Continuation(user_error_cont)
 parse_error_cont = Continuation(user_error_cont)
 type_error_cont = Continuation(user_error_cont)
 value_error_cont = Continuation(user_error_cont)
@@ -1040,6 +2102,34 @@ add_positive_to_negative_infinity_cont = Continuation(arithmetic_error_cont)
 multiply_infinity_by_zero_cont = Continuation(arithmetic_error_cont)
 divide_infinity_cont = Continuation(arithmetic_error_cont)
 divide_by_zero_cont = Continuation(arithmetic_error_cont)
+deadlock_cont = Continuation(user_error_cont)
+# Not a user error, so handlers for those don't keep runaway code going.
+fuel_exhausted_cont = Continuation(error_cont)
+
+# The error continuations above, in a fixed order, so errors can be referred
+# to by position when they cross process boundaries.
+standard_error_conts = [error_cont,
+                        system_error_cont,
+                        user_error_cont,
+                        file_not_found_cont,
+                        io_error_cont,
+                        parse_error_cont,
+                        type_error_cont,
+                        value_error_cont,
+                        combine_with_non_list_operands_cont,
+                        encapsulation_type_error_cont,
+                        operand_mismatch_cont,
+                        arity_mismatch_cont,
+                        symbol_not_found_cont,
+                        unbound_dynamic_key_cont,
+                        unbound_static_key_cont,
+                        arithmetic_error_cont,
+                        add_positive_to_negative_infinity_cont,
+                        multiply_infinity_by_zero_cont,
+                        divide_infinity_cont,
+                        divide_by_zero_cont,
+                        deadlock_cont,
+                        fuel_exhausted_cont]
 
 class ErrorObject(KernelValue):
     type_name = 'error-object'
@@ -1065,6 +2155,9 @@ def signal_file_not_found(filename):
            ("file '%s' not found" % filename),
            Pair(String(filename), nil))
 
+def signal_io_error(msg, irritants):
+    raise_(io_error_cont, msg, irritants)
+
 def signal_parse_error(error_string, source_filename):
     raise_(parse_error_cont,
            error_string,
@@ -1146,10 +2239,28 @@ def signal_divide_by_zero(dividend, zero):
            "Tried to divide by zero",
            Pair(dividend, Pair(zero, nil)))
 
+def signal_deadlock():
+    raise_(deadlock_cont, "All threads are blocked", nil)
+
 # Not actual kernel type.
 class KernelExit(Exception):
     pass
 
+# Not actual kernel type.
+class WouldBlock(Exception):
+    """A port operation would have to wait for `fd` to be ready for `events`
+    (POLLIN or POLLOUT)."""
+    def __init__(self, fd, events):
+        self.fd = fd
+        self.events = events
+
+def fd_ready(fd, events):
+    try:
+        return len(rpoll.poll({fd: events}, 0)) > 0
+    except rpoll.PollError:
+        # Let the actual operation report the error.
+        return True
+
 # We need to wrap ErrorObjects in these because we want them to be KernelValues
 # and rpython doesn't allow raising non-Exceptions nor multiple inheritance.
 class KernelException(Exception):
@@ -1172,14 +2283,28 @@ def iter_list(vals):
 
 def pythonify_list(vals, check_arity=-1):
     ret = []
-    for item in iter_list(vals):
-        ret.append(item)
+    # Compact lists hand us all their elements at once.
+    while isinstance(vals, Pair):
+        vals = vals.append_items(ret)
+    if not is_nil(vals):
+        raise NonNullListTail(vals)
     if check_arity != -1 and len(ret) != check_arity:
         signal_arity_mismatch(str(check_arity), vals)
     return ret
 
 def kernelify_list(ls):
-    ret = nil
-    for x in reversed(ls):
-        ret = Pair(x, ret)
+    """Kernel list of the elements of the Python list `ls`.  Its last two or
+    three elements go in a single compact object (see Pair2 and Pair3)."""
+    n = len(ls)
+    if n == 0:
+        return nil
+    elif n == 1:
+        return Pair(ls[0], nil)
+    elif n == 2:
+        return Pair2(ls[0], ls[1])
+    ret = Pair3(ls[n - 3], ls[n - 2], ls[n - 1])
+    i = n - 4
+    while i >= 0:
+        ret = Pair(ls[i], ret)
+        i -= 1
     return ret
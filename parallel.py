@@ -0,0 +1,158 @@
+"""
+Parallel map over forked worker processes.
+
+The arguments are split into contiguous chunks, and a worker process is
+forked for each chunk.  Workers inherit the whole heap, so the combiner and
+its arguments need no encoding.  Each worker applies the combiner to the
+arguments of its chunk in order, and writes the results back through a pipe
+in the format of serialize.py.  The parent reads the chunks in order, so
+results come back in the order of the arguments.
+
+Workers run in their own copy of the heap, so their side effects (defines,
+mutations, output port positions) aren't seen by the parent.  Only plain
+data (see serialize.py) can be returned.
+
+If the combiner signals an error, the worker sends the error back and the
+parent signals it again, to the same standard error continuation.  Other
+abnormal passes out of the worker's computation (like calling a continuation
+captured before the parallel map) would resume the parent's computation in
+the worker, so they are caught and reported as errors too.
+"""
+
+import os
+
+import kernel_type as kt
+import serialize
+
+
+RESULT = 'r'
+ERROR = 'e'
+
+# RPython's os.sysconf only takes numbers.
+SC_NPROCESSORS_ONLN = os.sysconf_names['SC_NPROCESSORS_ONLN']
+
+def worker_count():
+    """Maximum number of workers: $KERNELWORKERS if set, otherwise the number
+    of online processors."""
+    setting = os.environ.get('KERNELWORKERS')
+    if setting:
+        try:
+            return max(1, int(setting))
+        except ValueError:
+            pass
+    try:
+        return max(1, os.sysconf(SC_NPROCESSORS_ONLN))
+    except (OSError, ValueError):
+        return 1
+
+def map_(combiner, arg_lists, keep_results=True):
+    """Python list with the results of combining `combiner` with each of the
+    (Kernel) argument lists in `arg_lists`, computed in parallel.  If
+    `keep_results` is false, workers send #inert back instead."""
+    num_items = len(arg_lists)
+    if num_items == 0:
+        return []
+    num_workers = min(num_items, worker_count())
+    import interpreter
+    # Don't let workers inherit (and flush again) buffered output.
+    interpreter.current().stdout_port.flush()
+    # Worker i gets the argument lists from bounds[i] to bounds[i + 1].
+    bounds = [num_items * i // num_workers for i in range(num_workers + 1)]
+    pids = []
+    fds = []
+    try:
+        for i in range(num_workers):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                os.close(read_fd)
+                run_worker(combiner, arg_lists[bounds[i]:bounds[i + 1]],
+                           write_fd, keep_results)
+            os.close(write_fd)
+            pids.append(pid)
+            fds.append(read_fd)
+        results = []
+        for i in range(num_workers):
+            read_results(fds[i], bounds[i + 1] - bounds[i], results)
+        return results
+    finally:
+        for fd in fds:
+            os.close(fd)
+        for pid in pids:
+            os.waitpid(pid, 0)
+
+def run_worker(combiner, arg_lists, fd, keep_results):
+    import interpreter
+    import threads
+    interp = interpreter.current()
+    # Other green threads belong to the parent.
+    interp.scheduler = threads.Scheduler()
+    try:
+        try:
+            for args in arg_lists:
+                val = interp.eval_contained(kt.Pair(combiner, args),
+                                            kt.Environment([]))
+                if not keep_results:
+                    val = kt.inert
+                serialize.write_record(fd, RESULT, serialize.serialize(val))
+        except interpreter.Escape as e:
+            serialize.write_record(fd, ERROR, encode_error(e.val))
+        except kt.KernelException as e:
+            serialize.write_record(fd, ERROR, encode_error(e.val))
+        interp.stdout_port.flush()
+    finally:
+        os._exit(0)
+
+def encode_error(obj):
+    """Serialized (index message . irritants) of an error object, where
+    index is the position of its destination in kt.standard_error_conts.
+    Irritants we can't serialize are sent as their external representation."""
+    if not isinstance(obj, kt.ErrorObject):
+        index = kt.standard_error_conts.index(kt.error_cont)
+        message = "Continuation escaped from parallel worker"
+        irritants = kt.Pair(obj, kt.nil)
+    else:
+        if obj.dest_cont in kt.standard_error_conts:
+            index = kt.standard_error_conts.index(obj.dest_cont)
+        else:
+            index = kt.standard_error_conts.index(kt.error_cont)
+        message = obj.message.strval
+        irritants = obj.irritants
+    sendable = []
+    for irritant in kt.iter_list(irritants):
+        try:
+            serialize.serialize(irritant)
+        except kt.KernelException:
+            irritant = kt.String(irritant.tostring())
+        sendable.append(irritant)
+    return serialize.serialize(
+            kt.Pair(kt.make_fixnum(index),
+                    kt.Pair(kt.String(message),
+                            kt.kernelify_list(sendable))))
+
+def signal_decoded_error(data):
+    index, message, irritants = decode_error(data)
+    kt.raise_(kt.standard_error_conts[index], message, irritants)
+
+def decode_error(data):
+    error = serialize.deserialize(data)
+    assert isinstance(error, kt.Pair)
+    index = error.car
+    assert isinstance(index, kt.Fixnum)
+    rest = error.cdr
+    assert isinstance(rest, kt.Pair)
+    message = rest.car
+    assert isinstance(message, kt.String)
+    return index.fixval, message.strval, rest.cdr
+
+def read_results(fd, count, results):
+    for i in range(count):
+        record = serialize.read_record(fd)
+        if record is None:
+            kt.raise_(kt.system_error_cont,
+                      "Parallel worker died",
+                      kt.nil)
+        tag, data = record.tag, record.data
+        if tag == ERROR:
+            signal_decoded_error(data)
+        results.append(serialize.deserialize(data))
@@ -4,11 +4,13 @@
 
 __all__ = ['parse']
 
+import os
+
 from rpython.rlib.parsing.ebnfparse import parse_ebnf, make_parse_function
 from rpython.rlib.parsing.parsing import ParseError
 from rpython.rlib.parsing.tree import RPythonVisitor
 from rpython.rlib.rbigint import rbigint
-from rpython.rlib import rstring
+from rpython.rlib import rbisect, rfloat, rstring
 from rpython.rlib.rarithmetic import string_to_int
 
 import kernel_type as kt
@@ -32,6 +34,8 @@ grammar = r"""
     EXACT_OCT_INTEGER: "(#[eE]#[oO]|#[oO]#[eE]|#[oO])[\+\-]?[0-7]+";
     EXACT_DEC_INTEGER: "(#[eE]#[dD]|#[dD]#[eE]|#[eE]|#[dD])?[\+\-]?[0-9]+";
     EXACT_HEX_INTEGER: "(#[eE]#[xX]|#[xX]#[eE]|#[xX])[\+\-]?[0-9a-fA-F]+";
+    INEXACT_INFINITY: "#[iI][\+\-][iI][nN][fF][iI][nN][iI][tT][yY]";
+    INEXACT_REAL: "(#[iI]#[dD]|#[dD]#[iI]|#[iI])[\+\-]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][\+\-]?[0-9]+)?|(#[dD])?[\+\-]?([0-9]+\.[0-9]*|\.[0-9]+)([eE][\+\-]?[0-9]+)?|(#[dD])?[\+\-]?[0-9]+[eE][\+\-]?[0-9]+";
     IGNORE: " |\n|;[^\n]*\n";
     program: <sequence> [EOF];
     sequence: expr >sequence< | expr;
@@ -39,7 +43,7 @@ grammar = r"""
     list: LEFT_PAREN >sequence< RIGHT_PAREN;
     dotted_list: LEFT_PAREN >sequence< ["."] expr RIGHT_PAREN;
     atom: <BOOLEAN> | <INERT> | <IGNORE_VAL> | <SUPPRESS> | <STRING> | <number> | <IDENTIFIER> | <nil>;
-    number: <EXACT_POSITIVE_INFINITY> | <EXACT_NEGATIVE_INFINITY> | <EXACT_BIN_INTEGER> | <EXACT_OCT_INTEGER> | <EXACT_DEC_INTEGER> | <EXACT_HEX_INTEGER>;
+    number: <EXACT_POSITIVE_INFINITY> | <EXACT_NEGATIVE_INFINITY> | <EXACT_BIN_INTEGER> | <EXACT_OCT_INTEGER> | <EXACT_DEC_INTEGER> | <EXACT_HEX_INTEGER> | <INEXACT_INFINITY> | <INEXACT_REAL>;
     nil: LEFT_PAREN RIGHT_PAREN;
     """
 
@@ -50,31 +54,185 @@ suppress = Suppress()
 suppress_next = Suppress()
 
 class SourceFile(object):
-    _immutable_fields_ = ['path', 'lines']
-    def __init__(self, path, lines):
+    """A file code was loaded from, shared by the positions of all the values
+    parsed from it.  We don't keep its text: the index of line starts is
+    built by reading the file back when we first show a position in it, and
+    the lines we show are read back one at a time."""
+    _immutable_fields_ = ['path', 'number']
+    def __init__(self, path, number):
         self.path = path
-        self.lines = lines
+        self.number = number
+        self.line_starts = None
+    def get_line_starts(self):
+        if self.line_starts is None:
+            line_starts = [0]
+            try:
+                fd = os.open(self.path, os.O_RDONLY, 0)
+            except OSError:
+                # Gone since we loaded it; we can't show its lines.
+                return line_starts
+            try:
+                offset = 0
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    i = chunk.find("\n")
+                    while i >= 0:
+                        line_starts.append(offset + i + 1)
+                        i = chunk.find("\n", i + 1)
+                    offset += len(chunk)
+            finally:
+                os.close(fd)
+            self.line_starts = line_starts
+        return self.line_starts
+    def line_and_column(self, offset):
+        """0-based line and column of the given offset."""
+        return find_line_and_column(self.get_line_starts(), offset)
+    def get_line(self, lineno):
+        line_starts = self.get_line_starts()
+        if not 0 <= lineno < len(line_starts):
+            return ""
+        try:
+            fd = os.open(self.path, os.O_RDONLY, 0)
+        except OSError:
+            return ""
+        try:
+            os.lseek(fd, line_starts[lineno], 0)
+            chunks = []
+            while True:
+                chunk = os.read(fd, 4096)
+                if not chunk:
+                    break
+                i = chunk.find("\n")
+                if i >= 0:
+                    chunks.append(chunk[:i])
+                    break
+                chunks.append(chunk)
+        finally:
+            os.close(fd)
+        return "".join(chunks)
 
-class SourcePos(object):
-    _immutable_fields_ = ['source_file', 'line', 'column']
-    def __init__(self, source_file, line, column):
-        self.source_file = source_file
-        self.line = line
-        self.column = column
-    def print_(self, prefix=''):
-        # Editors show 1-based line and column numbers, while
-        # source_pos objects are 0-based.
-        print "%s%s, line %s, column %s:" % (prefix,
-                                             self.source_file.path,
-                                             self.line + 1,
-                                             self.column + 1)
-        print "%s%s" % (prefix, self.source_file.lines[self.line])
-        print "%s%s^" % (prefix, (" " * self.column))
+def find_line_and_column(line_starts, offset):
+    line = rbisect.bisect_right(line_starts, offset, len(line_starts)) - 1
+    return line, offset - line_starts[line]
+
+class SourceFiles(object):
+    """Numbered source files, so a source position can be a single integer:
+    the number of its source file shifted left by OFFSET_BITS, plus the
+    offset into it.  Then parsed values don't need an object each for their
+    positions.
+
+    Each interpreter has its own table.  kernel.k and extension.k are parsed
+    once for all interpreters, so they are numbered in a table of their own,
+    which interpreters' tables number their files after and look those up in.
+
+    Loading a path again reuses its number, so a table has an entry for each
+    file loaded, not for each load.  We only number files we load code
+    from; values parsed from other text (`read`, requests to a server, the
+    debugger prompt) have no position."""
+    def __init__(self, parent=None):
+        self.parent = parent
+        if parent is None:
+            self.first_number = 0
+        else:
+            self.first_number = parent.first_number + len(parent.files)
+        self.files = []
+        self.by_path = {}
+    def register(self, path):
+        source_file = self.by_path.get(path, None)
+        if source_file is None:
+            source_file = SourceFile(path,
+                                     self.first_number + len(self.files))
+            self.files.append(source_file)
+            self.by_path[path] = source_file
+        else:
+            # It may have changed since we last loaded it.
+            source_file.line_starts = None
+        return source_file
+    def get(self, number):
+        """The SourceFile with the given number, or None if we don't know it
+        (e.g. positions of values made by another interpreter)."""
+        if number < self.first_number:
+            if self.parent is None:
+                return None
+            return self.parent.get(number)
+        i = number - self.first_number
+        if i < len(self.files):
+            return self.files[i]
+        return None
+
+OFFSET_BITS = 32
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+def make_source_pos(source_file, offset):
+    if source_file is None or offset > OFFSET_MASK:
+        return kt.NO_SOURCE_POS
+    return (source_file.number << OFFSET_BITS) | offset
+
+def current_source_files():
+    import interpreter
+    return interpreter.current().source_files
+
+def source_file_of(pos, source_files=None):
+    """SourceFile of the position, or None if we don't know it.
+    `source_files` is the current interpreter's by default."""
+    assert pos != kt.NO_SOURCE_POS
+    if source_files is None:
+        source_files = current_source_files()
+    return source_files.get(pos >> OFFSET_BITS)
+
+def line_and_column(pos, source_files=None):
+    """0-based line and column of the position, or (-1, -1) if we don't know
+    its file."""
+    source_file = source_file_of(pos, source_files)
+    if source_file is None:
+        return -1, -1
+    return source_file.line_and_column(pos & OFFSET_MASK)
+
+def location(pos):
+    """Short, 1-based 'path:line:column' description."""
+    source_file = source_file_of(pos)
+    if source_file is None:
+        return "<unknown>"
+    line, column = source_file.line_and_column(pos & OFFSET_MASK)
+    return "%s:%d:%d" % (source_file.path, line + 1, column + 1)
+
+def trace_location(pos):
+    """Like `location`, for naming JIT traces.  The JIT can't wait for us to
+    read the source file then, so unless we have read its lines already we
+    give the offset in it instead: 'path@offset'."""
+    if pos == kt.NO_SOURCE_POS:
+        return "<unknown>"
+    source_file = source_file_of(pos)
+    if source_file is None:
+        return "<unknown>"
+    offset = pos & OFFSET_MASK
+    if source_file.line_starts is None:
+        return "%s@%d" % (source_file.path, offset)
+    line, column = find_line_and_column(source_file.line_starts, offset)
+    return "%s:%d:%d" % (source_file.path, line + 1, column + 1)
+
+def print_source_pos(pos, prefix=''):
+    source_file = source_file_of(pos)
+    if source_file is None:
+        print "%s<unknown source position>" % prefix
+        return
+    line, column = source_file.line_and_column(pos & OFFSET_MASK)
+    # Editors show 1-based line and column numbers, while ours are 0-based.
+    print "%s%s, line %s, column %s:" % (prefix,
+                                         source_file.path,
+                                         line + 1,
+                                         column + 1)
+    print "%s%s" % (prefix, source_file.get_line(line))
+    print "%s%s^" % (prefix, (" " * column))
 
 class Visitor(RPythonVisitor):
-    def __init__(self, source_file=None):
+    def __init__(self, source_file=None, offset=0):
         RPythonVisitor.__init__(self)
         self.source_file = source_file
+        # Offset of the parsed text within the source file.
+        self.offset = offset
     def visit_SUPPRESS(self, node):
         return suppress_next
     def visit_sequence(self, node):
@@ -103,6 +261,20 @@ class Visitor(RPythonVisitor):
         return kt.ExactPositiveInfinity(self.make_src_pos(node))
     def visit_EXACT_NEGATIVE_INFINITY(self, node):
         return kt.ExactNegativeInfinity(self.make_src_pos(node))
+    def visit_INEXACT_INFINITY(self, node):
+        if node.token.source[2] == '+':
+            val = rfloat.INFINITY
+        else:
+            val = -rfloat.INFINITY
+        return kt.Flonum(val, self.make_src_pos(node))
+    def visit_INEXACT_REAL(self, node):
+        s = node.token.source
+        i = 0
+        # Skip prefixes
+        while s[i] == "#":
+            i += 2
+        return kt.Flonum(rfloat.string_to_float(s[i:]),
+                         self.make_src_pos(node))
     def visit_IGNORE_VAL(self, node):
         return kt.Ignore(self.make_src_pos(node))
     def visit_INERT(self, node):
@@ -123,8 +295,8 @@ class Visitor(RPythonVisitor):
     def visit_RIGHT_PAREN(self, node):
         return suppress
     def make_src_pos(self, node):
-        src_pos = node.getsourcepos()
-        return SourcePos(self.source_file, src_pos.lineno, src_pos.columnno)
+        return make_source_pos(self.source_file,
+                               node.getsourcepos().i + self.offset)
     def exact_from_node(self, node, radix):
         s = node.token.source
         i = 0
@@ -154,19 +326,32 @@ def filter_suppressed(lst):
             if not isinstance(x, Suppress)
                and prev is not suppress_next]
 
-def build_pair_chain(lst, source_pos, start=0):
-    end = len(lst)
-    if end - start == 2:
-        return kt.Pair(lst[start], lst[start+1], source_pos=source_pos)
-    else:
-        return kt.Pair(lst[start], build_pair_chain(lst, None, start+1), source_pos=source_pos)
+def build_pair_chain(lst, source_pos):
+    # Build from the tail backwards, so long lists don't eat native stack.
+    i = len(lst) - 1
+    ret = lst[i]
+    while i > 1:
+        i -= 1
+        ret = kt.Pair(lst[i], ret)
+    return kt.Pair(lst[0], ret, source_pos=source_pos)
 
 regexs, rules, ToAST = parse_ebnf(grammar)
 parse_ebnf = make_parse_function(regexs, rules, eof=True)
 
-def parse(s, path='<no path>'):
-    source_file = SourceFile(path, s.split("\n"))
-    return Visitor(source_file).dispatch(ToAST().transform(parse_ebnf(s)))
+def parse(s):
+    """Parse data without source positions."""
+    return Visitor().dispatch(ToAST().transform(parse_ebnf(s)))
+
+def parse_datum(s, path, source_file, offset):
+    """Parse the source of a single datum, read from `path`, found at the
+    given offset of `source_file` (None for no source positions)."""
+    visitor = Visitor(source_file, offset)
+    data = visitor.dispatch(ToAST().transform(parse_ebnf(s)))
+    if not isinstance(data, kt.Pair) or not kt.is_nil(data.cdr):
+        # The port split its input wrong; don't drop the rest silently.
+        kt.signal_parse_error("Expected a single datum: %s" % s, path)
+    assert isinstance(data, kt.Pair)
+    return data.car
 
 def test(s):
     try:
@@ -1,17 +1,25 @@
 from itertools import product
+import math
 import os
 import stat
 
-from rpython.rlib import jit, rpath, rstring, unroll
+from rpython.rlib import jit, rfloat, rpath, rstring, unroll
 from rpython.rlib.parsing.parsing import ParseError
 from rpython.rlib.parsing.deterministic import LexerError
+from rpython.rlib.rarithmetic import ovfcheck
 from rpython.rlib.rbigint import rbigint
 
+import analyze
+import checkpoint
 import debug
+import interpreter
 import kernel_type as kt
+import parallel
 import parse
-
-search_paths = ['.'] + os.environ.get('KERNELPATH', '').split(':')
+import remote
+import serialize
+import sockets
+import threads
 
 _exports = {}
 
@@ -64,6 +72,14 @@ def string_append(vals):
         s.append(v.strval)
     return kt.String(s.build())
 
+@export('error-object-message', [kt.ErrorObject])
+def error_object_message(error):
+    return error.message
+
+@export('error-object-irritants', [kt.ErrorObject])
+def error_object_irritants(error):
+    return error.irritants
+
 @export('continuation->applicative', argtypes=[kt.Continuation])
 def continuation2applicative(cont):
     return kt.Applicative(kt.ContWrapper(cont))
@@ -104,7 +120,8 @@ def vau(operands, env, cont):
     assert isinstance(cdr, kt.Pair)
     eformals = cdr.car
     exprs = cdr.cdr
-    return cont.plug_reduce(kt.CompoundOperative(formals, eformals, exprs, env))
+    return cont.plug_reduce(
+            kt.make_compound_operative(formals, eformals, exprs, env))
 
 @export('$if', [kt.KernelValue, kt.KernelValue, kt.KernelValue])
 def if_(test, consequent, alternative, env, cont):
@@ -114,6 +131,10 @@ def if_(test, consequent, alternative, env, cont):
 def equalp(o1, o2):
     return kt.true if o1.equal(o2) else kt.false
 
+@export('eq?', [kt.KernelValue, kt.KernelValue])
+def eqp(o1, o2):
+    return kt.true if kt.is_eq(o1, o2) else kt.false
+
 @export('cons', [kt.KernelValue, kt.KernelValue])
 def cons(car, cdr):
     return kt.Pair(car, cdr)
@@ -145,7 +166,7 @@ def length(lst):
         except OverflowError:
             return big_length(ret, lst)
         lst = lst.cdr
-    return kt.Fixnum(ret)
+    return kt.make_fixnum(ret)
 
 @export('list?', [kt.KernelValue])
 def listp(val):
@@ -195,8 +216,7 @@ def lambda_(vals, env, cont):
     formals = vals.car
     exprs = vals.cdr
     return cont.plug_reduce(
-            kt.Applicative(
-                kt.CompoundOperative(formals, kt.ignore, exprs, env)))
+            kt.Applicative(kt.Lambda(formals, exprs, env)))
 
 # car, cdr, caar, cadr, ..., caadr, ..., cdddddr.
 for length in range(1, 6):
@@ -223,22 +243,35 @@ def apply_(vals, env_ignore, cont):
 
 @export('map', simple=False)
 def map_(vals, env, cont):
+    app, arg_lists = map_arguments(vals, 'map')
+    return kt.map_(app.wrapped_combiner, arg_lists, 0, env, cont)
+
+@export('parallel-map')
+def parallel_map(vals):
+    app, arg_lists = map_arguments(vals, 'parallel-map')
+    return kt.kernelify_list(parallel.map_(app.wrapped_combiner, arg_lists))
+
+@export('parallel-for-each')
+def parallel_for_each(vals):
+    app, arg_lists = map_arguments(vals, 'parallel-for-each')
+    parallel.map_(app.wrapped_combiner, arg_lists, keep_results=False)
+    return kt.inert
+
+def map_arguments(vals, name):
+    """Applicative and Python list of argument lists for map-like
+    primitives."""
     try:
         args = kt.pythonify_list(vals)
     except kt.NonNullListTail:
-        kt.signal_value_error("Argument tree to map is not a list", vals)
+        kt.signal_value_error("Argument tree to %s is not a list" % name,
+                              vals)
     else:
         if len(args) < 2:
             kt.signal_arity_mismatch(">=2", vals)
         app = args[0]
         kt.check_type(app, kt.Applicative)
         assert isinstance(app, kt.Applicative)
-        lists = args[1:]
-        return kt.map_(app.wrapped_combiner,
-                       transpose(lists),
-                       0,
-                       env,
-                       cont)
+        return app, transpose(args[1:])
 
 def transpose(pyklists):
     """
@@ -313,10 +346,25 @@ def make_keyed_variable(binder_class, accessor_class):
     return kt.Pair(kt.Applicative(binder),
                    kt.Pair(kt.Applicative(accessor), kt.nil))
 
+# The arithmetic primitives below go through leading fixnum arguments in a
+# machine integer, and only box the result (or the partial result, if they find
+# other kinds of numbers or overflow).
+
 @export('+')
 def add(vals):
-    accum = kt.zero
-    for v in kt.iter_list(vals):
+    fixsum = 0
+    rest = vals
+    while isinstance(rest, kt.Pair):
+        v = rest.car
+        if not isinstance(v, kt.Fixnum):
+            break
+        try:
+            fixsum = ovfcheck(fixsum + v.fixval)
+        except OverflowError:
+            break
+        rest = rest.cdr
+    accum = kt.make_fixnum(fixsum)
+    for v in kt.iter_list(rest):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
         accum = accum.add(v)
@@ -324,8 +372,19 @@ def add(vals):
 
 @export('*')
 def mul(vals):
-    accum = kt.one
-    for v in kt.iter_list(vals):
+    fixprod = 1
+    rest = vals
+    while isinstance(rest, kt.Pair):
+        v = rest.car
+        if not isinstance(v, kt.Fixnum):
+            break
+        try:
+            fixprod = ovfcheck(fixprod * v.fixval)
+        except OverflowError:
+            break
+        rest = rest.cdr
+    accum = kt.make_fixnum(fixprod)
+    for v in kt.iter_list(rest):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
         accum = accum.mul(v)
@@ -338,7 +397,8 @@ def zerop(vals):
         # after the first non-zero.
         kt.check_type(v, kt.Number)
     for v in kt.iter_list(vals):
-        if not kt.zero.equal(v):
+        assert isinstance(v, kt.Number)
+        if not v.is_zero():
             return kt.false
     return kt.true
 
@@ -346,7 +406,7 @@ def zerop(vals):
 def div(a, d):
     if isinstance(a, kt.Infinity):
         kt.signal_divide_infinity(a, d)
-    elif d.equal(kt.zero):
+    elif d.is_zero():
         kt.signal_divide_by_zero(a, d)
     else:
         return a.divide_by(d)
@@ -355,7 +415,7 @@ def div(a, d):
 def mod(a, d):
     if isinstance(a, kt.Infinity):
         kt.signal_divide_infinity(a, d)
-    elif d.equal(kt.zero):
+    elif d.is_zero():
         kt.signal_divide_by_zero(a, d)
     else:
         return a.mod_by(d)
@@ -364,18 +424,35 @@ def mod(a, d):
 def div_and_mod(a, d):
     if isinstance(a, kt.Infinity):
         kt.signal_divide_infinity(a, d)
-    elif d.equal(kt.zero):
+    elif d.is_zero():
         kt.signal_divide_by_zero(a, d)
     else:
         return a.divmod_by(d)
 
 @export('-')
 def sub(vals):
-    ls = kt.pythonify_list(vals)
-    if len(ls) < 2:
+    if not (isinstance(vals, kt.Pair) and isinstance(vals.cdr, kt.Pair)):
         kt.signal_arity_mismatch('>=2', vals)
-    accum = ls[0]
-    for v in ls[1:]:
+    assert isinstance(vals, kt.Pair)
+    first = vals.car
+    kt.check_type(first, kt.Number)
+    assert isinstance(first, kt.Number)
+    rest = vals.cdr
+    if isinstance(first, kt.Fixnum):
+        fixdiff = first.fixval
+        while isinstance(rest, kt.Pair):
+            v = rest.car
+            if not isinstance(v, kt.Fixnum):
+                break
+            try:
+                fixdiff = ovfcheck(fixdiff - v.fixval)
+            except OverflowError:
+                break
+            rest = rest.cdr
+        accum = kt.make_fixnum(fixdiff)
+    else:
+        accum = first
+    for v in kt.iter_list(rest):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
         accum = accum.sub(v)
@@ -383,26 +460,27 @@ def sub(vals):
 
 @export('=?')
 def eq(vals):
-    ls = kt.pythonify_list(vals)
-    if len(ls) < 2:
-        return kt.true
-    latest = ls[0]
-    for v in ls[1:]:
+    latest = None
+    for v in kt.iter_list(vals):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
-        if not latest.equal(v):
-            return kt.false
+        if latest is not None:
+            if isinstance(latest, kt.Fixnum) and isinstance(v, kt.Fixnum):
+                if latest.fixval != v.fixval:
+                    return kt.false
+            elif not latest.num_eq(v):
+                return kt.false
         latest = v
     return kt.true
 
 #XXX: refactor
 @export('<=?')
 def lteq(vals):
-    latest = kt.e_neg_inf
+    latest = None
     for v in kt.iter_list(vals):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
-        if not latest.lteq(v):
+        if latest is not None and not latest.lteq(v):
             return kt.false
         latest = v
     return kt.true
@@ -410,26 +488,264 @@ def lteq(vals):
 #XXX: refactor
 @export('<?')
 def lt(vals):
-    latest = kt.e_neg_inf
+    latest = None
     for v in kt.iter_list(vals):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
-        if not latest.lt(v):
+        if latest is None:
+            pass
+        elif isinstance(latest, kt.Fixnum) and isinstance(v, kt.Fixnum):
+            if latest.fixval >= v.fixval:
+                return kt.false
+        elif not latest.lt(v):
             return kt.false
         latest = v
     return kt.true
 
 @export('>?')
 def gt(vals):
-    latest = kt.e_pos_inf
+    latest = None
     for v in kt.iter_list(vals):
         kt.check_type(v, kt.Number)
         assert isinstance(v, kt.Number)
-        if not v.lt(latest):
+        if latest is not None and not v.lt(latest):
             return kt.false
         latest = v
     return kt.true
 
+@export('>=?')
+def gteq(vals):
+    latest = None
+    for v in kt.iter_list(vals):
+        kt.check_type(v, kt.Number)
+        assert isinstance(v, kt.Number)
+        if latest is not None and not v.lteq(latest):
+            return kt.false
+        latest = v
+    return kt.true
+
+@export('abs', [kt.Number])
+def abs_(n):
+    return n.abs()
+
+def extremum(vals, want_max):
+    ret = None
+    inexact = False
+    for v in kt.iter_list(vals):
+        kt.check_type(v, kt.Number)
+        assert isinstance(v, kt.Number)
+        if isinstance(v, kt.Flonum):
+            inexact = True
+        if ret is None or (ret.lt(v) if want_max else v.lt(ret)):
+            ret = v
+    if ret is None:
+        kt.signal_arity_mismatch('>=1', vals)
+    # Like the other arithmetic, one inexact argument makes the result
+    # inexact.
+    if inexact and not isinstance(ret, kt.Flonum):
+        return kt.Flonum(ret.to_float())
+    return ret
+
+@export('max')
+def max_(vals):
+    return extremum(vals, True)
+
+@export('min')
+def min_(vals):
+    return extremum(vals, False)
+
+@export('gcd')
+def gcd(vals):
+    accum = kt.zero
+    for v in kt.iter_list(vals):
+        kt.check_type(v, kt.Integer)
+        assert isinstance(v, kt.Integer)
+        accum = kt.integer_gcd(accum, v)
+    return accum
+
+@export('lcm')
+def lcm(vals):
+    accum = kt.one
+    for v in kt.iter_list(vals):
+        kt.check_type(v, kt.Integer)
+        assert isinstance(v, kt.Integer)
+        accum = kt.integer_lcm(accum, v)
+    return accum
+
+@export('expt', [kt.Number, kt.Number])
+def expt(base, power):
+    assert isinstance(base, kt.Number)
+    assert isinstance(power, kt.Number)
+    if (isinstance(base, kt.Flonum)
+        or isinstance(power, kt.Flonum)
+        or (isinstance(power, kt.Integer) and power.lt(kt.zero))):
+        # There are no exact rationals, so negative exponents give inexact
+        # results too.
+        return float_result(math.pow, base.to_float(), power.to_float(),
+                            kt.Pair(base, kt.Pair(power, kt.nil)))
+    kt.check_type(power, kt.Integer)
+    assert isinstance(power, kt.Integer)
+    if power.is_zero():
+        return kt.one
+    if isinstance(base, kt.Infinity):
+        if (isinstance(base, kt.ExactNegativeInfinity)
+            and power.mod_by(kt.make_fixnum(2)).equal(kt.one)):
+            return kt.e_neg_inf
+        return kt.e_pos_inf
+    assert isinstance(base, kt.Integer)
+    return kt.integer_expt(base, power)
+
+@export('number->string')
+def number2string(vals):
+    args = kt.pythonify_list(vals)
+    radix = 10
+    if len(args) == 1:
+        pass
+    elif len(args) == 2:
+        kt.check_type(args[1], kt.Fixnum)
+        r = args[1]
+        assert isinstance(r, kt.Fixnum)
+        radix = r.fixval
+        if not 2 <= radix <= 36:
+            kt.signal_value_error("number->string radix must be between 2 "
+                                  "and 36",
+                                  kt.Pair(r, kt.nil))
+    else:
+        kt.signal_arity_mismatch('1 or 2', vals)
+    n = args[0]
+    kt.check_type(n, kt.Number)
+    assert isinstance(n, kt.Number)
+    return kt.String(n.tostring_radix(radix))
+
+@export('/')
+def divide(vals):
+    if not isinstance(vals, kt.Pair):
+        kt.signal_arity_mismatch('>=1', vals)
+    assert isinstance(vals, kt.Pair)
+    accum = vals.car
+    kt.check_type(accum, kt.Number)
+    assert isinstance(accum, kt.Number)
+    if kt.is_nil(vals.cdr):
+        return quotient(kt.one, accum)
+    for v in kt.iter_list(vals.cdr):
+        kt.check_type(v, kt.Number)
+        assert isinstance(v, kt.Number)
+        accum = quotient(accum, v)
+    return accum
+
+def quotient(a, b):
+    """Exact if both numbers are exact integers and b divides a; inexact
+    otherwise, since we have no exact rationals."""
+    if b.is_zero():
+        kt.signal_divide_by_zero(a, b)
+    if isinstance(a, kt.Integer) and isinstance(b, kt.Integer):
+        if a.mod_by(b).is_zero():
+            return a.divide_by(b)
+    if isinstance(a, kt.Infinity) and not isinstance(b, kt.Flonum):
+        kt.signal_divide_infinity(a, b)
+    return kt.Flonum(a.to_float() / b.to_float())
+
+@export('exact->inexact', [kt.Number])
+def exact2inexact(n):
+    if isinstance(n, kt.Flonum):
+        return n
+    return kt.Flonum(n.to_float())
+
+@export('inexact->exact', [kt.Number])
+def inexact2exact(n):
+    if not isinstance(n, kt.Flonum):
+        return n
+    x = n.floval
+    if rfloat.isinf(x):
+        if x > 0:
+            return kt.e_pos_inf
+        return kt.e_neg_inf
+    if rfloat.isnan(x) or math.floor(x) != x:
+        kt.signal_value_error("No exact equivalent (there are no exact "
+                              "rationals)",
+                              kt.Pair(n, kt.nil))
+    return kt.try_and_make_fixnum(rbigint.fromfloat(x))
+
+def is_exact(n):
+    return not isinstance(n, kt.Flonum)
+
+def is_inexact(n):
+    return isinstance(n, kt.Flonum)
+
+def make_exactness_pred(test, name):
+    def pred(vals):
+        result = kt.true
+        for v in kt.iter_list(vals):
+            kt.check_type(v, kt.Number)
+            if not test(v):
+                result = kt.false
+        return result
+    return kt.Applicative(kt.SimplePrimitive(pred, name))
+
+_exports['exact?'] = make_exactness_pred(is_exact, 'exact?')
+_exports['inexact?'] = make_exactness_pred(is_inexact, 'inexact?')
+
+def float_result(fn, x, y, irritants):
+    try:
+        return kt.Flonum(fn(x, y))
+    except (ValueError, OverflowError):
+        kt.signal_value_error("Result is not a real number", irritants)
+
+def make_float_function(fn, name):
+    def wrapped(vals):
+        args = kt.pythonify_list(vals, 1)
+        x = args[0]
+        kt.check_type(x, kt.Number)
+        assert isinstance(x, kt.Number)
+        try:
+            return kt.Flonum(fn(x.to_float()))
+        except (ValueError, OverflowError):
+            kt.signal_value_error("Result of %s is not a real number" % name,
+                                  vals)
+    return kt.Applicative(kt.SimplePrimitive(wrapped, name))
+
+for _name, _fn in [('exp', math.exp),
+                   ('log', math.log),
+                   ('sin', math.sin),
+                   ('cos', math.cos),
+                   ('tan', math.tan),
+                   ('asin', math.asin),
+                   ('acos', math.acos)]:
+    _exports[_name] = make_float_function(_fn, _name)
+del _name, _fn
+
+@export('atan')
+def atan(vals):
+    args = kt.pythonify_list(vals)
+    for arg in args:
+        kt.check_type(arg, kt.Number)
+        assert isinstance(arg, kt.Number)
+    if len(args) == 1:
+        y = args[0]
+        assert isinstance(y, kt.Number)
+        return kt.Flonum(math.atan(y.to_float()))
+    elif len(args) == 2:
+        y = args[0]
+        x = args[1]
+        assert isinstance(y, kt.Number)
+        assert isinstance(x, kt.Number)
+        return kt.Flonum(math.atan2(y.to_float(), x.to_float()))
+    else:
+        kt.signal_arity_mismatch('1 or 2', vals)
+
+@export('sqrt', [kt.Number])
+def sqrt(n):
+    if isinstance(n, kt.Fixnum) and n.fixval >= 0:
+        # Exact square roots of exact numbers stay exact.
+        root = int(math.sqrt(float(n.fixval)))
+        if root * root == n.fixval:
+            return kt.make_fixnum(root)
+    try:
+        return kt.Flonum(math.sqrt(n.to_float()))
+    except ValueError:
+        kt.signal_value_error("Square root of a negative number",
+                              kt.Pair(n, kt.nil))
+
 @export('positive?')
 def positive(vals):
     for v in kt.iter_list(vals):
@@ -499,30 +815,447 @@ def s_andp(vals, env, cont):
 def s_andp(vals, env, cont):
     return kt.s_orp(vals, env, cont)
 
-# Not standard Kernel functions; for debugging only.
+# Ports.
+
+_input_port_binder = kt.KeyedDynamicBinder()
+_output_port_binder = kt.KeyedDynamicBinder()
+
+def current_input_port(cont):
+    port = kt.find_dynamic_binding(_input_port_binder, cont)
+    if port is None:
+        return interpreter.current().stdin_port
+    assert isinstance(port, kt.InputPort)
+    return port
+
+def output_port_binding(port, cont):
+    """Continuation extending `cont` in which `port` is the current output
+    port."""
+    return kt.KeyedDynamicCont(_output_port_binder, port, cont)
+
+def current_output_port(cont):
+    port = kt.find_dynamic_binding(_output_port_binder, cont)
+    if port is None:
+        return interpreter.current().stdout_port
+    assert isinstance(port, kt.OutputPort)
+    return port
+
+def optional_input_port(vals, cont):
+    """Parse the argument list of a primitive that takes an optional input
+    port, which defaults to the current input port."""
+    args = kt.pythonify_list(vals)
+    if len(args) == 0:
+        return current_input_port(cont)
+    elif len(args) == 1:
+        port = args[0]
+        kt.check_type(port, kt.InputPort)
+        assert isinstance(port, kt.InputPort)
+        return port
+    else:
+        kt.signal_arity_mismatch("0 or 1", vals)
 
-@export('print')
-def print_(val):
-    if isinstance(val, kt.Pair):
-        for v in kt.iter_list(val):
-            print v.todisplay(),
+def optional_output_port(vals, cont):
+    """Parse the argument list of a primitive that takes an optional output
+    port, which defaults to the current output port."""
+    args = kt.pythonify_list(vals)
+    if len(args) == 0:
+        return current_output_port(cont)
+    elif len(args) == 1:
+        port = args[0]
+        kt.check_type(port, kt.OutputPort)
+        assert isinstance(port, kt.OutputPort)
+        return port
+    else:
+        kt.signal_arity_mismatch("0 or 1", vals)
+
+def value_and_output_port(vals, cont):
+    """Parse the argument list of a primitive that takes a value and an
+    optional output port, which defaults to the current output port."""
+    args = kt.pythonify_list(vals)
+    if len(args) == 1:
+        return args[0], current_output_port(cont)
+    elif len(args) == 2:
+        port = args[1]
+        kt.check_type(port, kt.OutputPort)
+        assert isinstance(port, kt.OutputPort)
+        return args[0], port
+    else:
+        kt.signal_arity_mismatch("1 or 2", vals)
+
+def open_input_file(path):
+    fd = -1
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        kt.signal_file_not_found(path)
+    return kt.FileInputPort(fd, path)
+
+def open_mapped_input_file(path):
+    fd = -1
+    try:
+        fd = os.open(path, os.O_RDONLY, 0)
+    except OSError:
+        kt.signal_file_not_found(path)
+    return kt.MappedInputPort(fd, path)
+
+def open_output_file(path):
+    fd = -1
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0666)
+    except OSError:
+        kt.signal_io_error("Can't open file '%s' for output" % path,
+                           kt.Pair(kt.String(path), kt.nil))
+    return kt.FileOutputPort(fd)
+
+@export('open-input-file', [kt.String])
+def open_input_file_(path):
+    return open_input_file(path.strval)
+
+@export('open-mapped-input-file', [kt.String])
+def open_mapped_input_file_(path):
+    return open_mapped_input_file(path.strval)
+
+@export('open-output-file', [kt.String])
+def open_output_file_(path):
+    return open_output_file(path.strval)
+
+@export('close-port', [kt.Port])
+def close_port(port):
+    port.close()
+    return kt.inert
+
+@export('with-input-from-file', [kt.String, kt.Combiner], simple=False)
+def with_input_from_file(path, combiner, env, cont):
+    port = open_input_file(path.strval)
+    return combiner.combine(
+            kt.nil,
+            kt.Environment([]),
+            kt.KeyedDynamicCont(_input_port_binder,
+                                port,
+                                kt.ClosePortCont(port, cont)))
+
+@export('with-output-to-file', [kt.String, kt.Combiner], simple=False)
+def with_output_to_file(path, combiner, env, cont):
+    port = open_output_file(path.strval)
+    return combiner.combine(
+            kt.nil,
+            kt.Environment([]),
+            kt.KeyedDynamicCont(_output_port_binder,
+                                port,
+                                kt.ClosePortCont(port, cont)))
+
+@export('get-current-input-port', [], simple=False)
+def get_current_input_port(env, cont):
+    return cont.plug_reduce(current_input_port(cont))
+
+def read_datum(port):
+    src = port.read_datum_source()
+    if src is None:
+        return kt.eof
+    try:
+        return parse.parse_datum(src, port.path, None, 0)
+    except ParseError as e:
+        kt.signal_parse_error(e.nice_error_message(), port.path)
+    except LexerError as e:
+        kt.signal_parse_error(e.nice_error_message(), port.path)
+
+def read_input(name, port):
+    """Result of the input primitive `name` on `port`."""
+    if name == 'read':
+        return read_datum(port)
+    elif name == 'read-char':
+        c = port.read_char()
+        return kt.eof if c == '' else kt.String(c)
+    elif name == 'peek-char':
+        c = port.peek_char()
+        return kt.eof if c == '' else kt.String(c)
+    elif name == 'read-line':
+        line = port.read_line()
+        return kt.eof if line is None else kt.String(line)
     else:
-        assert kt.is_nil(val)
+        assert name == 'deserialize'
+        val = serialize.read(port)
+        return kt.eof if val is None else val
+
+def input_primitive(name, port, vals, env, cont):
+    """Run the input primitive `name` on `port`.  If it would block, block
+    only the current green thread, and run it again once there's input."""
+    port.begin_read()
+    try:
+        val = read_input(name, port)
+    except kt.WouldBlock as e:
+        port.rewind()
+        return retry_when_ready(name, e, vals, env, cont)
+    finally:
+        port.end_read()
+    return cont.plug_reduce(val)
+
+def retry_when_ready(name, e, vals, env, cont):
+    """Block the current green thread until the file descriptor that the
+    primitive `name` was waiting for (according to WouldBlock `e`) is ready,
+    and then combine the primitive with `vals` again."""
+    applicative = _ground_bindings[name]
+    assert isinstance(applicative, kt.Applicative)
+    retry = kt.ConstantCont(applicative.wrapped_combiner,
+                            kt.CombineCont(vals, env, cont))
+    return threads.get_scheduler().wait_io(e.fd, e.events, retry)
+
+@export('read', simple=False)
+def read(vals, env, cont):
+    return input_primitive('read', optional_input_port(vals, cont),
+                           vals, env, cont)
+
+# icbink has no character type yet; characters are one-character strings.
+@export('read-char', simple=False)
+def read_char(vals, env, cont):
+    return input_primitive('read-char', optional_input_port(vals, cont),
+                           vals, env, cont)
+
+@export('peek-char', simple=False)
+def peek_char(vals, env, cont):
+    return input_primitive('peek-char', optional_input_port(vals, cont),
+                           vals, env, cont)
+
+@export('read-line', simple=False)
+def read_line(vals, env, cont):
+    return input_primitive('read-line', optional_input_port(vals, cont),
+                           vals, env, cont)
+
+@export('write', simple=False)
+def write(vals, env, cont):
+    val, port = value_and_output_port(vals, cont)
+    kt.write_value(val, port)
+    return cont.plug_reduce(kt.inert)
+
+@export('display', simple=False)
+def display(vals, env, cont):
+    val, port = value_and_output_port(vals, cont)
+    kt.write_value(val, port, display=True)
+    return cont.plug_reduce(kt.inert)
+
+@export('newline', simple=False)
+def newline(vals, env, cont):
+    optional_output_port(vals, cont).write("\n")
+    return cont.plug_reduce(kt.inert)
+
+@export('flush-output-port', simple=False)
+def flush_output_port(vals, env, cont):
+    try:
+        optional_output_port(vals, cont).flush_ready()
+    except kt.WouldBlock as e:
+        return retry_when_ready('flush-output-port', e, vals, env, cont)
+    return cont.plug_reduce(kt.inert)
+
+@export('make-pipe', [])
+def make_pipe():
+    read_fd, write_fd = os.pipe()
+    return kt.Pair(kt.FileInputPort(read_fd, '<pipe>'),
+                   kt.Pair(kt.FileOutputPort(write_fd), kt.nil))
+
+# Sockets (see sockets.py).
+
+@export('open-tcp-listener', [kt.String, kt.Fixnum])
+def open_tcp_listener(host, port):
+    return sockets.open_tcp_listener(host.strval, port.fixval)
+
+@export('open-unix-listener', [kt.String])
+def open_unix_listener(path):
+    return sockets.open_unix_listener(path.strval)
+
+@export('listener-port', [sockets.Listener])
+def listener_port(listener):
+    return kt.make_fixnum(listener.port_number())
+
+@export('accept', [sockets.Listener], simple=False)
+def accept(listener, env, cont):
+    try:
+        ports = listener.accept()
+    except kt.WouldBlock as e:
+        return retry_when_ready('accept', e, kt.Pair(listener, kt.nil),
+                                env, cont)
+    return cont.plug_reduce(ports)
+
+@export('close-listener', [sockets.Listener])
+def close_listener(listener):
+    listener.close()
     return kt.inert
 
-@export('println')
-def println(val):
-    print_(val)
-    print
+@export('open-tcp-connection', [kt.String, kt.Fixnum])
+def open_tcp_connection(host, port):
+    return sockets.open_tcp_connection(host.strval, port.fixval)
+
+@export('open-unix-connection', [kt.String])
+def open_unix_connection(path):
+    return sockets.open_unix_connection(path.strval)
+
+@export('get-current-output-port', [], simple=False)
+def get_current_output_port(env, cont):
+    return cont.plug_reduce(current_output_port(cont))
+
+# Green threads (see threads.py).
+
+@export('spawn', [kt.Applicative], simple=False)
+def spawn(thunk, env, cont):
+    return cont.plug_reduce(threads.get_scheduler().spawn(thunk, cont))
+
+@export('yield', [], simple=False)
+def yield_(env, cont):
+    scheduler = threads.get_scheduler()
+    scheduler.poll_io(0)
+    if not scheduler.has_ready():
+        return cont.plug_reduce(kt.inert)
+    return scheduler.preempt(kt.inert, env, cont)
+
+@export('join', [threads.Thread], simple=False)
+def join(thread, env, cont):
+    return threads.get_scheduler().join(thread, cont)
+
+@export('current-thread', [], simple=False)
+def current_thread(env, cont):
+    return cont.plug_reduce(threads.get_scheduler().current)
+
+@export('call-with-fuel', [kt.Fixnum, kt.Applicative], simple=False)
+def call_with_fuel(fuel, combiner, env, cont):
+    scheduler = threads.get_scheduler()
+    cont = scheduler.with_fuel(threads.check_fuel(fuel), cont)
+    return kt.Pair(combiner, kt.nil), env, cont
+
+@export('make-channel', [])
+def make_channel():
+    return threads.Channel()
+
+@export('channel-send!', [threads.Channel, kt.KernelValue])
+def channel_send(channel, val):
+    threads.get_scheduler().send(channel, val)
     return kt.inert
 
+@export('channel-receive', [threads.Channel], simple=False)
+def channel_receive(channel, env, cont):
+    return threads.get_scheduler().receive(channel, cont)
+
+# Remote evaluation (see remote.py).
+
+@export('make-remote-node')
+def make_remote_node(vals):
+    address, size = remote_node_arguments(vals, 4)
+    return remote.RemoteNode(address, size)
+
+@export('spawn-remote-node')
+def spawn_remote_node(vals):
+    address, num_workers = remote_node_arguments(vals,
+                                                 parallel.worker_count())
+    return remote.spawn_node(address, num_workers)
+
+def remote_node_arguments(vals, default_size):
+    """Address and pool size (or number of workers) from (address [size])."""
+    args = kt.pythonify_list(vals)
+    if len(args) < 1 or len(args) > 2:
+        kt.signal_arity_mismatch("1 or 2", vals)
+    address = args[0]
+    kt.check_type(address, kt.String)
+    assert isinstance(address, kt.String)
+    size = default_size
+    if len(args) == 2:
+        n = args[1]
+        kt.check_type(n, kt.Fixnum)
+        assert isinstance(n, kt.Fixnum)
+        if n.fixval < 1:
+            kt.signal_value_error("Size must be positive", kt.Pair(n, kt.nil))
+        size = n.fixval
+    return address.strval, size
+
+@export('remote-eval', [kt.KernelValue, kt.Environment, remote.RemoteNode],
+        simple=False)
+def remote_eval(expr, env, node, _, cont):
+    return remote.remote_eval(expr, env, node, current_output_port(cont),
+                              cont)
+
+@export('close-remote-node', [remote.RemoteNode])
+def close_remote_node(node):
+    node.close()
+    return kt.inert
+
+# Binary serialization (see serialize.py).
+
+@export('serialize')
+def serialize_(vals):
+    args = kt.pythonify_list(vals)
+    if len(args) == 1:
+        return kt.String(serialize.serialize(args[0]))
+    elif len(args) == 2:
+        port = args[1]
+        kt.check_type(port, kt.OutputPort)
+        assert isinstance(port, kt.OutputPort)
+        port.check_open()
+        serialize.write(args[0], port)
+        return kt.inert
+    else:
+        kt.signal_arity_mismatch('1 or 2', vals)
+
+@export('deserialize', [kt.KernelValue], simple=False)
+def deserialize_(source, env, cont):
+    if isinstance(source, kt.String):
+        return cont.plug_reduce(serialize.deserialize(source.strval))
+    kt.check_type(source, kt.InputPort)
+    assert isinstance(source, kt.InputPort)
+    return input_primitive('deserialize', source, kt.Pair(source, kt.nil),
+                           env, cont)
+
+# Checkpoints (see checkpoint.py).
+
+@export('checkpoint', [kt.String], simple=False)
+def checkpoint_(path, env, cont):
+    try:
+        checkpoint.write_file(path.strval, cont)
+    except OSError:
+        kt.signal_io_error("Can't write checkpoint",
+                           kt.Pair(path, kt.nil))
+    return cont.plug_reduce(kt.false)
+
+@export('resume', [kt.String], simple=False)
+def resume(path, env, cont):
+    saved = None
+    try:
+        saved = checkpoint.read_file(path.strval, cont)
+    except OSError:
+        kt.signal_file_not_found(path.strval)
+    return kt.abnormally_pass(kt.true, cont, saved)
+
+@export('call-with-checkpoint-root', [kt.Applicative], simple=False)
+def call_with_checkpoint_root(combiner, env, cont):
+    return (kt.Pair(combiner, kt.nil),
+            env,
+            checkpoint.CheckpointRootCont(cont))
+
+# Not standard Kernel functions; for debugging only.
+
+def print_values(vals, port):
+    first = True
+    for v in kt.iter_list(vals):
+        if not first:
+            port.write(" ")
+        kt.write_value(v, port, display=True)
+        first = False
+
+@export('print', simple=False)
+def print_(vals, env, cont):
+    print_values(vals, current_output_port(cont))
+    return cont.plug_reduce(kt.inert)
+
+@export('println', simple=False)
+def println(vals, env, cont):
+    port = current_output_port(cont)
+    print_values(vals, port)
+    port.write("\n")
+    return cont.plug_reduce(kt.inert)
+
 @export('print-tb', simple=False)
 def print_tb(val, env, cont):
+    interpreter.current().stdout_port.flush()
     c = cont
     while c is not None:
         assert isinstance(c, kt.Continuation)
-        if c.source_pos is not None:
-            c.source_pos.print_()
+        if c.source_pos != kt.NO_SOURCE_POS:
+            parse.print_source_pos(c.source_pos)
         c = c.prev
     return cont.plug_reduce(kt.inert)
 
@@ -534,8 +1267,11 @@ class TestError(Exception):
 # XXX: integrate into error handling system?  start debug REPL?
 @export('test-error')
 def test_error(val):
-    print "ERROR: ",
-    println(val)
+    stdout_port = interpreter.current().stdout_port
+    stdout_port.write("ERROR:  ")
+    print_values(val, stdout_port)
+    stdout_port.write("\n")
+    stdout_port.flush()
     raise TestError(val)
     return kt.inert
 
@@ -560,11 +1296,32 @@ class AdHocCont(kt.Continuation):
         raise AdHocException(val)
 
 def kernel_eval(val, env, cont=None):
+    return interpreter.current().eval(val, env, cont)
+
+def trampoline(val, env, cont=None):
+    """Evaluate `val` in `env`, with whatever interpreter is current."""
     if cont is None:
         cont = AdHocCont(kt.root_cont)
+    scheduler = interpreter.current().scheduler
+    # Steps in this slice, and steps left before it ends and we let another
+    # green thread run and charge fuel budgets.
+    slice_steps = scheduler.slice_length(cont)
+    steps = slice_steps
     try:
         while True:
-            driver.jit_merge_point(val=val, env=env, cont=cont)
+            # Whatever value we got here by (entering an operative, plugging a
+            # continuation or switching green threads), `env` is the one it
+            # is evaluated in, so it tells us the enclosing body.
+            body = enclosing_body(env)
+            driver.jit_merge_point(val=val, body=body, env=env, cont=cont,
+                                   scheduler=scheduler, steps=steps,
+                                   slice_steps=slice_steps)
+            steps -= 1
+            if steps <= 0:
+                val, env, cont = scheduler.end_slice(slice_steps, val, env,
+                                                     cont)
+                slice_steps = scheduler.slice_length(cont)
+                steps = slice_steps
             val_, env_, cont_ = debug.on_eval(val, env, cont)
             if val_ is not None:
                 val, env, cont = val_, env_, cont_
@@ -572,22 +1329,51 @@ def kernel_eval(val, env, cont=None):
                 val, env, cont = val.interpret(env, cont)
             except kt.KernelException as e:
                 error = e.val
-                error.val = val
-                error.env = env
-                error.src_cont = cont
-                val, env, cont = kt.abnormally_pass(error, cont, e.val.dest_cont)
+                if error.src_cont is None:
+                    error.val = val
+                    error.env = env
+                    error.src_cont = cont
+                val, env, cont = kt.abnormally_pass(error,
+                                                    error.src_cont,
+                                                    error.dest_cont)
+            if isinstance(val, kt.BodyEntry):
+                # Entering an operative is the only way to loop in Kernel, so
+                # this is where we look for hot loops.
+                body = val.operative.get_body()
+                val, env, cont = kt.sequence(body, env, cont)
+                driver.can_enter_jit(val=val, body=body, env=env, cont=cont,
+                                     scheduler=scheduler, steps=steps,
+                                     slice_steps=slice_steps)
     except AdHocException as e:
         return e.val
 
-def get_printable_location(green_val):
-    if green_val is None:
-        return "No green val"
-    else:
-        return green_val.tostring()
+def enclosing_body(env):
+    """Body of the operative whose local environment `env` is, or None."""
+    if isinstance(env, kt.Frame):
+        return env.body
+    return None
 
-driver = jit.JitDriver(reds=['env', 'cont'],
-                       greens=['val'],
-                       get_printable_location=get_printable_location)
+def get_printable_location(val, body):
+    if val is None:
+        return "No green val"
+    location = parse.trace_location(val.source_pos)
+    # Only as much of the expression as we show.
+    port = kt.StringOutputPort()
+    kt.write_value(val, port, limit=61)
+    text = port.getvalue()
+    if len(text) > 60:
+        text = text[:57] + "..."
+    if body is None or body.source_pos == kt.NO_SOURCE_POS:
+        return "%s %s" % (location, text)
+    return "%s %s (in body at %s)" % (location,
+                                      text,
+                                      parse.trace_location(body.source_pos))
+
+driver = jit.JitDriver(reds=['steps', 'slice_steps', 'scheduler', 'env',
+                             'cont'],
+                       greens=['val', 'body'],
+                       get_printable_location=get_printable_location,
+                       is_recursive=True)
 
 
 def file_exists(path):
@@ -601,11 +1387,12 @@ def file_exists(path):
 def load_(path, env, cont):
     # XXX: have some programmatically editable search path?
     filename = path.strval
-    for dir_path in search_paths:
+    for dir_path in interpreter.current().search_paths:
         whole_path = rpath.rjoin(dir_path, filename)
         if file_exists(whole_path):
             try:
-                program = parse_file(whole_path)
+                program = parse_file(whole_path,
+                                     interpreter.current().source_files)
             except ParseError as e:
                 return kt.signal_parse_error(e.nice_error_message(),
                                              whole_path)
@@ -616,10 +1403,36 @@ def load_(path, env, cont):
     else:
         return kt.signal_file_not_found(filename)
 
-def parse_file(path):
-    src = open(path).read()  # XXX: RPython?
-    return kt.Pair(_ground_env.bindings['$sequence'],
-                   parse.parse(src, path))
+def parse_file(path, source_files):
+    """Program made up of the data in the file at `path`, with source
+    positions in it numbered in `source_files`."""
+    # Parse a datum at a time from a mapping of the file, so we don't need to
+    # hold a copy of the whole source in memory.
+    port = open_mapped_input_file(path)
+    try:
+        return parse_port(port, source_files.register(path))
+    finally:
+        port.close()
+
+def parse_string(text, path):
+    """Program made up of the data in `text`, like `parse_file` but without
+    source positions, since nobody keeps the text."""
+    try:
+        return parse_port(kt.StringInputPort(text, path), None)
+    except ParseError as e:
+        kt.signal_parse_error(e.nice_error_message(path), path)
+    except LexerError as e:
+        kt.signal_parse_error(e.nice_error_message(path), path)
+
+def parse_port(port, source_file):
+    exprs = []
+    while True:
+        src = port.read_datum_source()
+        if src is None:
+            break
+        exprs.append(parse.parse_datum(src, port.path, source_file,
+                                       port.datum_start))
+    return kt.Pair(_sequence, kt.kernelify_list(exprs))
 
 def check_guards(guards):
     for guard in kt.iter_list(guards):
@@ -658,7 +1471,15 @@ for cls in [kt.Boolean,
             kt.String,
             kt.Number,
             kt.Promise,
-            kt.ErrorObject]:
+            kt.ErrorObject,
+            kt.Port,
+            kt.InputPort,
+            kt.OutputPort,
+            kt.EofObject,
+            threads.Thread,
+            threads.Channel,
+            sockets.Listener,
+            remote.RemoteNode]:
     pred_name = cls.type_name + "?"
     _exports[pred_name] = make_pred(cls, pred_name)
 del pred_name, cls
@@ -666,21 +1487,23 @@ del pred_name, cls
 # Not standard Kernel and not real type predicates.
 _exports['fixnum?'] = make_pred(kt.Fixnum, 'fixnum?')
 _exports['bignum?'] = make_pred(kt.Bignum, 'bignum?')
+_exports['flonum?'] = make_pred(kt.Flonum, 'flonum?')
 
 def empty_environment():
     return kt.Environment([], {})
 
 def standard_environment():
-    return kt.Environment([_ground_env], {})
+    return interpreter.current().standard_environment()
 
 def extended_environment():
-    return kt.Environment([_extended_env], {})
+    return interpreter.current().extended_environment()
 
 _exports['root-continuation'] = kt.root_cont
 _exports['error-continuation'] = kt.error_cont
 _exports['system-error-continuation'] = kt.system_error_cont
 _exports['user-error-continuation'] = kt.user_error_cont
 _exports['file-not-found-continuation'] = kt.file_not_found_cont
+_exports['io-error-continuation'] = kt.io_error_cont
 _exports['parse-error-continuation'] = kt.parse_error_cont
 _exports['unbound-dynamic-key-continuation'] = kt.unbound_dynamic_key_cont
 _exports['unbound-static-key-continuation'] = kt.unbound_static_key_cont
@@ -695,8 +1518,20 @@ _exports['add-positive-to-negative-infinity-continuation'] = kt.add_positive_to_
 _exports['multiply-infinity-by-zero-continuation'] = kt.multiply_infinity_by_zero_cont
 _exports['divide-infinity-continuation'] = kt.divide_infinity_cont
 _exports['divide-by-zero-continuation'] = kt.divide_by_zero_cont
+_exports['deadlock-continuation'] = kt.deadlock_cont
+_exports['fuel-exhausted-continuation'] = kt.fuel_exhausted_cont
+
+_ground_bindings = _exports
+_sequence = _exports['$sequence']
 
-_ground_env = kt.Environment([], _exports)
+def make_ground_environment():
+    """Ground environment with just the primitives; each interpreter gets
+    its own and evaluates kernel.k in it."""
+    return kt.Environment([], _ground_bindings.copy())
+
+for name in ['$if', '$sequence', '$define!', '$vau', '$lambda']:
+    analyze.register_special_form(name, _exports[name])
+del name
 
 def dirname(path):
     norm = rpath.rnormpath(path)
@@ -704,15 +1539,23 @@ def dirname(path):
         norm = rpath.rjoin(".", norm)
     return norm.rsplit(rpath.sep, 1)[0]
 
-print "file si", __file__
-
 here = dirname(__file__)
 
-kernel_eval(parse_file(rpath.rjoin(here, "kernel.k")), _ground_env)
-_extended_env = kt.Environment([_ground_env], {})
-kernel_eval(parse_file(rpath.rjoin(here, "extension.k")), _extended_env)
+# Parsed once and shared by all interpreters; evaluating source never
+# mutates it.
+builtin_source_files = parse.SourceFiles()
+_kernel_program = parse_file(rpath.rjoin(here, "kernel.k"),
+                             builtin_source_files)
+_extension_program = parse_file(rpath.rjoin(here, "extension.k"),
+                                builtin_source_files)
+
+def kernel_program():
+    return _kernel_program
+
+def extension_program():
+    return _extension_program
 
 def standard_value(name):
-    return _ground_env.bindings[name]
+    return interpreter.current().standard_value(name)
 
 del _exports
@@ -0,0 +1,289 @@
+"""
+Evaluation on remote nodes.
+
+A remote node is an evaluation server (see server.py), on this host or
+reachable over TCP.  `(remote-eval expr env node)` sends `expr` to the
+node, together with the bindings in `env` of the symbols in `expr` that
+aren't bound to the same thing in the extended environment, and returns the
+value the node computes.  Both have to be plain data (see serialize.py), so
+the combiners a remote expression uses must be standard or defined by the
+expression itself.  Output is copied to the caller's current output port,
+and errors are signalled again here, to the same standard error
+continuation.
+
+We keep a pool of up to `size` connections to each node.  Requests are
+pipelined: each goes to the connection with the fewest outstanding
+requests (opening a new one if they all have some and the pool isn't full)
+without waiting for earlier replies.  Servers answer the requests on a
+connection in order, so each connection has a green thread that reads the
+replies and hands each to the thread waiting for it.  `remote-eval` only
+blocks the calling green thread, so to have several requests in flight make
+them from several threads.
+
+`spawn-remote-node` forks a server on this host from the running
+interpreter, which is handy for spreading work over local processes (and for
+testing).
+"""
+
+import os
+
+from rpython.rlib import rsignal, rsocket, rstring
+
+import kernel_type as kt
+import parallel
+import serialize
+import server
+import threads
+
+
+class RemoteNode(kt.KernelValue):
+    type_name = 'remote-node'
+    def __init__(self, address, size, pid=0, lifeline=-1,
+                 source_pos=kt.NO_SOURCE_POS):
+        self.address = address
+        self.size = size
+        self.connections = []
+        # Server process, if we forked it, and the write end of the pipe it
+        # watches to notice that we're gone.
+        self.pid = pid
+        self.lifeline = lifeline
+        self.closed = False
+        self.source_pos = source_pos
+    def check_open(self):
+        if self.closed:
+            kt.signal_io_error("Remote node is closed", kt.Pair(self, kt.nil))
+    def connection(self, cont):
+        """Connection to send the next request on."""
+        self.check_open()
+        connections = []
+        for conn in self.connections:
+            if not conn.lost:
+                connections.append(conn)
+        self.connections = connections
+        best = None
+        for conn in connections:
+            if best is None or len(conn.pending) < len(best.pending):
+                best = conn
+        if best is None or (best.pending and len(connections) < self.size):
+            best = self.connect(cont)
+        return best
+    def sockaddr(self):
+        try:
+            return server.make_address(self.address)
+        except ValueError:
+            kt.signal_value_error("Bad address",
+                                  kt.Pair(kt.String(self.address), kt.nil))
+        except rsocket.SocketError as e:
+            signal_socket_error(e, self)
+    def connect(self, cont):
+        sockaddr = self.sockaddr()
+        sock = rsocket.RSocket(sockaddr.family, rsocket.SOCK_STREAM)
+        try:
+            sock.connect(sockaddr)
+        except rsocket.SocketError as e:
+            sock.close()
+            signal_socket_error(e, self)
+        conn = Connection(sock)
+        self.connections.append(conn)
+        threads.get_scheduler().spawn(kt.Applicative(ReadReplies(conn)), cont)
+        return conn
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for conn in self.connections:
+            conn.shutdown()
+        self.connections = []
+        if self.lifeline >= 0:
+            os.close(self.lifeline)
+            self.lifeline = -1
+        if self.pid:
+            os.kill(self.pid, rsignal.SIGTERM)
+            os.waitpid(self.pid, 0)
+            if not server.is_tcp(self.address):
+                try:
+                    os.unlink(self.address)
+                except OSError:
+                    pass
+    def tostring(self):
+        return "#<remote-node %s>" % self.address
+
+class Connection(object):
+    def __init__(self, sock):
+        self.sock = sock
+        # We read through a port, so reading doesn't block other threads.
+        self.port = kt.FileInputPort(sock.fd, '<remote>')
+        # Requests sent and not answered yet, oldest first.
+        self.pending = []
+        self.lost = False
+    def send(self, data, request):
+        if self.lost:
+            kt.signal_io_error("Connection to remote node lost", kt.nil)
+        try:
+            serialize.write_record(self.sock.fd, server.REMOTE_EVAL, data)
+        except OSError:
+            kt.signal_io_error("Connection to remote node lost", kt.nil)
+        self.pending.append(request)
+    def shutdown(self):
+        """Make the reader see the end of the connection."""
+        if not self.lost:
+            try:
+                self.sock.shutdown(rsocket.SHUT_RDWR)
+            except rsocket.SocketError:
+                pass
+    def close(self):
+        """Called by the reader once the connection is over."""
+        self.lost = True
+        self.port.close()
+        # The port closed the file descriptor.
+        self.sock.detach()
+        for request in self.pending:
+            threads.get_scheduler().send(
+                    request.channel,
+                    Reply(server.ERROR, "Connection to remote node lost"))
+        self.pending = []
+
+class Request(object):
+    def __init__(self, channel, output_port):
+        self.channel = channel
+        self.output_port = output_port
+
+class Reply(kt.KernelValue):
+    """A response record, passed from the reader to the requesting thread."""
+    def __init__(self, tag, data):
+        self.tag = tag
+        self.data = data
+
+class ReadReplies(kt.Operative):
+    """Body of the thread that reads the responses on a connection."""
+    uses_dynamic_env = False
+    def __init__(self, conn):
+        self.conn = conn
+        self.source_pos = kt.NO_SOURCE_POS
+        self.name = None
+    def combine(self, operands, env, cont):
+        conn = self.conn
+        port = conn.port
+        port.begin_read()
+        try:
+            record = read_record(port)
+        except kt.WouldBlock as e:
+            port.rewind()
+            return threads.get_scheduler().wait_io(e.fd, e.events,
+                                                   self.again(env, cont))
+        except OSError:
+            record = None
+        finally:
+            port.end_read()
+        if record is None:
+            conn.close()
+            return cont.plug_reduce(kt.inert)
+        tag, data = record.tag, record.data
+        if tag == server.OUTPUT:
+            if conn.pending and not conn.pending[0].output_port.closed:
+                conn.pending[0].output_port.write(data)
+        elif conn.pending:
+            request = conn.pending.pop(0)
+            threads.get_scheduler().send(request.channel, Reply(tag, data))
+        return kt.inert, kt.Environment([]), self.again(env, cont)
+    def again(self, env, cont):
+        """Continuation that reads the next record."""
+        return kt.ConstantCont(self, kt.CombineCont(kt.nil, env, cont))
+
+def read_record(port):
+    """Like `serialize.read_record`, but reading from an input port."""
+    tag = port.read_char()
+    if tag == '':
+        return None
+    length = 0
+    for i in range(8):
+        c = port.read_char()
+        if c == '':
+            return None
+        length |= ord(c[0]) << (8 * i)
+    # The length comes off the network, so we only allocate for data as it
+    # arrives, a bounded chunk at a time.
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        size = min(remaining, 65536)
+        chunk = rstring.StringBuilder(size)
+        for i in range(size):
+            c = port.read_char()
+            if c == '':
+                return None
+            chunk.append(c)
+        chunks.append(chunk.build())
+        remaining -= size
+    return serialize.Record(tag, "".join(chunks))
+
+class ReplyCont(kt.Continuation):
+    def _plug_reduce(self, reply):
+        assert isinstance(reply, Reply)
+        if reply.tag == server.DATA:
+            return self.prev.plug_reduce(serialize.deserialize(reply.data))
+        elif reply.tag == server.ERROR_DATA:
+            parallel.signal_decoded_error(reply.data)
+        else:
+            kt.signal_io_error(reply.data, kt.nil)
+
+def remote_eval(expr, env, node, output_port, cont):
+    data = server.encode_remote_request(expr, needed_bindings(expr, env))
+    channel = threads.Channel()
+    node.connection(cont).send(data, Request(channel, output_port))
+    return threads.get_scheduler().receive(channel, ReplyCont(cont))
+
+def needed_bindings(expr, env):
+    """List of (symbol . value) with the bindings in `env` of the symbols in
+    `expr` that the remote node doesn't have."""
+    import interpreter
+    standard = interpreter.current().extended_env
+    seen = {}
+    bindings = kt.nil
+    pending = [expr]
+    while pending:
+        val = pending.pop()
+        if isinstance(val, kt.Pair):
+            pending.append(val.cdr)
+            pending.append(val.car)
+        elif isinstance(val, kt.Symbol) and val.symval not in seen:
+            seen[val.symval] = None
+            value = env.lookup_unchecked(val)
+            if value is not None and standard.lookup_unchecked(val) is not value:
+                bindings = kt.Pair(kt.Pair(val, value), bindings)
+    return bindings
+
+def spawn_node(address, num_workers):
+    """Fork a server at `address` from the current interpreter."""
+    import interpreter
+    sock = listen(address)
+    interpreter.current().stdout_port.flush()
+    # The server exits when this pipe is closed, so it doesn't outlive us
+    # if we never get to close the node.
+    lifeline, keeper = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(keeper)
+            server.serve_socket(interpreter.current(), sock, num_workers,
+                                parent=lifeline)
+            if not server.is_tcp(address):
+                try:
+                    os.unlink(address)
+                except OSError:
+                    pass
+        finally:
+            os._exit(0)
+    os.close(lifeline)
+    sock.close()
+    return RemoteNode(address, num_workers, pid, keeper)
+
+def listen(address):
+    try:
+        return server.listen(address)
+    except (OSError, ValueError, rsocket.SocketError):
+        kt.signal_io_error("Can't listen at address",
+                           kt.Pair(kt.String(address), kt.nil))
+
+def signal_socket_error(e, node):
+    kt.signal_io_error(e.get_msg(), kt.Pair(node, kt.nil))
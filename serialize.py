@@ -0,0 +1,371 @@
+"""
+Binary encoding of Kernel data.
+
+Used to pass values between processes (see parallel.py) and exposed to
+Kernel code as `serialize` and `deserialize`.  Only plain data can be
+encoded: numbers, strings, symbols, booleans, #inert, #ignore, () and pairs
+of those.
+
+A serialized value is a two-byte header (MAGIC and VERSION) followed by the
+value.  Every value starts with a one-byte tag.  Integers and lengths are
+LEB128 varints (fixnums zigzag-encoded first), so small numbers take a byte.
+
+Substructure is shared: each pair, string, bignum and symbol name is given
+the next number the first time it's written, and later occurrences are
+written as a reference to that number, so `eq?`-ness survives the round
+trip.  Pairs are immutable, so shared structure can't be cyclic; objects are
+numbered once they are complete, which is when the decoder can build them.
+
+Values are written straight to an output port as they are encoded, so big
+values don't need to be built up in memory first.  If we find something we
+can't encode halfway through, whatever we had written stays in the port.
+"""
+
+import os
+
+from rpython.rlib import rstring
+from rpython.rlib.rarithmetic import LONG_BIT, intmask, r_uint, r_ulonglong
+from rpython.rlib.rbigint import rbigint
+from rpython.rlib.rstruct import ieee
+
+import kernel_type as kt
+
+
+MAGIC = 'K'
+VERSION = '\x01'
+
+NIL = 'n'
+INERT = 'i'
+IGNORE = 'g'
+TRUE = 't'
+FALSE = 'f'
+FIXNUM = 'x'
+BIGNUM = 'b'
+FLONUM = 'd'
+E_POS_INF = '+'
+E_NEG_INF = '-'
+STRING = 's'
+SYMBOL = 'y'
+PAIR = 'p'
+REF = 'r'
+
+class Encoder(object):
+    def __init__(self, port):
+        self.port = port
+        # Numbers of the objects we've written so far.
+        self.numbers = {}
+        self.symbol_numbers = {}
+        self.count = 0
+    def write_uint(self, u):
+        u = r_uint(u)
+        s = rstring.StringBuilder()
+        while u >= 0x80:
+            s.append(chr(intmask(u & 0x7f) | 0x80))
+            u >>= 7
+        s.append(chr(intmask(u)))
+        self.port.write(s.build())
+    def write_int(self, n):
+        u = (r_uint(n) << 1) ^ r_uint(n >> (LONG_BIT - 1))
+        self.write_uint(intmask(u))
+    def write_str(self, s):
+        self.write_uint(len(s))
+        self.port.write(s)
+    def remember(self, val):
+        self.numbers[val] = self.count
+        self.count += 1
+    def write_ref(self, val):
+        """Write a reference to `val` if we've written it already."""
+        if isinstance(val, kt.Symbol):
+            number = self.symbol_numbers.get(val.symval, -1)
+        else:
+            number = self.numbers.get(val, -1)
+        if number == -1:
+            return False
+        self.port.write(REF)
+        self.write_uint(number)
+        return True
+    def encode(self, val):
+        # Walk lists along their cdrs, and keep the pairs of the lists we're
+        # in the middle of in an explicit stack while we do their cars, so
+        # neither long nor deeply nested values eat native stack.  The pairs
+        # of each list are complete (and get their numbers) from the last
+        # one back, once we reach its end.
+        pending = []
+        pairs = []
+        while True:
+            if not self.write_ref(val):
+                if isinstance(val, kt.Pair):
+                    self.port.write(PAIR)
+                    pairs.append(val)
+                    pending.append(pairs)
+                    pairs = []
+                    val = val.car
+                    continue
+                self.encode_atom(val)
+            for i in range(len(pairs) - 1, -1, -1):
+                self.remember(pairs[i])
+            if not pending:
+                return
+            pairs = pending.pop()
+            val = pairs[-1].cdr
+    def encode_atom(self, val):
+        if isinstance(val, kt.Null):
+            self.port.write(NIL)
+        elif isinstance(val, kt.Inert):
+            self.port.write(INERT)
+        elif isinstance(val, kt.Ignore):
+            self.port.write(IGNORE)
+        elif isinstance(val, kt.Boolean):
+            self.port.write(TRUE if val.bval else FALSE)
+        elif isinstance(val, kt.Fixnum):
+            self.port.write(FIXNUM)
+            self.write_int(val.fixval)
+        elif isinstance(val, kt.Bignum):
+            self.port.write(BIGNUM)
+            nbytes = val.bigval.abs().bit_length() // 8 + 1
+            self.write_str(val.bigval.tobytes(nbytes, 'little', True))
+            self.remember(val)
+        elif isinstance(val, kt.Flonum):
+            self.port.write(FLONUM)
+            bits = ieee.float_pack(val.floval, 8)
+            s = rstring.StringBuilder(8)
+            for i in range(8):
+                s.append(chr(intmask(bits & 0xff)))
+                bits >>= 8
+            self.port.write(s.build())
+        elif isinstance(val, kt.ExactPositiveInfinity):
+            self.port.write(E_POS_INF)
+        elif isinstance(val, kt.ExactNegativeInfinity):
+            self.port.write(E_NEG_INF)
+        elif isinstance(val, kt.String):
+            self.port.write(STRING)
+            self.write_str(val.strval)
+            self.remember(val)
+        elif isinstance(val, kt.Symbol):
+            self.port.write(SYMBOL)
+            self.write_str(val.symval)
+            self.symbol_numbers[val.symval] = self.count
+            self.count += 1
+        else:
+            kt.signal_value_error("Can't serialize value",
+                                  kt.Pair(val, kt.nil))
+
+class Decoder(object):
+    """Subclasses say where the bytes come from."""
+    def __init__(self):
+        self.objects = []
+    def read_byte(self):
+        """Next byte, or the empty string at the end of the input."""
+        raise NotImplementedError
+    def read_bytes(self, n):
+        # `n` comes from the input, so don't trust it to size the buffer.
+        s = rstring.StringBuilder(min(n, 4096))
+        for i in range(n):
+            s.append(self.read_tag())
+        return s.build()
+    def read_tag(self):
+        c = self.read_byte()
+        if c == '':
+            signal_malformed()
+        return c
+    def read_uint(self):
+        u = r_uint(0)
+        shift = 0
+        while True:
+            if shift >= LONG_BIT:
+                signal_malformed()
+            byte = ord(self.read_tag()[0])
+            u |= r_uint(byte & 0x7f) << shift
+            if byte < 0x80:
+                return u
+            shift += 7
+    def read_int(self):
+        u = self.read_uint()
+        return intmask((u >> 1) ^ (r_uint(0) - (u & 1)))
+    def read_length(self):
+        n = intmask(self.read_uint())
+        if n < 0:
+            signal_malformed()
+        return n
+    def read_str(self):
+        return self.read_bytes(self.read_length())
+    def decode_header(self):
+        """Read a header, and return False if we're at the end of the input
+        instead."""
+        c = self.read_byte()
+        if c == '':
+            return False
+        if c != MAGIC or self.read_tag() != VERSION:
+            signal_malformed()
+        return True
+    def decode(self):
+        # The mirror image of Encoder.encode: `cars` are those of the list
+        # we're reading, and `pending` those of the lists whose cars we're
+        # in the middle of.
+        pending = []
+        cars = []
+        while True:
+            tag = self.read_tag()
+            if tag == PAIR:
+                pending.append(cars)
+                cars = []
+                continue
+            val = self.decode_atom(tag)
+            for i in range(len(cars) - 1, -1, -1):
+                val = kt.Pair(cars[i], val)
+                self.objects.append(val)
+            if not pending:
+                return val
+            cars = pending.pop()
+            cars.append(val)
+    def decode_atom(self, tag):
+        if tag == NIL:
+            return kt.nil
+        elif tag == INERT:
+            return kt.inert
+        elif tag == IGNORE:
+            return kt.ignore
+        elif tag == TRUE:
+            return kt.true
+        elif tag == FALSE:
+            return kt.false
+        elif tag == FIXNUM:
+            return kt.make_fixnum(self.read_int())
+        elif tag == BIGNUM:
+            val = kt.try_and_make_fixnum(
+                    rbigint.frombytes(self.read_str(), 'little', True))
+            self.objects.append(val)
+            return val
+        elif tag == FLONUM:
+            s = self.read_bytes(8)
+            bits = r_ulonglong(0)
+            for i in range(7, -1, -1):
+                bits = (bits << 8) | r_ulonglong(ord(s[i]))
+            return kt.Flonum(ieee.float_unpack(bits, 8))
+        elif tag == E_POS_INF:
+            return kt.e_pos_inf
+        elif tag == E_NEG_INF:
+            return kt.e_neg_inf
+        elif tag == STRING:
+            val = kt.String(self.read_str())
+            self.objects.append(val)
+            return val
+        elif tag == SYMBOL:
+            val = kt.Symbol(self.read_str())
+            self.objects.append(val)
+            return val
+        elif tag == REF:
+            number = self.read_length()
+            if number >= len(self.objects):
+                signal_malformed()
+            return self.objects[number]
+        else:
+            signal_malformed()
+
+class StringDecoder(Decoder):
+    def __init__(self, data):
+        Decoder.__init__(self)
+        self.data = data
+        self.pos = 0
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            return ''
+        c = self.data[self.pos]
+        self.pos += 1
+        return c
+    def read_bytes(self, n):
+        start = self.pos
+        stop = start + n
+        if stop > len(self.data):
+            signal_malformed()
+        assert start >= 0 and stop >= 0
+        self.pos = stop
+        return self.data[start:stop]
+    def at_end(self):
+        return self.pos >= len(self.data)
+
+class PortDecoder(Decoder):
+    def __init__(self, port):
+        Decoder.__init__(self)
+        self.port = port
+    def read_byte(self):
+        return self.port.read_char()
+
+def signal_malformed():
+    kt.signal_value_error("Malformed serialized data", kt.nil)
+
+def write(val, port):
+    """Serialize `val` into an output port."""
+    port.write(MAGIC)
+    port.write(VERSION)
+    Encoder(port).encode(val)
+
+def read(port):
+    """Deserialize the next value from an input port, or return None at end
+    of file."""
+    decoder = PortDecoder(port)
+    if not decoder.decode_header():
+        return None
+    return decoder.decode()
+
+def serialize(val):
+    port = kt.StringOutputPort()
+    write(val, port)
+    return port.getvalue()
+
+def deserialize(data):
+    decoder = StringDecoder(data)
+    if not decoder.decode_header():
+        signal_malformed()
+    val = decoder.decode()
+    if not decoder.at_end():
+        signal_malformed()
+    return val
+
+# Streams of tagged records over file descriptors, for passing serialized
+# data (or anything else) between processes.  A record is a one-byte tag,
+# the length of the data as 8 little-endian bytes, and the data.
+
+def write_record(fd, tag, data):
+    header = rstring.StringBuilder(9)
+    header.append(tag)
+    length = len(data)
+    for i in range(8):
+        header.append(chr(length & 0xff))
+        length >>= 8
+    write_all(fd, header.build())
+    write_all(fd, data)
+
+def write_all(fd, data):
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+class Record(object):
+    def __init__(self, tag, data):
+        self.tag = tag
+        self.data = data
+
+def read_record(fd):
+    """Next `Record` in `fd`, or None at end of file."""
+    header = read_exactly(fd, 9)
+    if header is None:
+        return None
+    length = 0
+    for i in range(8, 0, -1):
+        length = (length << 8) | ord(header[i])
+    data = read_exactly(fd, length)
+    if data is None:
+        return None
+    return Record(header[0], data)
+
+def read_exactly(fd, size):
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        chunk = os.read(fd, min(remaining, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return "".join(chunks)
@@ -0,0 +1,409 @@
+"""
+Evaluation server.
+
+Starting an interpreter means evaluating kernel.k and extension.k, which
+takes much longer than running a small script.  `interpret.py --serve
+ADDRESS` does that once, and then serves evaluation requests at ADDRESS
+(HOST:PORT for TCP, or the path of a Unix domain socket); `interpret.py
+--client ADDRESS ...` sends them.
+
+After initializing, the server forks a number of workers, which inherit the
+initialized interpreter and take turns accepting connections.  A connection
+carries any number of requests, one after the other.  Workers serve the
+requests on all the connections they've accepted, one at a time, so clients
+may keep connections open without starving each other.  Each request is
+evaluated in a fresh environment that inherits from the extended
+environment, with its own green thread scheduler, so requests don't see each
+other's definitions.  The output of the program is streamed back to the
+client as it's flushed, followed by the result.  With `--fuel N`, a request
+that takes more than N trampoline steps fails with a fuel exhausted error,
+so runaway programs don't keep a worker busy forever.  If a worker dies, the
+server starts another one.
+
+Requests and responses are records (see `serialize.write_record`):
+
+    request:   EVAL_TEXT program text | EVAL_FILE path | STATS
+    response:  OUTPUT text ... (VALUE text | ERROR text)
+
+    request:   REMOTE_EVAL serialized (expr . ((symbol . value) ...))
+    response:  OUTPUT text ... (DATA serialized value | ERROR_DATA error)
+
+where the VALUE text is the external representation of the value of the
+program.  REMOTE_EVAL requests come from remote.py: the expression is
+evaluated with the given bindings added to its environment, and errors are
+encoded with `parallel.encode_error`.  STATS is answered with a VALUE with request latency figures for
+all the workers since the server started.  Workers keep their figures in
+slots of a memory mapping shared with the others.
+"""
+
+import os
+import stat
+import time
+
+from rpython.rlib import rmmap, rpoll, rsocket, rstring
+
+import kernel_type as kt
+import serialize
+
+
+EVAL_TEXT = 'e'
+EVAL_FILE = 'f'
+STATS = 's'
+REMOTE_EVAL = 'r'
+OUTPUT = 'o'
+VALUE = 'v'
+ERROR = 'x'
+DATA = 'd'
+ERROR_DATA = 'z'
+
+class Metrics(object):
+    """Request counts and latencies, in a slot per worker.  Slots are made
+    up of 8-byte fields: requests, errors, total and maximum latency in
+    microseconds, and a latency histogram where bucket i counts requests
+    that took less than 2**(i + 6) microseconds (the last one counts the
+    rest)."""
+    REQUESTS = 0
+    ERRORS = 1
+    TOTAL_US = 2
+    MAX_US = 3
+    BUCKETS = 4
+    NUM_BUCKETS = 20
+    NUM_FIELDS = BUCKETS + NUM_BUCKETS
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        # Anonymous shared mapping, so workers forked later share it.
+        self.map = rmmap.mmap(-1, num_slots * Metrics.NUM_FIELDS * 8,
+                              flags=rmmap.MAP_SHARED)
+    def offset(self, slot, field):
+        return (slot * Metrics.NUM_FIELDS + field) * 8
+    def get(self, slot, field):
+        offset = self.offset(slot, field)
+        n = 0
+        for i in range(7, -1, -1):
+            n = (n << 8) | ord(self.map.getitem(offset + i))
+        return n
+    def set(self, slot, field, n):
+        offset = self.offset(slot, field)
+        for i in range(8):
+            self.map.setitem(offset + i, chr(n & 0xff))
+            n >>= 8
+    def add(self, slot, field, n):
+        self.set(slot, field, self.get(slot, field) + n)
+    def record(self, slot, latency_us, error):
+        self.add(slot, Metrics.REQUESTS, 1)
+        if error:
+            self.add(slot, Metrics.ERRORS, 1)
+        self.add(slot, Metrics.TOTAL_US, latency_us)
+        if latency_us > self.get(slot, Metrics.MAX_US):
+            self.set(slot, Metrics.MAX_US, latency_us)
+        bucket = 0
+        while (bucket < Metrics.NUM_BUCKETS - 1
+               and latency_us >= 1 << (bucket + 6)):
+            bucket += 1
+        self.add(slot, Metrics.BUCKETS + bucket, 1)
+    def total(self, field):
+        n = 0
+        for slot in range(self.num_slots):
+            n += self.get(slot, field)
+        return n
+    def percentile_us(self, percent):
+        """Upper bound of the latency under which `percent` percent of the
+        requests were served."""
+        requests = self.total(Metrics.REQUESTS)
+        count = 0
+        for bucket in range(Metrics.NUM_BUCKETS - 1):
+            count += self.total(Metrics.BUCKETS + bucket)
+            if count * 100 >= requests * percent:
+                return 1 << (bucket + 6)
+        return self.total(Metrics.MAX_US)
+    def report(self):
+        requests = self.total(Metrics.REQUESTS)
+        mean = 0
+        if requests > 0:
+            mean = self.total(Metrics.TOTAL_US) // requests
+        max_ = 0
+        for slot in range(self.num_slots):
+            max_ = max(max_, self.get(slot, Metrics.MAX_US))
+        return ("workers %d\nrequests %d\nerrors %d\nmean-us %d\n"
+                "p50-us %d\np99-us %d\nmax-us %d\n"
+                % (self.num_slots, requests, self.total(Metrics.ERRORS), mean,
+                   self.percentile_us(50), self.percentile_us(99), max_))
+
+class ConnectionOutputPort(kt.FileOutputPort):
+    """Output port that sends what's flushed as OUTPUT records."""
+    def flush(self):
+        if self.buf.getlength() == 0:
+            return
+        data = self.buf.build()
+        self.buf = rstring.StringBuilder(self.buffer_size)
+        serialize.write_record(self.fd, OUTPUT, data)
+    def flush_ready(self):
+        self.flush()
+    def close(self):
+        # The connection isn't ours to close.
+        if not self.closed:
+            self.flush()
+            self.closed = True
+
+def is_tcp(address):
+    return address.find('/') == -1 and address.rfind(':') > 0
+
+def make_address(address):
+    """Socket address for a "HOST:PORT" or a Unix domain socket path.  May
+    raise ValueError or rsocket.SocketError."""
+    if is_tcp(address):
+        colon = address.rfind(':')
+        assert colon > 0
+        return rsocket.INETAddress(address[:colon], int(address[colon + 1:]))
+    return rsocket.UNIXAddress(address)
+
+def listen(address):
+    """Listening socket at `address`.  May raise OSError, ValueError or
+    rsocket.SocketError."""
+    sockaddr = make_address(address)
+    if not is_tcp(address):
+        try:
+            if stat.S_ISSOCK(os.stat(address).st_mode):
+                # Left behind by a server that was killed.
+                os.unlink(address)
+        except OSError:
+            pass
+    sock = rsocket.RSocket(sockaddr.family, rsocket.SOCK_STREAM)
+    try:
+        if is_tcp(address):
+            sock.setsockopt_int(rsocket.SOL_SOCKET, rsocket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+        sock.listen(128)
+        # Workers poll before accepting, but another one may beat them to it.
+        sock.setblocking(False)
+    except rsocket.SocketError:
+        sock.close()
+        raise
+    return sock
+
+def serve(interp, address, num_workers, fuel=0):
+    """Serve requests at `address` forever.  If `fuel` is positive, requests
+    that take more trampoline steps than that fail."""
+    try:
+        sock = listen(address)
+    except (OSError, ValueError, rsocket.SocketError):
+        os.write(2, "Can't listen at %s\n" % address)
+        return 1
+    serve_socket(interp, sock, num_workers, fuel)
+    return 0
+
+def serve_socket(interp, sock, num_workers, fuel=0, parent=-1):
+    """Serve requests on `sock` with `num_workers` worker processes.  If
+    `parent` is a file descriptor, we stop once it becomes readable, which
+    happens when the process holding its write end goes away."""
+    metrics = Metrics(num_workers)
+    # Workers notice that we're gone when this pipe is closed.
+    lifeline, keeper = os.pipe()
+    interp.stdout_port.flush()
+    pids = [0] * num_workers
+    for slot in range(num_workers):
+        pids[slot] = start_worker(interp, sock, lifeline, keeper, parent,
+                                  metrics, slot, fuel)
+    running = num_workers
+    while running > 0:
+        pid, status = os.waitpid(-1, 0)
+        if pid in pids:
+            slot = pids.index(pid)
+            if parent >= 0 and is_readable(parent):
+                # Workers watch `parent` too, so they are all on their way.
+                pids[slot] = 0
+                running -= 1
+            else:
+                pids[slot] = start_worker(interp, sock, lifeline, keeper,
+                                          parent, metrics, slot, fuel)
+    sock.close()
+
+def is_readable(fd):
+    try:
+        return len(rpoll.poll({fd: rpoll.POLLIN}, 0)) > 0
+    except rpoll.PollError:
+        return False
+
+def start_worker(interp, sock, lifeline, keeper, parent, metrics, slot, fuel):
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(keeper)
+            Worker(interp, sock, lifeline, parent, metrics, slot, fuel).run()
+        finally:
+            os._exit(0)
+    return pid
+
+class Worker(object):
+    def __init__(self, interp, sock, lifeline, parent, metrics, slot, fuel):
+        self.interp = interp
+        self.sock = sock
+        self.lifeline = lifeline
+        # The server's own lifeline, if it has one.
+        self.parent = parent
+        self.metrics = metrics
+        self.slot = slot
+        # Steps a request may take, if positive.
+        self.fuel = fuel
+    def run(self):
+        # Connections we have accepted and not seen the end of.
+        connections = []
+        while True:
+            fds = {self.sock.fd: rpoll.POLLIN, self.lifeline: rpoll.POLLIN}
+            if self.parent >= 0:
+                fds[self.parent] = rpoll.POLLIN
+            for fd in connections:
+                fds[fd] = rpoll.POLLIN
+            try:
+                ready = rpoll.poll(fds, -1)
+            except rpoll.PollError:
+                continue
+            for fd, events in ready:
+                if fd == self.lifeline or fd == self.parent:
+                    # The server, or the process that spawned it, is gone.
+                    for fd in connections:
+                        os.close(fd)
+                    return
+                elif fd == self.sock.fd:
+                    try:
+                        new_fd, address = self.sock.accept()
+                    except rsocket.SocketError:
+                        continue
+                    connections.append(new_fd)
+                elif not self.serve_request(fd):
+                    connections.remove(fd)
+                    os.close(fd)
+    def serve_request(self, fd):
+        """Serve the next request on a connection, and return whether there
+        may be more."""
+        try:
+            record = serialize.read_record(fd)
+            if record is None:
+                return False
+            tag, data = record.tag, record.data
+            if tag == STATS:
+                serialize.write_record(fd, VALUE, self.metrics.report())
+            else:
+                self.serve_eval(fd, tag, data)
+        except OSError:
+            # The client went away.
+            return False
+        return True
+    def serve_eval(self, fd, tag, data):
+        start = time.time()
+        tag, data = self.eval_request(fd, tag, data)
+        serialize.write_record(fd, tag, data)
+        latency_us = int((time.time() - start) * 1000000)
+        self.metrics.record(self.slot, latency_us,
+                            tag == ERROR or tag == ERROR_DATA)
+    def eval_request(self, fd, tag, data):
+        """(response tag, data) for an evaluation request."""
+        import analyze
+        import interpreter
+        import parallel
+        import primitive
+        import threads
+        interp = self.interp
+        interp.scheduler = threads.Scheduler()
+        remote = tag == REMOTE_EVAL
+        port = ConnectionOutputPort(fd)
+        try:
+            try:
+                env = interp.extended_environment()
+                if tag == EVAL_FILE:
+                    program = primitive.parse_file(data, interp.source_files)
+                elif tag == EVAL_TEXT:
+                    program = primitive.parse_string(data, '<request>')
+                elif remote:
+                    program = decode_remote_request(data, env)
+                else:
+                    return ERROR, "Unknown request"
+                if interp.analysis.enabled:
+                    program = analyze.analyze(program)
+                val = interp.eval_contained(
+                        program,
+                        env,
+                        primitive.output_port_binding(port, kt.root_cont),
+                        self.fuel)
+                if remote:
+                    return DATA, serialize.serialize(val)
+                return VALUE, external_representation(val)
+            except interpreter.Escape as e:
+                error = e.val
+            except kt.KernelException as e:
+                error = e.val
+        finally:
+            port.close()
+        if remote:
+            return ERROR_DATA, parallel.encode_error(error)
+        return ERROR, error_text(error)
+
+def encode_remote_request(expr, bindings):
+    """Data of a REMOTE_EVAL request to evaluate `expr` with `bindings`, a
+    list of (symbol . value) pairs."""
+    return serialize.serialize(kt.Pair(expr, bindings))
+
+def decode_remote_request(data, env):
+    """Expression of a REMOTE_EVAL request, after adding its bindings to
+    `env`."""
+    request = serialize.deserialize(data)
+    if not isinstance(request, kt.Pair):
+        kt.signal_value_error("Malformed remote request", kt.nil)
+    for binding in kt.iter_list(request.cdr):
+        if not isinstance(binding, kt.Pair):
+            kt.signal_value_error("Malformed remote request", kt.nil)
+        kt.check_type(binding.car, kt.Symbol)
+        env.set(binding.car, binding.cdr)
+    return request.car
+
+def external_representation(val):
+    port = kt.StringOutputPort()
+    kt.write_value(val, port)
+    return port.getvalue()
+
+def error_text(val):
+    if not isinstance(val, kt.ErrorObject):
+        return ("Continuation escaped from request: %s"
+                % external_representation(val))
+    port = kt.StringOutputPort()
+    port.write(val.message.strval)
+    for irritant in kt.iter_list(val.irritants):
+        port.write(" ")
+        kt.write_value(irritant, port)
+    return port.getvalue()
+
+def request(address, tag, data, print_value):
+    """Send a request to the server at `address`, copy its output to stdout,
+    and print the resulting value if `print_value` or the error message.
+    Return the exit status for the client."""
+    try:
+        sockaddr = make_address(address)
+    except (ValueError, rsocket.SocketError):
+        os.write(2, "Bad address: %s\n" % address)
+        return 1
+    sock = rsocket.RSocket(sockaddr.family, rsocket.SOCK_STREAM)
+    try:
+        sock.connect(sockaddr)
+    except rsocket.SocketError as e:
+        sock.close()
+        os.write(2, "Can't connect to %s: %s\n" % (address, e.get_msg()))
+        return 1
+    try:
+        serialize.write_record(sock.fd, tag, data)
+        while True:
+            record = serialize.read_record(sock.fd)
+            if record is None:
+                os.write(2, "Server closed the connection\n")
+                return 1
+            tag, text = record.tag, record.data
+            if tag == OUTPUT:
+                serialize.write_all(1, text)
+            elif tag == VALUE:
+                if print_value:
+                    serialize.write_all(1, text + "\n")
+                return 0
+            else:
+                serialize.write_all(2, text + "\n")
+                return 1
+    finally:
+        sock.close()
@@ -0,0 +1,134 @@
+"""
+Stream sockets, TCP and Unix domain.
+
+A connection is a pair of ports on the same socket: a FileInputPort and a
+SocketOutputPort, each with its own file descriptor so they can be closed
+independently.  Closing the output port shuts the connection down for
+writing, which the other end reads as end of file.
+
+Reading, flushing and accepting connections only block the green thread
+that does them (see threads.py).  Connecting blocks the whole interpreter,
+which for local addresses is never for long.
+"""
+
+import os
+
+from rpython.rlib import rpoll, rsocket
+
+import kernel_type as kt
+
+
+class Listener(kt.KernelValue):
+    type_name = 'listener'
+    def __init__(self, sock, path, source_pos=kt.NO_SOURCE_POS):
+        self.sock = sock
+        # Socket file we created, for Unix domain sockets.
+        self.path = path
+        self.closed = False
+        self.source_pos = source_pos
+    def check_open(self):
+        if self.closed:
+            kt.signal_io_error("Listener is closed", kt.Pair(self, kt.nil))
+    def accept(self):
+        """(input-port output-port) of the next connection, or raise
+        WouldBlock if there's none yet."""
+        self.check_open()
+        if not kt.fd_ready(self.sock.fd, rpoll.POLLIN):
+            raise kt.WouldBlock(self.sock.fd, rpoll.POLLIN)
+        fd = -1
+        try:
+            fd, address = self.sock.accept()
+        except rsocket.SocketError as e:
+            signal_socket_error(e, self)
+        return connection_ports(
+                rsocket.make_socket(fd, self.sock.family, self.sock.type,
+                                    self.sock.proto),
+                self.name())
+    def port_number(self):
+        self.check_open()
+        if self.path is not None:
+            kt.signal_value_error("Not a TCP listener", kt.Pair(self, kt.nil))
+        address = self.sock.getsockname()
+        assert isinstance(address, rsocket.INETAddress)
+        return address.get_port()
+    def name(self):
+        if self.path is not None:
+            return self.path
+        return '<tcp>'
+    def close(self):
+        if not self.closed:
+            self.sock.close()
+            if self.path is not None:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+            self.closed = True
+    def tostring(self):
+        return "#<listener %s>" % self.name()
+
+class SocketOutputPort(kt.FileOutputPort):
+    def __init__(self, sock, source_pos=kt.NO_SOURCE_POS):
+        kt.FileOutputPort.__init__(self, sock.fd, source_pos=source_pos)
+        self.sock = sock
+    def close(self):
+        if not self.closed:
+            self.flush()
+            try:
+                self.sock.shutdown(rsocket.SHUT_WR)
+            except rsocket.SocketError:
+                # The other end is gone already.
+                pass
+            self.sock.close()
+            self.closed = True
+
+def connection_ports(sock, name):
+    in_port = kt.FileInputPort(os.dup(sock.fd), name)
+    return kt.Pair(in_port, kt.Pair(SocketOutputPort(sock), kt.nil))
+
+def signal_socket_error(e, irritant):
+    kt.signal_io_error(e.get_msg(), kt.Pair(irritant, kt.nil))
+
+def tcp_address(host, port):
+    try:
+        return rsocket.INETAddress(host, port)
+    except rsocket.SocketError as e:
+        signal_socket_error(e, kt.String(host))
+
+def listen(sock, address, irritant):
+    try:
+        sock.bind(address)
+        sock.listen(128)
+    except rsocket.SocketError as e:
+        sock.close()
+        signal_socket_error(e, irritant)
+
+def connect(sock, address, irritant):
+    try:
+        sock.connect(address)
+    except rsocket.SocketError as e:
+        sock.close()
+        signal_socket_error(e, irritant)
+
+def open_tcp_listener(host, port):
+    address = tcp_address(host, port)
+    sock = rsocket.RSocket(rsocket.AF_INET, rsocket.SOCK_STREAM)
+    sock.setsockopt_int(rsocket.SOL_SOCKET, rsocket.SO_REUSEADDR, 1)
+    listen(sock, address, kt.String(host))
+    return Listener(sock, None)
+
+def open_unix_listener(path):
+    sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+    listen(sock, rsocket.UNIXAddress(path), kt.String(path))
+    return Listener(sock, path)
+
+def open_tcp_connection(host, port):
+    address = tcp_address(host, port)
+    sock = rsocket.RSocket(rsocket.AF_INET, rsocket.SOCK_STREAM)
+    connect(sock, address, kt.String(host))
+    return connection_ports(sock, '<tcp>')
+
+def open_unix_connection(path):
+    sock = rsocket.RSocket(rsocket.AF_UNIX, rsocket.SOCK_STREAM)
+    connect(sock, rsocket.UNIXAddress(path), kt.String(path))
+    return connection_ports(sock, path)
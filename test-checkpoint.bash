@@ -0,0 +1,33 @@
+#!/usr/bin/env bash
+
+# Save a checkpoint with test-checkpoint.k and resume it with
+# `interpret.py --resume` in a fresh process, evaluating with the tree
+# walker, analyzed code and the VM in turn.
+
+dir=$(dirname $0)
+failed=0
+
+check() {
+    output=$($dir/interpret.py $1 $dir/test-checkpoint.k 2> /dev/null < /dev/null)
+    if [ "$output" != '("caught" ((1 10 #t #f) (2 20 #t #f) (3 30 #t #f)))' ]; then
+        echo "saving with options '$1' printed:"
+        echo "$output"
+        failed=1
+    fi
+    output=$($dir/interpret.py $1 --resume test-resume.tmp 2> /dev/null < /dev/null)
+    if [ "$output" != '("caught" ((1 10 #t #f) (2 20 #t #t) (3 30 #t #f)))' ]; then
+        echo "resuming with options '$1' printed:"
+        echo "$output"
+        failed=1
+    fi
+    rm -f test-resume.tmp
+}
+
+check ""
+check --analyze
+check --vm
+
+if [ $failed -ne 0 ]; then
+    exit 1
+fi
+echo "checkpoints ok"
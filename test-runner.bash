@@ -0,0 +1,35 @@
+#!/usr/bin/env bash
+
+# Run test-runner-fixture.k through `interpret.py --run-tests` and check the
+# status it reports for each test, and its own exit status.
+
+dir=$(dirname $0)
+report=$($dir/interpret.py --run-tests --jobs 2 \
+             $dir/test-runner-fixture.k 2> /dev/null)
+status=$?
+failed=0
+
+expect() {
+    if ! echo "$report" \
+            | grep -q "\"name\": \"$1\", \"line\": $2, \"status\": \"$3\""; then
+        echo "expected \"$1\" at line $2 to be reported as $3"
+        failed=1
+    fi
+}
+
+expect "passes" 10 pass
+expect "fails" 12 fail
+expect "signals an error" 14 error
+expect "set up at line 16" 16 error
+expect "runs after a failing set up" 18 pass
+
+if [ $status -ne 1 ]; then
+    echo "expected exit status 1, got $status"
+    failed=1
+fi
+
+if [ $failed -ne 0 ]; then
+    echo "$report"
+    exit 1
+fi
+echo "test runner ok"
@@ -0,0 +1,33 @@
+#!/usr/bin/env bash
+
+# Step through test-stepping.k in the debugger and check that evaluating
+# each operand is shown, including the symbols that are evaluated without a
+# trip through the trampoline when we aren't stepping.
+
+dir=$(dirname $0)
+output=$(yes ,s | head -n 200 | $dir/interpret.py $dir/test-stepping.k 2>&1)
+failed=0
+
+expect() {
+    if ! echo "$output" | grep -q "test-stepping.k, line $1, column $2:"; then
+        echo "expected evaluation at line $1, column $2 to be shown"
+        failed=1
+    fi
+}
+
+# x, (+ x 1), the x in it, and y in (println (list x (+ x 1) y)).
+expect 5 16
+expect 5 18
+expect 5 21
+expect 5 26
+
+if ! echo "$output" | grep -q "^(1 2 3)$"; then
+    echo "expected (1 2 3) to be printed"
+    failed=1
+fi
+
+if [ $failed -ne 0 ]; then
+    echo "$output"
+    exit 1
+fi
+echo "stepping ok"
@@ -0,0 +1,366 @@
+"""
+Running the tests in a file in parallel.
+
+`interpret.py --run-tests FILE` (or `test --run-tests`) runs the tests in
+FILE, which is laid out like test.k: the top-level forms that are `$test`,
+`$t/t` or `$test-raises` combinations are tests, named by their first
+operand, and everything else (the definitions of those operatives, helpers,
+etc.) is set up for the tests that follow.
+
+The set up forms are evaluated in order in this process.  Each test is
+evaluated in a process forked when its turn comes, so it sees the
+environment as the forms before it left it, and its own side effects
+(defines, `trace`, etc.) don't reach the tests after it.  Up to `jobs` tests
+run at once.  A test fails if it calls `test-error`, and it's an error if
+it signals an error that it doesn't handle or its process dies; either way
+we go on with the rest.
+
+A line for each test is written to stderr as it finishes, and a report with
+the result, time and captured output of every test, in the order of the
+file, is written as JSON (or JUnit XML) to stdout or a file.
+"""
+
+import os
+import time
+
+from rpython.rlib import rpoll, rstring
+
+import kernel_type as kt
+import serialize
+
+
+PASS = 'p'
+FAIL = 'f'
+ERROR = 'e'
+
+TEST_OPERATIVES = ['$test', '$t/t', '$test-raises']
+
+class Result(object):
+    def __init__(self, name, line):
+        self.name = name
+        self.line = line
+        self.status = ERROR
+        self.elapsed_us = 0
+        self.message = ""
+        self.output = ""
+    def status_name(self):
+        if self.status == PASS:
+            return "pass"
+        elif self.status == FAIL:
+            return "fail"
+        else:
+            return "error"
+
+class Running(object):
+    """A test running in a child process."""
+    def __init__(self, pid, fd, result):
+        self.pid = pid
+        self.fd = fd
+        self.result = result
+
+def test_name(form):
+    """Name of the test `form` is, or None if it isn't one."""
+    if not isinstance(form, kt.Pair):
+        return None
+    operator = form.car
+    if (not isinstance(operator, kt.Symbol)
+            or operator.symval not in TEST_OPERATIVES):
+        return None
+    operands = form.cdr
+    if not isinstance(operands, kt.Pair):
+        return None
+    name = operands.car
+    if isinstance(name, kt.String):
+        return name.strval
+    return name.tostring()
+
+def source_line(interp, form):
+    import parse
+    if form.source_pos == kt.NO_SOURCE_POS:
+        return 0
+    line, _ = parse.line_and_column(form.source_pos, interp.source_files)
+    return line + 1
+
+def run_tests(interp, path, jobs):
+    """Results of the tests in the file at `path`, in the order of the
+    file."""
+    import analyze
+    import primitive
+    program = primitive.parse_file(path, interp.source_files)
+    assert isinstance(program, kt.Pair)
+    env = interp.extended_environment()
+    results = []
+    running = []
+    for form in kt.iter_list(program.cdr):
+        name = test_name(form)
+        if interp.analysis.enabled:
+            form = analyze.analyze(form)
+        if name is None:
+            setup(interp, form, env, results)
+            continue
+        while len(running) >= jobs:
+            wait_for_test(running)
+        result = Result(name, source_line(interp, form))
+        results.append(result)
+        running.append(start_test(interp, form, env, result))
+    while running:
+        wait_for_test(running)
+    return results
+
+def setup(interp, form, env, results):
+    """Evaluate a form that isn't a test.  If it fails, we report it as an
+    erroneous test, since the tests after it may fail because of it."""
+    import interpreter
+    import primitive
+    # Nobody would see it, and it'd get mixed with the report.
+    port = kt.StringOutputPort()
+    try:
+        interp.eval_contained(form, env,
+                              primitive.output_port_binding(port,
+                                                            kt.root_cont))
+    except interpreter.Escape as e:
+        line = source_line(interp, form)
+        result = Result("set up at line %d" % line, line)
+        result.message = error_message(e.val)
+        result.output = port.getvalue()
+        results.append(result)
+        report_progress(result)
+
+def start_test(interp, form, env, result):
+    # Don't let the child inherit (and flush again) buffered output.
+    interp.stdout_port.flush()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        run_test(interp, form, env, write_fd)
+    os.close(write_fd)
+    return Running(pid, read_fd, result)
+
+def run_test(interp, form, env, fd):
+    """Body of a test process."""
+    import interpreter
+    import primitive
+    import threads
+    try:
+        # Other green threads belong to the parent.
+        interp.scheduler = threads.Scheduler()
+        # Output goes to the report; `test-error` also writes straight to
+        # stdout, but we get its message from the exception.
+        null_fd = os.open("/dev/null", os.O_WRONLY, 0)
+        os.dup2(null_fd, 1)
+        os.close(null_fd)
+        port = kt.StringOutputPort()
+        status = PASS
+        message = ""
+        start = time.time()
+        try:
+            interp.eval_contained(form, env,
+                                  primitive.output_port_binding(port,
+                                                                kt.root_cont))
+        except primitive.TestError as e:
+            status = FAIL
+            message = value_text(e.val)
+        except interpreter.Escape as e:
+            status = ERROR
+            message = error_message(e.val)
+        except kt.KernelException as e:
+            status = ERROR
+            message = error_message(e.val)
+        elapsed_us = int((time.time() - start) * 1000000)
+        serialize.write_record(
+                fd, status,
+                serialize.serialize(
+                    kt.kernelify_list([kt.make_fixnum(elapsed_us),
+                                       kt.String(message),
+                                       kt.String(port.getvalue())])))
+    finally:
+        os._exit(0)
+
+def wait_for_test(running):
+    """Wait for one of the `running` tests to finish, and take it out."""
+    fds = {}
+    for test in running:
+        fds[test.fd] = rpoll.POLLIN
+    try:
+        events = rpoll.poll(fds, -1)
+    except rpoll.PollError:
+        events = []
+    ready_fds = {}
+    for fd, _ in events:
+        ready_fds[fd] = None
+    for i in range(len(running)):
+        test = running[i]
+        if test.fd in ready_fds:
+            del running[i]
+            finish_test(test)
+            return
+
+def finish_test(test):
+    result = test.result
+    try:
+        record = serialize.read_record(test.fd)
+    except OSError:
+        record = None
+    os.close(test.fd)
+    os.waitpid(test.pid, 0)
+    if record is None:
+        result.status = ERROR
+        result.message = "Test process died"
+    else:
+        tag, data = record.tag, record.data
+        elapsed, message, output = kt.pythonify_list(
+                serialize.deserialize(data), 3)
+        assert isinstance(elapsed, kt.Fixnum)
+        assert isinstance(message, kt.String)
+        assert isinstance(output, kt.String)
+        result.status = tag
+        result.elapsed_us = elapsed.fixval
+        result.message = message.strval
+        result.output = output.strval
+    report_progress(result)
+
+def value_text(vals):
+    """The irritants of `test-error`, as it prints them."""
+    import primitive
+    port = kt.StringOutputPort()
+    primitive.print_values(vals, port)
+    return port.getvalue()
+
+def error_message(val):
+    import server
+    if not isinstance(val, kt.ErrorObject):
+        return ("Continuation escaped from test: %s"
+                % server.external_representation(val))
+    return server.error_text(val)
+
+def report_progress(result):
+    if result.status == PASS:
+        line = "ok %s (%s s)\n" % (result.name, seconds(result.elapsed_us))
+    else:
+        line = "%s %s: %s\n" % (result.status_name().upper(), result.name,
+                                result.message)
+    os.write(2, line)
+
+def seconds(us):
+    """Microseconds as a decimal number of seconds."""
+    fraction = str(us % 1000000)
+    return "%d.%s%s" % (us // 1000000, "0" * (6 - len(fraction)), fraction)
+
+def count(results, status):
+    n = 0
+    for result in results:
+        if result.status == status:
+            n += 1
+    return n
+
+def json_report(path, results, elapsed_us):
+    out = rstring.StringBuilder()
+    out.append('{"file": %s, "seconds": %s, "passed": %d, "failed": %d, '
+               '"errors": %d, "tests": ['
+               % (json_string(path), seconds(elapsed_us),
+                  count(results, PASS), count(results, FAIL),
+                  count(results, ERROR)))
+    first = True
+    for result in results:
+        if not first:
+            out.append(',')
+        first = False
+        out.append('\n  {"name": %s, "line": %d, "status": "%s", '
+                   '"seconds": %s, "message": %s, "output": %s}'
+                   % (json_string(result.name), result.line,
+                      result.status_name(), seconds(result.elapsed_us),
+                      json_string(result.message),
+                      json_string(result.output)))
+    out.append('\n]}\n')
+    return out.build()
+
+def json_string(s):
+    out = rstring.StringBuilder(len(s) + 2)
+    out.append('"')
+    for c in s:
+        if c == '"' or c == '\\':
+            out.append('\\')
+            out.append(c)
+        elif c == '\n':
+            out.append('\\n')
+        elif c == '\t':
+            out.append('\\t')
+        elif ord(c) < 0x20:
+            out.append('\\u00')
+            out.append('0123456789abcdef'[ord(c) >> 4])
+            out.append('0123456789abcdef'[ord(c) & 15])
+        else:
+            out.append(c)
+    out.append('"')
+    return out.build()
+
+def junit_report(path, results, elapsed_us):
+    out = rstring.StringBuilder()
+    out.append('<?xml version="1.0" encoding="UTF-8"?>\n')
+    out.append('<testsuite name=%s tests="%d" failures="%d" errors="%d" '
+               'time="%s">\n'
+               % (xml_attribute(path), len(results), count(results, FAIL),
+                  count(results, ERROR), seconds(elapsed_us)))
+    for result in results:
+        out.append('  <testcase classname=%s name=%s time="%s">\n'
+                   % (xml_attribute(path), xml_attribute(result.name),
+                      seconds(result.elapsed_us)))
+        if result.status != PASS:
+            if result.status == FAIL:
+                element = 'failure'
+            else:
+                element = 'error'
+            out.append('    <%s message=%s/>\n'
+                       % (element, xml_attribute(result.message)))
+        if result.output:
+            out.append('    <system-out>%s</system-out>\n'
+                       % xml_text(result.output))
+        out.append('  </testcase>\n')
+    out.append('</testsuite>\n')
+    return out.build()
+
+def xml_attribute(s):
+    return '"%s"' % rstring.replace(xml_text(s), '"', '&quot;')
+
+def xml_text(s):
+    out = rstring.StringBuilder(len(s))
+    for c in s:
+        if c == '&':
+            out.append('&amp;')
+        elif c == '<':
+            out.append('&lt;')
+        elif c == '>':
+            out.append('&gt;')
+        elif ord(c) < 0x20 and c != '\n' and c != '\t':
+            # Not allowed in XML 1.0, even as character references.
+            out.append('?')
+        else:
+            out.append(c)
+    return out.build()
+
+def run(interp, path, jobs, junit, output_path):
+    """Run the tests in `path` and write the report; the exit status is 1
+    if any test didn't pass."""
+    start = time.time()
+    results = run_tests(interp, path, jobs)
+    elapsed_us = int((time.time() - start) * 1000000)
+    if junit:
+        report = junit_report(path, results, elapsed_us)
+    else:
+        report = json_report(path, results, elapsed_us)
+    if output_path is None:
+        serialize.write_all(1, report)
+    else:
+        fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0644)
+        try:
+            serialize.write_all(fd, report)
+        finally:
+            os.close(fd)
+    failed = len(results) - count(results, PASS)
+    os.write(2, "%d tests, %d failed, in %s s\n"
+                % (len(results), failed, seconds(elapsed_us)))
+    if failed:
+        return 1
+    return 0
@@ -0,0 +1,385 @@
+"""
+Green threads.
+
+All of a computation's control state is in its (val, env, cont) triple, so
+threads are just saved triples, and switching threads is just handing a
+different triple to the trampoline.  Primitives that switch (`yield`,
+`join`, `channel-receive`) return the triple of the next thread to run; the
+trampoline also preempts the running thread every `quantum` steps if there
+are others ready.
+
+A thread's continuation extends the one `spawn` was called with, so threads
+see the keyed dynamic bindings of the code that spawned them.  Its base is
+guarded against errors: an error that isn't handled within the thread ends
+it, and is signalled again in whoever joins it.  Switching threads isn't an
+abnormal pass, so it doesn't run any guards.
+
+Port operations on file descriptors that aren't ready don't block the whole
+interpreter: the primitive parks its thread until the descriptor is ready,
+and then starts over (see `FileInputPort`).  The scheduler polls the
+descriptors threads are waiting for every `quantum` steps, and waits on them
+when no thread can run.
+
+The thread that started the computation (the main thread) is the only one
+whose end ends the program.  If every thread is blocked, and none of them on
+I/O, we signal a deadlock error in the main thread.
+
+A computation may be given a budget of trampoline steps (its fuel) with
+`call-with-fuel`, which marks its extent with a `FuelCont`.  Budgets are
+charged a slice at a time, so the trampoline still only counts down a local
+variable: slices are cut short to the fuel left in the budgets of the
+running continuation, and when one ends we charge it to them.  When a slice
+ends, the running continuation looks up the innermost `FuelCont` it extends
+and remembers it, as do the frames it walked through, and each `FuelCont`
+finds the next one out the same way.  So making continuations costs nothing
+extra, and a lookup only walks the frames made since the last one.  Steps
+taken in the slice where a budget starts (or gets more fuel) are free, so a
+budget may be overrun by up to `quantum` steps.  When a budget runs out we
+signal an error with a continuation that resumes the computation where it
+stopped, given more fuel.  Threads spawned in a computation share its
+budget.
+"""
+
+import errno
+
+from rpython.rlib import rpoll
+
+import kernel_type as kt
+
+
+READY = 0
+RUNNING = 1
+BLOCKED = 2
+DONE = 3
+
+class Thread(kt.KernelValue):
+    type_name = 'thread'
+    def __init__(self, source_pos=kt.NO_SOURCE_POS):
+        self.source_pos = source_pos
+        self.state = READY
+        # Saved triple, while not running.
+        self.val = None
+        self.env = None
+        self.cont = None
+        # List of threads we are in, if blocked.
+        self.waiting_in = None
+        # What we are waiting for, if blocked on I/O.
+        self.fd = -1
+        self.events = 0
+        self.joiners = []
+        self.result = None
+        self.error = None
+    def save(self, val, env, cont):
+        self.val = val
+        self.env = env
+        self.cont = cont
+    def resume_with(self, val, cont):
+        """Make the saved triple pass `val` to `cont`."""
+        self.save(kt.inert, kt.Environment([]), kt.ConstantCont(val, cont))
+    def take(self):
+        val, env, cont = self.val, self.env, self.cont
+        self.val = None
+        self.env = None
+        self.cont = None
+        return val, env, cont
+    def tostring(self):
+        return "#<thread>"
+
+class Channel(kt.KernelValue):
+    """Unbounded mailbox.  Sending never blocks; receiving blocks while the
+    channel is empty."""
+    type_name = 'channel'
+    def __init__(self, source_pos=kt.NO_SOURCE_POS):
+        self.source_pos = source_pos
+        self.items = Queue()
+        self.receivers = []
+    def tostring(self):
+        return "#<channel>"
+
+class Queue(object):
+    """FIFO of Kernel values (threads included)."""
+    def __init__(self):
+        self.items = []
+        self.head = 0
+    def is_empty(self):
+        return self.head >= len(self.items)
+    def push(self, item):
+        self.items.append(item)
+    def pop(self):
+        assert not self.is_empty()
+        item = self.items[self.head]
+        self.items[self.head] = None
+        self.head += 1
+        if self.head >= 64 and self.head * 2 >= len(self.items):
+            del self.items[:self.head]
+            self.head = 0
+        return item
+
+class Scheduler(object):
+    def __init__(self, quantum=1000):
+        # Trampoline steps a thread runs before being preempted.
+        self.quantum = quantum
+        self.ready = Queue()
+        # Threads blocked on I/O.
+        self.io_waiting = []
+        self.main = Thread()
+        self.main.state = RUNNING
+        self.current = self.main
+        # Number of slices that have ended.
+        self.slices = 0
+    def slice_length(self, cont):
+        """Steps to run `cont`'s computation for before calling `end_slice`."""
+        steps = self.quantum
+        fuel_cont = cont.get_fuel_cont()
+        while fuel_cont is not None:
+            assert isinstance(fuel_cont, FuelCont)
+            if 0 < fuel_cont.budget.fuel < steps:
+                steps = fuel_cont.budget.fuel
+            fuel_cont = fuel_cont.outer_fuel_cont()
+        return steps
+    def end_slice(self, steps, val, env, cont):
+        """Charge the `steps` of the slice that just ended to the budgets of
+        `cont`, and return the triple to go on with: that of a fuel
+        exhausted error (for the outermost budget that ran out), that of
+        another thread if any is ready, or (val, env, cont)."""
+        exhausted = None
+        fuel_cont = cont.get_fuel_cont()
+        while fuel_cont is not None:
+            assert isinstance(fuel_cont, FuelCont)
+            budget = fuel_cont.budget
+            if budget.start < self.slices:
+                budget.fuel -= steps
+            if budget.fuel <= 0:
+                exhausted = budget
+            fuel_cont = fuel_cont.outer_fuel_cont()
+        self.slices += 1
+        if exhausted is not None:
+            resume = ResumeCont(exhausted, val, env, cont)
+            return kt.inert, env, FuelExhaustedCont(resume)
+        self.poll_io(0)
+        if self.has_ready():
+            return self.preempt(val, env, cont)
+        return val, env, cont
+    def with_fuel(self, fuel, cont):
+        """Continuation for a computation that may take `fuel` steps, and
+        whose value goes to `cont`."""
+        return FuelCont(Budget(fuel, self.slices), cont)
+    def refuel(self, budget, fuel):
+        budget.fuel = fuel
+        budget.start = self.slices
+    def has_ready(self):
+        return not self.ready.is_empty()
+    def make_ready(self, thread):
+        thread.state = READY
+        thread.waiting_in = None
+        self.ready.push(thread)
+    def switch(self):
+        """Triple of the next ready thread, which becomes the current one."""
+        thread = self.ready.pop()
+        assert isinstance(thread, Thread)
+        thread.state = RUNNING
+        self.current = thread
+        return thread.take()
+    def preempt(self, val, env, cont):
+        """Put the current thread at the back of the queue and switch."""
+        self.current.save(val, env, cont)
+        self.make_ready(self.current)
+        return self.switch()
+    def block(self, waiting_in, cont):
+        """Block the current thread (which will be resumed by passing a value
+        to `cont`) in the list `waiting_in`, and switch to another one."""
+        thread = self.current
+        thread.state = BLOCKED
+        thread.save(None, None, cont)
+        thread.waiting_in = waiting_in
+        waiting_in.append(thread)
+        return self.switch_or_deadlock()
+    def switch_or_deadlock(self):
+        while not self.has_ready() and self.io_waiting:
+            self.poll_io(-1)
+        if self.has_ready():
+            return self.switch()
+        # Nothing can run; wake the main thread with an error.
+        main = self.main
+        if main.state == DONE or main.waiting_in is None:
+            kt.signal_deadlock()
+        main.waiting_in.remove(main)
+        cont = main.cont
+        main.save(kt.inert, kt.Environment([]), DeadlockCont(cont))
+        self.make_ready(main)
+        return self.switch()
+    def spawn(self, combiner, cont):
+        thread = Thread()
+        env = kt.Environment([])
+        outer = kt.OuterGuardCont(kt.nil, env, ThreadEndCont(thread, cont))
+        guarded = kt.InnerGuardCont(
+                kt.Pair(kt.Pair(kt.error_cont,
+                                kt.Pair(kt.Applicative(ThreadErrorHandler(thread)),
+                                        kt.nil)),
+                        kt.nil),
+                env,
+                outer)
+        thread.save(kt.Pair(combiner, kt.nil), env, guarded)
+        self.make_ready(thread)
+        return thread
+    def finish(self, thread, result, error):
+        """End `thread` and return the triple of the next one to run."""
+        thread.state = DONE
+        thread.result = result
+        thread.error = error
+        for joiner in thread.joiners:
+            self.wake(joiner, result)
+        thread.joiners = []
+        return self.switch_or_deadlock()
+    def wait_io(self, fd, events, cont):
+        """Block the current thread until `fd` is ready for `events`, and
+        then pass #inert to `cont`."""
+        thread = self.current
+        thread.fd = fd
+        thread.events = events
+        return self.block(self.io_waiting, cont)
+    def poll_io(self, timeout):
+        """Make ready the threads whose file descriptors are, waiting up to
+        `timeout` milliseconds (forever if negative) for some to be."""
+        if not self.io_waiting:
+            return
+        fds = {}
+        for thread in self.io_waiting:
+            fds[thread.fd] = fds.get(thread.fd, 0) | thread.events
+        revents = {}
+        try:
+            for fd, events in rpoll.poll(fds, timeout):
+                revents[fd] = events
+        except rpoll.PollError as e:
+            if e.errno == errno.EINTR:
+                return
+            # Wake everyone, so their operations report the error.
+            revents = fds
+        still_waiting = []
+        woken = []
+        for thread in self.io_waiting:
+            if thread.fd in revents:
+                woken.append(thread)
+            else:
+                still_waiting.append(thread)
+        del self.io_waiting[:]
+        self.io_waiting.extend(still_waiting)
+        for thread in woken:
+            self.wake(thread, kt.inert)
+    def wake(self, thread, val):
+        thread.resume_with(val, thread.cont)
+        self.make_ready(thread)
+    def join(self, thread, cont):
+        if thread.state == DONE:
+            if thread.error is not None:
+                resignal(thread.error)
+            return cont.plug_reduce(thread.result)
+        if thread is self.current:
+            kt.signal_deadlock()
+        return self.block(thread.joiners, JoinCont(thread, cont))
+    def receive(self, channel, cont):
+        if not channel.items.is_empty():
+            return cont.plug_reduce(channel.items.pop())
+        return self.block(channel.receivers, cont)
+    def send(self, channel, val):
+        if channel.receivers:
+            self.wake(channel.receivers.pop(0), val)
+        else:
+            channel.items.push(val)
+
+def resignal(error):
+    if isinstance(error, kt.ErrorObject):
+        kt.raise_(error.dest_cont, error.message.strval, error.irritants)
+    else:
+        kt.raise_(kt.error_cont,
+                  "Non-error object passed to error continuation in thread",
+                  kt.Pair(error, kt.nil))
+
+class ThreadEndCont(kt.Continuation):
+    """Base of a thread's continuation; `prev` is only used to look up keyed
+    dynamic bindings and guards."""
+    def __init__(self, thread, prev):
+        kt.Continuation.__init__(self, prev)
+        self.thread = thread
+    def _plug_reduce(self, val):
+        return get_scheduler().finish(self.thread, val, None)
+
+class ThreadErrorHandler(kt.Operative):
+    """Interceptor for errors leaving a thread: end the thread instead."""
+    uses_dynamic_env = False
+    def __init__(self, thread):
+        self.thread = thread
+        self.source_pos = kt.NO_SOURCE_POS
+        self.name = None
+    def combine(self, operands, env, cont):
+        error, divert = kt.pythonify_list(operands, 2)
+        return get_scheduler().finish(self.thread, kt.inert, error)
+
+class JoinCont(kt.Continuation):
+    """Resumes a thread blocked joining `thread`, once it's done."""
+    def __init__(self, thread, prev):
+        kt.Continuation.__init__(self, prev)
+        self.thread = thread
+    def _plug_reduce(self, val):
+        if self.thread.error is not None:
+            resignal(self.thread.error)
+        return self.prev.plug_reduce(val)
+
+class Budget(object):
+    def __init__(self, fuel, start):
+        self.fuel = fuel
+        # Slice in which we got our fuel, which isn't charged.
+        self.start = start
+
+class FuelCont(kt.Continuation):
+    """Marks the extent of a computation with a fuel budget."""
+    def __init__(self, budget, prev):
+        kt.Continuation.__init__(self, prev)
+        self.budget = budget
+    def extend_fuel_cont(self, fuel_cont):
+        return self
+    def outer_fuel_cont(self):
+        """The next continuation with a budget that this one extends."""
+        if self.prev is None:
+            return None
+        return self.prev.get_fuel_cont()
+
+class ResumeCont(kt.Continuation):
+    """Passed with a fuel exhausted error.  Passing it a number of steps
+    gives them to the budget that ran out and resumes the computation."""
+    def __init__(self, budget, val, env, prev):
+        kt.Continuation.__init__(self, prev)
+        self.budget = budget
+        self.val = val
+        self.env = env
+    def _plug_reduce(self, fuel):
+        get_scheduler().refuel(self.budget, check_fuel(fuel))
+        return self.val, self.env, self.prev
+
+class FuelExhaustedCont(kt.Continuation):
+    def _plug_reduce(self, val):
+        resume = self.prev
+        assert isinstance(resume, ResumeCont)
+        error = kt.ErrorObject(kt.fuel_exhausted_cont,
+                               "Out of fuel",
+                               kt.Pair(resume, kt.nil))
+        # Report where we stopped, rather than this continuation.
+        error.val = resume.val
+        error.env = resume.env
+        error.src_cont = resume
+        raise kt.KernelException(error)
+
+def check_fuel(val):
+    kt.check_type(val, kt.Fixnum)
+    assert isinstance(val, kt.Fixnum)
+    if val.fixval < 1:
+        kt.signal_value_error("Fuel must be positive", kt.Pair(val, kt.nil))
+    return val.fixval
+
+class DeadlockCont(kt.Continuation):
+    def _plug_reduce(self, val):
+        kt.signal_deadlock()
+
+def get_scheduler():
+    import interpreter
+    return interpreter.current().scheduler
@@ -0,0 +1,422 @@
+"""
+Bytecode compiler and virtual machine for the bodies of compound operatives.
+
+Bodies are lowered into a flat array of (opcode, argument) pairs, which the
+loop in `run` executes with a small value stack.  The VM takes care of
+constants, variable lookup, calls to simple primitives and the ground special
+forms ($if, $sequence, $define!, $vau and $lambda) without going back to the
+trampoline in `kernel_eval`.
+
+Combiners aren't known until run time in Kernel, so:
+
+ - Special forms are compiled under a guard that checks that the operator
+   still evaluates to the ground operative.  If it doesn't, we combine
+   whatever it evaluates to with the original operands, as the tree walker
+   would.
+
+ - For other combinations we evaluate the operator first.  If it's not an
+   applicative we combine it with the original operands; otherwise we
+   evaluate the arguments on the stack and call it.
+
+Whenever we need the trampoline (calls to anything other than a simple
+primitive, fallbacks) we return to it with a `VMCont` that resumes execution
+where we left off.  This keeps call/cc, guarded continuations and tail calls
+working as usual.  VMConts keep their own copy of the stack, so they can be
+resumed any number of times.
+
+`run` has a JIT driver of its own, with the code and the pc as greens, so
+traces that go through the VM have its instructions constant-folded.
+"""
+
+from rpython.rlib import jit
+
+import analyze
+import debug
+import interpreter
+import kernel_type as kt
+import parse
+
+
+class VMState(object):
+    def __init__(self):
+        self.enabled = False
+
+def enable():
+    interpreter.current().vm.enabled = True
+
+def disable():
+    interpreter.current().vm.enabled = False
+
+def is_enabled():
+    return interpreter.current().vm.enabled
+
+# Opcodes.
+CONST = 0            # push constants[arg]
+LOAD = 1             # push value of symbol constants[arg]
+LOAD_LOCAL = 2       # same, for symbols bound by the formal parameter tree
+POP = 3              # discard top of stack
+RETURN = 4           # pass top of stack to the operative's continuation
+JUMP = 5             # jump to arg
+BRANCH_FALSE = 6     # pop boolean; jump to arg if false
+DEFINE = 7           # pop value; match definiend constants[arg]; push #inert
+GUARD = 8            # check that the operator of sites[arg] is as expected
+APPLICATIVE = 9      # check that the combiner on the stack is applicative
+CALL = 10            # pop arg arguments and an applicative; call it
+TAIL_CALL = 11       # same, in tail position
+MAKE_OPERATIVE = 12  # push compound operative described by sites[arg]
+EVAL = 13            # evaluate constants[arg] in the trampoline; push result
+TAIL_EVAL = 14       # same, in tail position
+
+opcode_names = ['CONST', 'LOAD', 'LOAD_LOCAL', 'POP', 'RETURN', 'JUMP',
+                'BRANCH_FALSE', 'DEFINE', 'GUARD', 'APPLICATIVE', 'CALL',
+                'TAIL_CALL', 'MAKE_OPERATIVE', 'EVAL', 'TAIL_EVAL']
+
+
+class Site(object):
+    """Data about a combination, needed by the instructions that may fall back
+    to generic evaluation of it."""
+    def __init__(self, operands, tail):
+        self.operands = operands
+        self.tail = tail
+        # Where to continue after falling back; patched by the compiler.
+        self.resume_pc = -1
+
+class GuardSite(Site):
+    def __init__(self, operator, expected, operands, tail):
+        Site.__init__(self, operands, tail)
+        self.operator = operator
+        self.expected = expected
+
+class OperativeSite(Site):
+    def __init__(self, formals, eformal, exprs, is_lambda):
+        Site.__init__(self, kt.nil, False)
+        self.formals = formals
+        self.eformal = eformal
+        self.exprs = exprs
+        self.is_lambda = is_lambda
+        # Shared by all the operatives created here; compiled on first use.
+        self.body = None
+        self.layout = kt.frame_layout(formals, eformal)
+    def get_body(self):
+        if self.body is None:
+            self.body = compile_body(self.exprs,
+                                     kt.Pair(self.formals, self.eformal))
+        return self.body
+
+
+class Code(kt.KernelValue):
+    """Compiled body of an operative.  Evaluating it runs it in the VM."""
+    simple = False
+    _immutable_fields_ = ['instructions[*]', 'constants[*]', 'sites[*]',
+                          'exprs']
+    def __init__(self, instructions, constants, sites, exprs):
+        self.instructions = instructions
+        self.constants = constants
+        self.sites = sites
+        self.exprs = exprs
+        self.source_pos = kt.NO_SOURCE_POS
+    def interpret(self, env, cont):
+        if debug.is_stepping():
+            # Let the debugger see every step.
+            return kt.sequence(self.exprs, env, cont)
+        return run(self, 0, [], env, cont)
+    def tostring(self):
+        return "<code for %s>" % self.exprs.tostring()
+    def disassemble(self):
+        lines = []
+        for pc in range(0, len(self.instructions), 2):
+            lines.append("%4d %s %d" % (pc,
+                                        opcode_names[self.instructions[pc]],
+                                        self.instructions[pc+1]))
+        return "\n".join(lines)
+
+class VMCont(kt.Continuation):
+    def __init__(self, code, pc, stack, env, prev):
+        kt.Continuation.__init__(self, prev)
+        self.code = code
+        self.pc = pc
+        # `run` hands us its stack and doesn't touch it again.
+        self.stack = stack
+        self.env = env
+    def _plug_reduce(self, val):
+        # Copied, so we can be plugged again.
+        stack = self.stack[:]
+        stack.append(val)
+        return run(self.code, self.pc, stack, self.env, self.prev)
+
+
+def compile_body(exprs, formals=kt.nil):
+    """Return the body to evaluate in place of `exprs`: a list with a single
+    Code object, or `exprs` itself if it's not a proper list.  Symbols in
+    `formals` are known to be bound in the local environment."""
+    if analyze.operand_list(kt.Pair(kt.nil, exprs), 0) is None:
+        return exprs
+    compiler = Compiler(formals)
+    compiler.compile_sequence(exprs, True)
+    return kt.Pair(compiler.make_code(exprs), kt.nil)
+
+class Compiler(object):
+    def __init__(self, formals):
+        self.instructions = []
+        self.constants = []
+        self.sites = []
+        self.locals = {}
+        collect_symbols(formals, self.locals)
+    def make_code(self, exprs):
+        return Code(self.instructions[:], self.constants[:], self.sites[:],
+                    exprs)
+    def emit(self, opcode, arg=0):
+        self.instructions.append(opcode)
+        self.instructions.append(arg)
+    def here(self):
+        return len(self.instructions)
+    def patch(self, pc, target):
+        self.instructions[pc+1] = target
+    def add_constant(self, val):
+        self.constants.append(val)
+        return len(self.constants) - 1
+    def add_site(self, site):
+        self.sites.append(site)
+        return len(self.sites) - 1
+    def compile_sequence(self, exprs, tail):
+        if kt.is_nil(exprs):
+            self.emit(CONST, self.add_constant(kt.inert))
+            if tail:
+                self.emit(RETURN)
+            return
+        while isinstance(exprs, kt.Pair):
+            if kt.is_nil(exprs.cdr):
+                self.compile_expr(exprs.car, tail)
+            else:
+                self.compile_expr(exprs.car, False)
+                self.emit(POP)
+            exprs = exprs.cdr
+    def compile_expr(self, expr, tail):
+        if isinstance(expr, kt.Pair):
+            self.compile_combination(expr, tail)
+            return
+        if isinstance(expr, kt.Symbol):
+            if expr.symval in self.locals:
+                self.emit(LOAD_LOCAL, self.add_constant(expr))
+            else:
+                self.emit(LOAD, self.add_constant(expr))
+        else:
+            self.emit(CONST, self.add_constant(expr))
+        if tail:
+            self.emit(RETURN)
+    def compile_combination(self, pair, tail):
+        operands = analyze.operand_list(pair, 0)
+        if operands is None:
+            # Let the trampoline signal the error.
+            self.emit(TAIL_EVAL if tail else EVAL, self.add_constant(pair))
+            return
+        name = analyze.special_form_name(pair.car)
+        if name is not None and self.compile_special_form(name,
+                                                          pair,
+                                                          operands,
+                                                          tail):
+            return
+        self.compile_expr(pair.car, False)
+        site = Site(pair.cdr, tail)
+        self.emit(APPLICATIVE, self.add_site(site))
+        for operand in operands:
+            self.compile_expr(operand, False)
+        self.emit(TAIL_CALL if tail else CALL, len(operands))
+        site.resume_pc = self.here()
+    def compile_special_form(self, name, pair, operands, tail):
+        n = len(operands)
+        if ((name == '$if' and n != 3)
+            or (name == '$define!' and n != 2)
+            or (name == '$vau' and n < 2)
+            or (name == '$lambda' and n < 1)):
+            return False
+        site = GuardSite(pair.car,
+                         analyze.special_forms[name],
+                         pair.cdr,
+                         tail)
+        self.emit(GUARD, self.add_site(site))
+        if name == '$if':
+            self.compile_expr(operands[0], False)
+            branch = self.here()
+            self.emit(BRANCH_FALSE)
+            self.compile_expr(operands[1], tail)
+            jump = -1
+            if tail:
+                self.patch(branch, self.here())
+            else:
+                jump = self.here()
+                self.emit(JUMP)
+                self.patch(branch, self.here())
+            self.compile_expr(operands[2], tail)
+            if not tail:
+                self.patch(jump, self.here())
+        elif name == '$sequence':
+            self.compile_sequence(pair.cdr, tail)
+        elif name == '$define!':
+            self.compile_expr(operands[1], False)
+            self.emit(DEFINE, self.add_constant(operands[0]))
+            if tail:
+                self.emit(RETURN)
+        else:
+            rest = pair.cdr
+            assert isinstance(rest, kt.Pair)
+            if name == '$vau':
+                rest = rest.cdr
+                assert isinstance(rest, kt.Pair)
+                op_site = OperativeSite(operands[0], operands[1], rest.cdr,
+                                        False)
+            else:
+                op_site = OperativeSite(operands[0], kt.ignore, rest.cdr, True)
+            self.emit(MAKE_OPERATIVE, self.add_site(op_site))
+            if tail:
+                self.emit(RETURN)
+        site.resume_pc = self.here()
+        return True
+
+def collect_symbols(tree, symbols):
+    pending = [tree]
+    while pending:
+        tree = pending.pop()
+        if isinstance(tree, kt.Symbol):
+            symbols[tree.symval] = None
+        elif isinstance(tree, kt.Pair):
+            pending.append(tree.car)
+            pending.append(tree.cdr)
+
+
+def get_printable_location(pc, code):
+    return "%s %d %s" % (parse.trace_location(code.exprs.source_pos),
+                         pc,
+                         opcode_names[code.instructions[pc]])
+
+driver = jit.JitDriver(reds=['stack', 'env', 'cont'],
+                       greens=['pc', 'code'],
+                       get_printable_location=get_printable_location,
+                       is_recursive=True)
+
+def run(code, pc, stack, env, cont):
+    while True:
+        driver.jit_merge_point(pc=pc, code=code, stack=stack, env=env,
+                               cont=cont)
+        opcode = code.instructions[pc]
+        arg = code.instructions[pc+1]
+        pc += 2
+        if opcode == CONST:
+            stack.append(code.constants[arg])
+        elif opcode == LOAD or opcode == LOAD_LOCAL:
+            symbol = code.constants[arg]
+            assert isinstance(symbol, kt.Symbol)
+            val = None
+            if opcode == LOAD_LOCAL:
+                val = env.get_local(symbol.symval)
+            if val is None:
+                try:
+                    val = env.lookup(symbol)
+                except kt.KernelException as e:
+                    fill_error(e.val, symbol, code, pc, stack, env, cont)
+                    raise
+            stack.append(val)
+        elif opcode == POP:
+            stack.pop()
+        elif opcode == RETURN:
+            return cont.plug_reduce(stack.pop())
+        elif opcode == JUMP:
+            pc = arg
+        elif opcode == BRANCH_FALSE:
+            val = stack.pop()
+            if kt.is_false(val):
+                pc = arg
+            elif not kt.is_true(val):
+                kt.signal_type_error(kt.Boolean, val)
+        elif opcode == DEFINE:
+            kt.match_parameter_tree(code.constants[arg], stack.pop(), env)
+            stack.append(kt.inert)
+        elif opcode == GUARD:
+            site = code.sites[arg]
+            assert isinstance(site, GuardSite)
+            if isinstance(site.operator, kt.Symbol):
+                combiner = env.lookup(site.operator)
+            else:
+                combiner = site.operator
+            if combiner is not site.expected:
+                return fall_back(site, combiner, code, stack, env, cont)
+        elif opcode == APPLICATIVE:
+            if not isinstance(stack[-1], kt.Applicative):
+                return fall_back(code.sites[arg],
+                                 stack.pop(),
+                                 code,
+                                 stack,
+                                 env,
+                                 cont)
+        elif opcode == CALL or opcode == TAIL_CALL:
+            applicative = stack[-arg-1]
+            assert isinstance(applicative, kt.Applicative)
+            combiner = applicative.wrapped_combiner
+            if isinstance(combiner, kt.Lambda) and combiner.arity == arg:
+                # Bind the arguments right off the stack.
+                callee = len(stack) - arg - 1
+                assert callee >= 0
+                frame = combiner.bind_arguments(stack[callee+1:])
+                del stack[callee:]
+                if opcode == TAIL_CALL:
+                    return combiner.entry, frame, cont
+                return (combiner.entry,
+                        frame,
+                        VMCont(code, pc, stack, env, cont))
+            args = kt.nil
+            for i in range(arg):
+                args = kt.Pair(stack.pop(), args)
+            stack.pop()
+            if isinstance(combiner, kt.SimplePrimitive):
+                try:
+                    val = combiner.code(args)
+                except kt.KernelException as e:
+                    fill_error(e.val, args, code, pc, stack, env, cont)
+                    raise
+                if opcode == TAIL_CALL:
+                    return cont.plug_reduce(val)
+                stack.append(val)
+            elif opcode == TAIL_CALL:
+                return combiner.combine(args, env, cont)
+            else:
+                return combiner.combine(args,
+                                        env,
+                                        VMCont(code, pc, stack, env, cont))
+        elif opcode == MAKE_OPERATIVE:
+            site = code.sites[arg]
+            assert isinstance(site, OperativeSite)
+            operative = kt.make_compound_operative(site.formals,
+                                                   site.eformal,
+                                                   site.exprs,
+                                                   env,
+                                                   body=site.get_body(),
+                                                   layout=site.layout)
+            if site.is_lambda:
+                stack.append(kt.Applicative(operative))
+            else:
+                stack.append(operative)
+        elif opcode == EVAL:
+            return (code.constants[arg],
+                    env,
+                    VMCont(code, pc, stack, env, cont))
+        elif opcode == TAIL_EVAL:
+            return code.constants[arg], env, cont
+        else:
+            assert False, "unknown opcode %d" % opcode
+
+def fall_back(site, combiner, code, stack, env, cont):
+    if site.tail:
+        return combiner.combine(site.operands, env, cont)
+    else:
+        return combiner.combine(site.operands,
+                                env,
+                                VMCont(code, site.resume_pc, stack, env, cont))
+
+def fill_error(error, val, code, pc, stack, env, cont):
+    """Record where an error signalled inside the VM happened, so a value
+    passed to `error.src_cont` (e.g., from the debugger) resumes execution
+    right after the failing instruction."""
+    if error.src_cont is None:
+        error.val = val
+        error.env = env
+        error.src_cont = VMCont(code, pc, stack, env, cont)